@@ -1,9 +1,15 @@
 # standard utilities
 from pathlib import Path
+from collections import Counter
+from itertools import islice
+from multiprocessing import Pool
+from functools import partial
 import sys
 from tqdm import tqdm
 import logging
 import pickle
+import json
+import os
 from nltk.tokenize import sent_tokenize, word_tokenize
 
 # modeling
@@ -11,7 +17,13 @@ from gensim.models.phrases import Phrases, Phraser
 
 logging.basicConfig(level=logging.INFO)
 
-from utils import get_sentences
+from utils import get_sentences, read_chunk
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'src'))
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'src' / 'modeling'))
+import ProfileUtils as PU
+import CorpusUtils as CU
+from CorpusUtils import get_chunks
 
 def tokenize(line):
     """
@@ -48,6 +60,20 @@ def get_phraser(sentences, mc, th):
     phraser = Phraser(phrases)
     return phraser
 
+class MultiPhraser(object):
+    """
+    Applies a sequence of phrasers to a tokenized sentence.
+    Unlike a closure, it can be sent to worker processes.
+    """
+    
+    def __init__(self, phrasers):
+        self.phrasers = phrasers
+        
+    def __call__(self, x):
+        for p in self.phrasers:
+            x = p[x]
+        return x
+
 def get_multiphraser(fs, params):
     """
     Gets an iterative phraser (ie unigrams -> bigrams -> trigrams)
@@ -58,55 +84,217 @@ def get_multiphraser(fs, params):
     return: a function that phrases a tokenized sentence
     """
     
-    identity = lambda x: x
     phrasers = []
-    def foo(x):
-        for p in phrasers:
-            x = p[x]
-        return x
+    foo = MultiPhraser(phrasers)
     for mc, th in params:
         phraser = get_phraser(get_sentences(fs, op=foo, verbose=False), mc=mc, th=th)
         phrasers.append(phraser)   
     return foo
+
+# the multiphraser of a worker process, set once by init_worker
+worker_op = None
+
+def init_worker(op):
+    global worker_op
+    worker_op = op
+    
+def count_phrase_stats(chunk, delimiter='_'):
+    """
+    Counts unigrams and adjacent bigrams in one shard, as gensim Phrases does.
+    
+    chunk: a byte range from get_chunks
+    delimiter: joins the two words of a bigram
+    
+    return: (Counter of unigrams and joined bigrams, number of words)
+    """
+    vocab = Counter()
+    n_words = 0
+    for line in read_chunk(chunk):
+        sent = line.strip().split()
+        vocab.update(sent)
+        vocab.update(delimiter.join(pair) for pair in zip(sent, sent[1:]))
+        n_words += len(sent)
+    return vocab, n_words
+
+def get_phrases_parallel(fs, mc, th, pool):
+    """
+    Gathers phrase statistics over shards of the files in a worker pool, and
+    merges them into a gensim Phrases that scores them.
+    Unlike gensim, the merged vocabulary is not pruned to max_vocab_size.
+    
+    fs: the files to read from
+    mc: min_count (see gensim Phrases)
+    th: threshold (see gensim Phrases)
+    pool: the worker pool
+    
+    return: gensim Phrases.
+    """
+    phrases = Phrases(min_count=mc, threshold=th)
+    # gensim 3 keys its vocabulary by utf8 bytes, gensim 4 by str
+    binary = isinstance(phrases.delimiter, bytes)
+    delimiter = phrases.delimiter.decode('utf8') if binary else phrases.delimiter
+    
+    chunks = [c for f in fs for c in get_chunks(f)]
+    vocab = Counter()
+    n_words = 0
+    for counts, n in pool.imap_unordered(partial(count_phrase_stats, delimiter=delimiter), chunks):
+        vocab.update(counts)
+        n_words += n
+    
+    if binary:
+        phrases.vocab.update((w.encode('utf8'), c) for w, c in vocab.items())
+    else:
+        phrases.vocab.update(vocab)
+    phrases.corpus_word_count += n_words
+    return phrases
+
+def apply_phraser(chunk):
+    """
+    Phrases the lines of one shard with the worker's phraser.
+    """
+    return ''.join(f"{' '.join(worker_op(line.strip().split()))}\n" for line in read_chunk(chunk))
+
+def get_round_key(fs, params):
+    """
+    Identifies the input of a phrasing round: the source files and the rounds before it.
+    """
+    sources = [(str(f), f.stat().st_size, f.stat().st_mtime) for f in fs]
+    return json.dumps({'sources': sources, 'params': params})
+
+def get_multiphraser_parallel(fs, params, n_workers, cache_dir):
+    """
+    Gets an iterative phraser like get_multiphraser, gathering the phrase
+    statistics of each round in parallel over file shards. The phrased text of
+    each round is cached in cache_dir and read by the next round, so earlier
+    phrasers are applied once per round instead of once per sentence per round.
+    
+    fs: the files to read from
+    params: A list of parameters: [(min_count1, threshold1), (min_count2, threshold2), ...]
+    n_workers: the number of worker processes
+    cache_dir: the directory to cache the phrased text of each round in
+    
+    return: a function that phrases a tokenized sentence
+    """
+    
+    phrasers = []
+    inputs = list(fs)
+    for r, (mc, th) in enumerate(params):
+        with Pool(n_workers) as pool:
+            phraser = Phraser(get_phrases_parallel(inputs, mc, th, pool))
+        phrasers.append(phraser)
+        logging.info(f"Phrasing round {r + 1}/{len(params)} done.")
+        if r == len(params) - 1:
+            break
+        
+        # phrase this round's input once, for the next round to read
+        round_dir = Path(cache_dir) / f"round{r + 1}"
+        key = get_round_key(fs, params[:r + 1])
+        outputs = [round_dir / f.name for f in fs]
+        if (round_dir / 'key.json').exists() and open(round_dir / 'key.json').read() == key:
+            logging.info(f"Reusing the cached phrased text in {round_dir}")
+        else:
+            if not os.path.exists(round_dir):
+                os.makedirs(round_dir)
+            with Pool(n_workers, initializer=init_worker, initargs=(MultiPhraser([phraser]),)) as pool:
+                for f_in, f_out in zip(inputs, outputs):
+                    with open(f_out, 'w') as fp:
+                        for text in pool.imap(apply_phraser, get_chunks(f_in)):
+                            fp.write(text)
+            with open(round_dir / 'key.json', 'w') as fp:
+                fp.write(key)
+        inputs = outputs
+    return MultiPhraser(phrasers)
+
+def phrase_batch(lines):
+    """
+    Phrases a batch of raw lines in a worker process.
+    
+    lines: the lines to phrase
+    
+    return: (the phrased lines as one string, the word counts of the batch,
+        the length of each phrased line in bytes)
+    """
+    counts = Counter()
+    out = []
+    for line in lines:
+        sent = worker_op(line.strip().split())
+        counts.update(sent)
+        out.append(f"{' '.join(sent)}\n")
+    return ''.join(out), counts, [len(line.encode('utf-8')) for line in out]
+
+def read_batches(f, batch_size):
+    """
+    Reads a file as lists of at most batch_size lines.
+    """
+    with open(f) as fp:
+        while True:
+            batch = list(islice(fp, batch_size))
+            if not batch:
+                return
+            yield batch
     
-def main(sources, targets, phraseseq):
+def main(sources, targets, phraseseq, n_workers=1, batch_size=10000, cache_dir='data/phrases'):
     """
     Reads from source files to build a phraser.
     Then, for each of the source files, phrases and prints to the appropriate target file.
-    Also saves the wordcounts across all the source files.
+    Also saves the wordcounts across all the source files, and a manifest of
+    each target file (see CorpusUtils.ManifestWriter).
     
     sources: the source files
     targets: the target files to print to. Should be same length as sources
     phraseseq: parameters for the iterative phrasing.
+    n_workers: the number of phrasing processes. With 1, phrase in this process.
+    batch_size: the number of lines sent to a worker at once
+    cache_dir: where the parallel phrase detection caches the text of each round
     
     return: None
     """
     
-    wordcounts = {}
+    wordcounts = Counter()
     
     logging.info("Building multiphraser.")
-    multiphraser = get_multiphraser(sources, phraseseq)
+    with PU.stage('preprocess:multiphraser', rounds=len(phraseseq), workers=n_workers):
+        if n_workers == 1:
+            multiphraser = get_multiphraser(sources, phraseseq)
+        else:
+            multiphraser = get_multiphraser_parallel(sources, phraseseq, n_workers, cache_dir)
     
     logging.info("Phrasing the text")
-    for s,t in zip(sources, targets):
-        with open(t, 'w') as fp:
-            for sent in tqdm(get_sentences([s], op=multiphraser)):
-                for w in sent:
-                    if w in wordcounts:
-                        wordcounts[w] += 1
-                    else:
-                        wordcounts[w] = 1
-                        
-                fp.write(f"{' '.join(sent)}\n")
-    pickle.dump(wordcounts, open('data/counts.pkl', 'wb'))
+    if n_workers == 1:
+        for s,t in zip(sources, targets):
+            manifest = CU.ManifestWriter(t)
+            with PU.stage('preprocess:phrase', unit='tokens', corpus=s.stem) as stage, open(t, 'w') as fp:
+                for sent in tqdm(get_sentences([s], op=multiphraser)):
+                    wordcounts.update(sent)
+                    line = f"{' '.join(sent)}\n"
+                    fp.write(line)
+                    manifest.add(len(line.encode('utf-8')), len(sent))
+                stage.items = manifest.n_tokens
+            manifest.close()
+    else:
+        # batches come back in input order, so the output matches the serial path
+        with Pool(n_workers, initializer=init_worker, initargs=(multiphraser,)) as pool:
+            for s,t in zip(sources, targets):
+                manifest = CU.ManifestWriter(t)
+                with PU.stage('preprocess:phrase', unit='tokens', corpus=s.stem) as stage, open(t, 'w') as fp:
+                    for text, counts, lengths in tqdm(pool.imap(phrase_batch, read_batches(s, batch_size))):
+                        wordcounts.update(counts)
+                        fp.write(text)
+                        manifest.add_lines(lengths, sum(counts.values()))
+                    stage.items = manifest.n_tokens
+                manifest.close()
+    pickle.dump(dict(wordcounts), open('data/counts.pkl', 'wb'))
         
 if __name__ == "__main__":
     """
-    USAGE EXAMPLE: python3 processing.py [corpora/raw/] [corpora/prep/]
+    USAGE EXAMPLE: python3 processing.py [corpora/raw/] [corpora/prep/] [n_workers] [batch_size] [phraseseq]
+    phraseseq is json, e.g. '[[5,100],[5,100]]'
     """
     
     sourcedir = Path(sys.argv[1]).resolve()
     targetdir = Path(sys.argv[2]).resolve()
+    n_workers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    batch_size = int(sys.argv[4]) if len(sys.argv) > 4 else 10000
     sources = list(sorted(sourcedir.glob('*.txt')))
     targets = [targetdir / s.name for s in sources]
     
@@ -114,4 +302,6 @@ if __name__ == "__main__":
     # [(5,100)] will do one round, with min_count=5 and threshold=100, building bigrams
     # [(5,100), (5,100)] will do two rounds, with the same parameters. This will produce trigrams and some 4-grams
     phraseseq = [(5,100)]
-    main(sources, targets, phraseseq)
\ No newline at end of file
+    if len(sys.argv) > 5:
+        phraseseq = [tuple(p) for p in json.loads(sys.argv[5])]
+    main(sources, targets, phraseseq, n_workers=n_workers, batch_size=batch_size)
\ No newline at end of file
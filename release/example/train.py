@@ -1,5 +1,6 @@
 # standard utilities
 import sys
+import time
 from multiprocessing import cpu_count
 import logging
 from pathlib import Path
@@ -21,17 +22,21 @@ opts={'dims':300,
      'n_iter':50
      }
 
-def main(source, target):    
+def main(source, target, corpus_file=False):    
     """
     Main file that trains and saves the Word2Vec model
     
     source: the source file to read from
     target: the target path to save to.
+    corpus_file: let gensim's worker threads read source directly, instead of
+        iterating over it in python. source must be one sentence per line.
     
     return: None
     """
     
-    model = Word2Vec(sentences=FileIter(source),
+    start = time.time()
+    model = Word2Vec(sentences=None if corpus_file else FileIter(source),
+                     corpus_file=str(source) if corpus_file else None,
                      size=opts['dims'],
                      window=opts['window'],
                      workers=opts['n_cpu'],
@@ -43,15 +48,18 @@ def main(source, target):
                      sample=opts['sample'],
                      iter=opts['n_iter']
                     )
+    seconds = time.time() - start
+    logging.info(f"{model.corpus_total_words * opts['n_iter'] / seconds:.0f} words/sec")
     model.save(str(target))
 
 if __name__ == "__main__":
     """
-    USAGE EXAMPLE: python3 train.py [corpora/prep/politics.txt] [models/politics.model];
+    USAGE EXAMPLE: python3 train.py [corpora/prep/politics.txt] [models/politics.model] [corpus_file];
     """
     
     source = Path(sys.argv[1])
     target = Path(sys.argv[2])
+    corpus_file = len(sys.argv) > 3 and sys.argv[3] == 'corpus_file'
     logging.info(f"Training word2vec for {source}")
-    main(source, target)
+    main(source, target, corpus_file=corpus_file)
     logging.info(f"Saved word2vec to {target}")
\ No newline at end of file
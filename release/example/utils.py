@@ -1,3 +1,5 @@
+import io
+
 class FileIter(object):
     """
     Single file iterator.
@@ -44,4 +46,14 @@ def get_sentences(fs, op=None, verbose=False):
             if verbose:
                 fp = tqdm(fp)
             for line in fp:
-                yield op(line.strip().split())
\ No newline at end of file
+                yield op(line.strip().split())
+
+def read_chunk(chunk):
+    """
+    Reads the lines of a byte range from get_chunks, split as open(f) would.
+    """
+    f, start, end = chunk
+    with open(f, 'rb') as fp:
+        fp.seek(start)
+        data = fp.read(end - start)
+    return list(io.TextIOWrapper(io.BytesIO(data), encoding='utf-8'))
@@ -0,0 +1,26 @@
+import multiprocessing
+
+def imap_unordered(fn, jobs, workers):
+    """
+    Runs fn on every job, in this process for a single worker, else in a pool of
+    forked workers, which share what the parent loaded before the fork.
+
+    fn: the function to run, a module-level function for the pool to find
+    jobs: the arguments of each call
+    workers: the number of processes
+
+    return: a generator of the results, in the order they finish. The pool is
+        closed once it is exhausted, and terminated if the caller fails or stops early.
+    """
+    if workers == 1:
+        yield from map(fn, jobs)
+        return
+    pool = multiprocessing.get_context('fork').Pool(workers)
+    try:
+        yield from pool.imap_unordered(fn, jobs)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
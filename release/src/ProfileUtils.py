@@ -0,0 +1,166 @@
+from pathlib import Path
+import cProfile
+import json
+import os
+import resource
+import sys
+import time
+
+# Per-stage instrumentation, off unless enabled through the environment:
+#   PROFILE_LOG=work/profile.jsonl  appends one json record per finished stage
+#   PROFILE_DIR=work/profiles/      also dumps a cProfile of each stage to {stage}.{pid}.{n}.prof
+# A record holds the wall and cpu seconds of the stage, the peak RSS of the process
+# so far, and the items processed per second when the stage counts its items:
+#   {"stage", "pid", "start", "wall", "cpu", "cpu_children", "max_rss_mb", "items", "unit", "per_sec"}
+
+LOG = os.environ.get('PROFILE_LOG')
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+
+# python runs one profiler at a time, so nested stages are profiled by the outermost
+_PROFILING = []
+# the number of profiles this process dumped, to keep repeated stages apart
+_DUMPED = [0]
+
+def _after_fork():
+    """
+    A forked worker inherits the profiler of the stage its parent is in, which
+    would keep the worker from profiling its own stages and is never dumped.
+    """
+    sys.setprofile(None)
+    _PROFILING.clear()
+
+if PROFILE_DIR is not None:
+    os.register_at_fork(after_in_child=_after_fork)
+
+def enabled():
+    return LOG is not None or PROFILE_DIR is not None
+
+class _Disabled():
+    """
+    The stage handed out when instrumentation is off: it records nothing.
+    """
+    items = None
+    unit = None
+
+    def __setattr__(self, name, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_DISABLED = _Disabled()
+
+class Stage():
+    """
+    Measures one stage. Set items (and unit) on it to report a throughput.
+    """
+
+    def __init__(self, name, items=None, unit='items', **info):
+        self.name = name
+        self.items = items
+        self.unit = unit
+        self.info = info
+        self.profile = None
+
+    def __enter__(self):
+        if PROFILE_DIR is not None and not _PROFILING:
+            self.profile = cProfile.Profile()
+            _PROFILING.append(self)
+        self.start = time.time()
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        self.cpu_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        if self.profile is not None:
+            self.profile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self.profile is not None:
+            self.profile.disable()
+            _PROFILING.remove(self)
+        wall = time.perf_counter() - self.wall
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        record = {'stage': self.name,
+                  'pid': os.getpid(),
+                  'start': self.start,
+                  'wall': wall,
+                  'cpu': time.process_time() - self.cpu,
+                  # only counts the child processes that have exited, e.g. a closed pool
+                  'cpu_children': max(0., children.ru_utime + children.ru_stime
+                                      - self.cpu_children.ru_utime - self.cpu_children.ru_stime),
+                  'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10,
+                  'items': self.items,
+                  'unit': self.unit,
+                  'per_sec': None if self.items is None else self.items / max(wall, 1e-9)}
+        record.update(self.info)
+        if exc[0] is not None:
+            record['error'] = exc[0].__name__
+        if LOG is not None:
+            write_record(record)
+        if self.profile is not None:
+            Path(PROFILE_DIR).mkdir(parents=True, exist_ok=True)
+            name = self.name.replace('/', '_').replace(':', '_')
+            self.profile.dump_stats(str(Path(PROFILE_DIR) / f"{name}.{os.getpid()}.{_DUMPED[0]}.prof"))
+            _DUMPED[0] += 1
+        return False
+
+def stage(name, items=None, unit='items', **info):
+    """
+    A context manager that records a stage, or does nothing when instrumentation is off.
+
+    name: the stage name, e.g. 'train:fit'
+    items: the number of items the stage processes, if known up front
+    unit: what the items are, e.g. 'tokens'
+    info: extra fields for the record
+    """
+    if not enabled():
+        return _DISABLED
+    return Stage(name, items=items, unit=unit, **info)
+
+def write_record(record):
+    """
+    Appends a record to PROFILE_LOG. Each record is a single write to a file opened
+    for appending, so processes logging at once do not interleave their lines.
+    """
+    Path(LOG).parent.mkdir(parents=True, exist_ok=True)
+    line = (json.dumps(record) + '\n').encode('utf8')
+    fd = os.open(LOG, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+def read_records(path):
+    with open(path) as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+def summarize(records):
+    """
+    Totals the records of each stage.
+
+    return: [(stage, count, wall, cpu, max_rss_mb, per_sec)], by decreasing wall time
+    """
+    totals = {}
+    for r in records:
+        t = totals.setdefault(r['stage'], {'count': 0, 'wall': 0., 'cpu': 0., 'rss': 0., 'items': 0, 'counted': 0.})
+        t['count'] += 1
+        t['wall'] += r['wall']
+        t['cpu'] += r['cpu'] + r['cpu_children']
+        t['rss'] = max(t['rss'], r['max_rss_mb'])
+        if r['items'] is not None:
+            t['items'] += r['items']
+            t['counted'] += r['wall']
+    res = [(name, t['count'], t['wall'], t['cpu'], t['rss'], t['items'] / t['counted'] if t['counted'] else None)
+           for name, t in totals.items()]
+    return list(sorted(res, key=lambda r: r[2], reverse=True))
+
+if __name__ == "__main__":
+    # ./src/ProfileUtils.py work/profile.jsonl
+    assert(len(sys.argv) == 2)
+    print(f"{'stage':40s} {'runs':>6s} {'wall':>10s} {'cpu':>10s} {'rss MB':>10s} {'items/s':>12s}")
+    for name, count, wall, cpu, rss, per_sec in summarize(read_records(sys.argv[1])):
+        rate = '' if per_sec is None else f"{per_sec:12.0f}"
+        print(f"{name:40s} {count:6d} {wall:10.1f} {cpu:10.1f} {rss:10.0f} {rate:>12s}")
@@ -0,0 +1,69 @@
+import json
+from urllib.request import Request, urlopen
+
+import numpy as np
+
+# A client for serve.py. RemoteAligner answers like AlignUtils.Aligner, so code
+# that translates with a loaded aligner can use the service instead:
+#   client = AlignClient.Client('http://127.0.0.1:8765')
+#   forward = client['politics2the_donald']
+#   guesses, simscores = forward.translate_words(sources)
+
+class Client():
+    def __init__(self, url='http://127.0.0.1:8765', timeout=60):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def get(self, path):
+        with urlopen(self.url + path, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def post(self, path, body):
+        request = Request(self.url + path, data=json.dumps(body).encode('utf8'),
+                          headers={'Content-Type': 'application/json'})
+        with urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def aligners(self):
+        return self.get('/aligners')
+
+    def stats(self):
+        return self.get('/stats')
+
+    def __getitem__(self, name):
+        return RemoteAligner(self, name)
+
+class RemoteAligner():
+    """
+    An aligner held by serve.py. Words outside the source vocabulary get None.
+    """
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def query(self, op, words, k):
+        res = self.client.post(f"/{op}", {'aligner': self.name, 'words': list(words), 'k': k})
+        return res['words'], res['sims']
+
+    def translate_word(self, word, k=1):
+        """
+        STRING -> STRING
+        """
+        decoded = self.translate_words([word], k=k)
+        return decoded[0][:k]
+
+    def translate_words(self, words, k=1):
+        """
+        [STRING] -> [STRING]
+        """
+        decoded, simscores = self.query('translate', words, k)
+        if all(s is not None for s in simscores):
+            simscores = np.array(simscores)
+        return decoded, simscores
+
+    def most_similar(self, words, k=10):
+        """
+        [STRING] -> [STRING], the nearest words of each in the source space
+        """
+        return self.query('most_similar', words, k)
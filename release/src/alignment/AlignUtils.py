@@ -1,7 +1,61 @@
 from abc import ABC
+from pathlib import Path
+import json
+import logging
+import os
+import pickle
+import shutil
+import sys
 import numpy as np
 from sklearn.cross_decomposition import CCA
-from sklearn.metrics.pairwise import cosine_similarity
+import IndexUtils as IU
+from IndexUtils import normalize_rows
+import EmbeddingStore as ES
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import ProfileUtils as PU
+
+# upper bound on the bytes held by one block of query x vocab similarities,
+# with the copy and the int64 indices argpartition makes of them
+DECODE_MEMORY = 2**28
+
+def topk_cosine(queries, targets, k=1, max_memory=DECODE_MEMORY, bias=None):
+    """
+    Finds the k most cosine-similar rows of targets for every row of queries.
+    
+    queries: the query matrix
+    targets: the target matrix, already normalized with normalize_rows
+    k: the number of neighbours to keep
+    max_memory: bytes allowed for one block of the search, see IndexUtils.search_row_bytes
+    bias: if given, subtracted from the similarities to each target before ranking,
+        and included in the returned similarities (see csls_neighbours)
+    
+    return: (indices, similarities), both of shape (len(queries), k), most similar first
+    """
+    n_targets = targets.shape[0]
+    k = max(0, min(k, n_targets))
+    dtype = np.result_type(queries.dtype, targets.dtype)
+    if k == 0:
+        return np.empty((queries.shape[0], 0), dtype=np.int64), np.empty((queries.shape[0], 0), dtype=dtype)
+    queries = normalize_rows(queries)
+    block_size = max(1, int(max_memory // IU.search_row_bytes(n_targets, dtype)))
+    
+    indices = np.empty((queries.shape[0], k), dtype=np.int64)
+    topsims = np.empty((queries.shape[0], k), dtype=dtype)
+    for start in range(0, queries.shape[0], block_size):
+        block = queries[start:start + block_size]
+        similarities = np.matmul(block, targets.T)
+        if bias is not None:
+            similarities -= bias
+        if k < n_targets:
+            candidates = np.argpartition(similarities, n_targets - k, axis=1)[:, n_targets - k:]
+        else:
+            candidates = np.broadcast_to(np.arange(n_targets), similarities.shape)
+        candsims = np.take_along_axis(similarities, candidates, axis=1)
+        order = np.argsort(candsims, axis=1)[:, ::-1]
+        indices[start:start + block_size] = np.take_along_axis(candidates, order, axis=1)
+        topsims[start:start + block_size] = np.take_along_axis(candsims, order, axis=1)
+    return indices, topsims
 
 def align_svd(source, target):
     product = np.matmul(source.transpose(), target)
@@ -9,6 +63,68 @@ def align_svd(source, target):
     T = np.matmul(U,V)
     return T
 
+def align_svd_sweep(source, target, ks):
+    """
+    align_svd on the prefixes source[:k], target[:k] for every k in ks. The
+    cross-covariance of each prefix adds only the rows since the previous k to
+    the last one, so all the maps cost one pass over the rows and one SVD per k.
+    
+    return: a generator of (k, T), by increasing k
+    """
+    ks = sorted(set(ks))
+    if ks and ks[0] < 1:
+        raise ValueError(f"align_svd_sweep needs prefixes of at least one row, got ks={ks}")
+    product = np.zeros((source.shape[1], target.shape[1]), dtype=np.result_type(source.dtype, target.dtype))
+    done = 0
+    for k in ks:
+        product += np.matmul(source[done:k].transpose(), target[done:k])
+        done = k
+        U, s, V = np.linalg.svd(product)
+        yield k, np.matmul(U, V)
+
+def csls_neighbours(source, target, csls_k=10, max_memory=DECODE_MEMORY):
+    """
+    The mutual nearest neighbours of two normalized matrices under CSLS,
+    2 cos(x, y) - r(x) - r(y), where r is a row's mean similarity to its csls_k
+    nearest rows of the other matrix. r(x) does not change the ranking of x's
+    neighbours, so each direction is one blocked top-1 search biased by r(y) / 2.
+    
+    return: (source rows, target rows, CSLS scores) of the mutual pairs
+    """
+    if csls_k < 1:
+        raise ValueError(f"csls_neighbours needs at least one neighbour, got csls_k={csls_k}")
+    r_source = topk_cosine(source, target, k=csls_k, max_memory=max_memory)[1].mean(axis=1)
+    r_target = topk_cosine(target, source, k=csls_k, max_memory=max_memory)[1].mean(axis=1)
+    forward, scores = topk_cosine(source, target, k=1, max_memory=max_memory, bias=r_target / 2)
+    backward, _ = topk_cosine(target, source, k=1, max_memory=max_memory, bias=r_source / 2)
+    forward = forward[:, 0]
+    rows = np.flatnonzero(backward[forward, 0] == np.arange(len(source)))
+    return rows, forward[rows], 2 * scores[rows, 0] - r_source[rows]
+
+def refine_svd(source, target, T, n_iter=5, csls_k=10, max_memory=DECODE_MEMORY):
+    """
+    Self-learning: maps source with T, takes the mutual CSLS nearest neighbours as
+    the new dictionary and refits align_svd on it, until the dictionary is stable.
+    
+    source: the source matrix
+    target: the target matrix
+    T: the initial map, e.g. align_svd on frequent shared words
+    
+    return: (T, source rows, target rows) of the last dictionary
+    """
+    if n_iter < 1:
+        raise ValueError(f"refine_svd needs at least one round, got n_iter={n_iter}")
+    normB = normalize_rows(np.asarray(target, dtype=np.float32))
+    rows_a = rows_b = None
+    for _ in range(n_iter):
+        mapped = normalize_rows(np.matmul(source, T).astype(np.float32))
+        new_a, new_b, _ = csls_neighbours(mapped, normB, csls_k=csls_k, max_memory=max_memory)
+        if rows_a is not None and np.array_equal(new_a, rows_a) and np.array_equal(new_b, rows_b):
+            break
+        rows_a, rows_b = new_a, new_b
+        T = align_svd(source[rows_a], target[rows_b])
+    return T, rows_a, rows_b
+
 def align_lstsq(source, target):
     T = np.linalg.lstsq(source, target, rcond=None)
     return T
@@ -19,6 +135,27 @@ def align_cca(source, target):
     cca.fit(source, target)
     return cca
 
+def align_joint(sources, n_iter=20, tol=1e-6):
+    """
+    Generalized Procrustes: one orthogonal map per community into a common space,
+    fitted to the mean of the mapped anchor matrices.
+
+    sources: the anchor matrices of the communities, with the same rows in the same order
+
+    return: [T], sources[i].dot(T[i]) is community i in the common space
+    """
+    if n_iter < 1:
+        raise ValueError(f"align_joint needs at least one iteration, got n_iter={n_iter}")
+    mean = np.asarray(sources[0], dtype=np.float64)
+    for _ in range(n_iter):
+        transforms = [align_svd(source, mean) for source in sources]
+        update = np.mean([np.matmul(source, T) for source, T in zip(sources, transforms)], axis=0)
+        change = np.linalg.norm(update - mean) / max(np.linalg.norm(mean), 1e-12)
+        mean = update
+        if change < tol:
+            break
+    return transforms
+
 class Aligner(ABC):
     def __init__(self, method, source, target, w2id, id2w, mtxA, mtxB, trainvoc):
         self.method = method
@@ -29,6 +166,56 @@ class Aligner(ABC):
         self.mtxA = mtxA
         self.mtxB = mtxB
         self.anchors = trainvoc
+        self.store = None
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_normB', None)
+        state.pop('_proj', None)
+        state.pop('_index', None)
+        state.pop('_quant', None)
+        if state.get('store') is not None:
+            # rebuilt from the embedding store when unpickled
+            for key in ['w2idA', 'id2wB', 'mtxA', 'mtxB']:
+                state.pop(key, None)
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if state.get('store') is not None:
+            self.bind_store(ES.EmbeddingStore(state['store']), *state['names'])
+    
+    def bind_store(self, store, name_a, name_b):
+        """
+        Takes the vocabularies and matrices from the embeddings of communities
+        name_a and name_b in store, instead of holding copies of them. The
+        unit-length targets are those of name_b, shared by every aligner into it.
+        The gensim models are dropped.
+        """
+        embA = store.get(name_a)
+        embB = store.get(name_b)
+        self.store = str(store.root)
+        self.names = (name_a, name_b)
+        self.src = None
+        self.tgt = None
+        self.w2idA = embA.w2id
+        self.id2wB = embB.id2w
+        self.mtxA = embA.vectors
+        self.mtxB = embB.vectors
+        self._normB = embB.unit_vectors
+        self._proj = None
+    
+    def source_space(self):
+        """
+        -> MTX, the rows that encode_input looks words up in
+        """
+        return self.mtxA
+    
+    def target_space(self):
+        """
+        -> MTX, the rows that decode_output searches
+        """
+        return self.mtxB
         
     def translate_mtx(self, mtx):
         """
@@ -40,41 +227,118 @@ class Aligner(ABC):
         """
         [STRING] -> MTX
         """
-        embs = [self.mtxA[self.w2idA[w], :] for w in words]
+        mtx = self.source_space()
+        embs = [mtx[self.w2idA[w], :] for w in words]
         return np.vstack(embs)
     
-    def decode_output(self, mtx, k=1):
+    def target_matrix(self, dtype=np.float32):
+        """
+        DTYPE -> MTX, the unit-length rows of target_space
+        """
+        normB = getattr(self, '_normB', None)
+        if normB is None or normB.dtype != dtype:
+            normB = normalize_rows(self.target_space().astype(dtype))
+            self._normB = normB
+        return normB
+    
+    def build_index(self, n_lists=None, n_iter=10, seed=0):
+        """
+        Builds an approximate nearest-neighbour index over target_space.
+        """
+        self._index = IU.IVFIndex.build(self.target_matrix(), n_lists=n_lists, n_iter=n_iter, seed=seed)
+        return self._index
+    
+    def save_index(self, path):
+        self._index.save(path)
+    
+    def quantize(self, dtype='int8', rerank=IU.DEFAULT_RERANK, path=None):
+        """
+        Quantizes target_space for searches with quantized=True, see IndexUtils.QuantizedMatrix.
+        With path, the result is saved there and its float32 rows are memory-mapped.
+        This only saves memory for aligners that do not hold mtxB themselves, compact
+        or store-bound aligners loaded with load_aligner next to their .quant files;
+        a pickled aligner keeps mtxB in memory whatever its quantized targets.
+        """
+        self._quant = IU.QuantizedMatrix.build(self.target_space(), dtype=dtype, rerank=rerank, path=path)
+        return self._quant
+    
+    def save_quantized(self, path):
+        self._quant.save(path)
+    
+    def load_quantized(self, path, rerank=IU.DEFAULT_RERANK):
+        quant = IU.QuantizedMatrix.load(path, rerank=rerank)
+        assert(quant.n_vectors == len(self.id2wB))
+        self._quant = quant
+        return quant
+    
+    def load_index(self, path):
+        index = IU.IVFIndex.load(path)
+        assert(index.n_vectors == len(self.id2wB))
+        self._index = index
+        return index
+    
+    def search(self, mtx, k=1, max_memory=DECODE_MEMORY, approximate=False, n_probe=IU.DEFAULT_PROBE,
+               quantized=False):
+        """
+        MTX -> (IDS, SIMS)
+        """
+        if quantized:
+            if approximate:
+                raise ValueError("a search is either approximate or quantized, not both")
+            quant = getattr(self, '_quant', None)
+            if quant is None:
+                raise ValueError("quantized search needs quantized targets, see quantize and load_quantized")
+            return quant.search(mtx, k=k, max_memory=max_memory)
+        # the queries take the dtype of the targets, so that the targets are never copied
+        dtype = np.result_type(self.target_space().dtype, np.float32)
+        mtx = np.asarray(mtx, dtype=dtype)
+        if approximate:
+            index = getattr(self, '_index', None)
+            if index is None:
+                raise ValueError("approximate search needs an index, see build_index and load_index")
+            return index.search(mtx, self.target_matrix(dtype), k=k, n_probe=n_probe)
+        return topk_cosine(mtx, self.target_matrix(dtype), k=k, max_memory=max_memory)
+    
+    def decode_output(self, mtx, k=1, max_memory=DECODE_MEMORY, approximate=False, n_probe=IU.DEFAULT_PROBE,
+                      quantized=False):
         """
         MTX -> [[STRING]]
         """
-        similarities = cosine_similarity(mtx, self.mtxB)
-        most_similar = np.argsort(similarities, axis=1)[:, ::-1]
-        topsims = np.sort(similarities, axis=1)[:, ::-1][:, :k]
-        res = [[self.id2wB[i] for i in row[:k]] for row in most_similar]
+        most_similar, topsims = self.search(mtx, k=k, max_memory=max_memory,
+                                            approximate=approximate, n_probe=n_probe, quantized=quantized)
+        res = [[self.id2wB[i] if i >= 0 else None for i in row] for row in most_similar]
         return res, topsims
     
-    def translate_word(self, word, k=1):
+    def translate_word(self, word, k=1, max_memory=DECODE_MEMORY, approximate=False, n_probe=IU.DEFAULT_PROBE,
+                       quantized=False):
         """
         STRING -> STRING
         """
         encoding = self.encode_input([word])
         translated = self.translate_mtx(encoding)
-        decoded = self.decode_output(translated, k=k)
+        decoded = self.decode_output(translated, k=k, max_memory=max_memory, approximate=approximate,
+                                     n_probe=n_probe, quantized=quantized)
         return decoded[0][:k]
     
-    def translate_words(self, words, k=1):
+    def translate_words(self, words, k=1, max_memory=DECODE_MEMORY, approximate=False, n_probe=IU.DEFAULT_PROBE,
+                        quantized=False):
         """
         [STRING] -> [STRING]
         """
-        encoding = self.encode_input(words)
-        translated = self.translate_mtx(encoding)
-        decoded, simscores = self.decode_output(translated, k=k)
+        with PU.stage('translate_words', items=len(words), unit='queries', method=self.method):
+            encoding = self.encode_input(words)
+            translated = self.translate_mtx(encoding)
+            decoded, simscores = self.decode_output(translated, k=k, max_memory=max_memory, approximate=approximate,
+                                                    n_probe=n_probe, quantized=quantized)
         return decoded, simscores
 
 class SVDAligner(Aligner):
     def set_params(self, T):
         self.T = T
 
+    def get_params(self):
+        return {'T': self.T}
+
     def translate_mtx(self, mtx):
         return mtx.dot(self.T)
     
@@ -82,111 +346,387 @@ class LSTSQAligner(Aligner):
     def set_params(self, T):
         self.T = T
 
+    def get_params(self):
+        return {'T': self.T}
+
     def translate_mtx(self, mtx):
         return mtx.dot(self.T)
     
+class CCAProjection():
+    """
+    The transform of a fitted sklearn CCA, without the rest of the estimator.
+    """
+
+    names = ['x_mean', 'x_std', 'x_rotations', 'y_mean', 'y_std', 'y_rotations']
+
+    def __init__(self, x_mean, x_std, x_rotations, y_mean, y_std, y_rotations):
+        self.x_mean = x_mean
+        self.x_std = x_std
+        self.x_rotations = x_rotations
+        self.y_mean = y_mean
+        self.y_std = y_std
+        self.y_rotations = y_rotations
+
+    @classmethod
+    def from_cca(cls, cca):
+        # the centering parameters lost their trailing underscore in sklearn 1.1
+        def param(name):
+            if hasattr(cca, f"_{name}"):
+                return getattr(cca, f"_{name}")
+            return getattr(cca, f"{name}_")
+        return cls(param('x_mean'), param('x_std'), cca.x_rotations_,
+                   param('y_mean'), param('y_std'), cca.y_rotations_)
+
+    def get_params(self):
+        return {name: getattr(self, name) for name in self.names}
+
+    def transform_x(self, X):
+        X = np.array(X, dtype=np.result_type(X.dtype, np.float32))
+        X -= self.x_mean
+        X /= self.x_std
+        return np.matmul(X, self.x_rotations)
+
+    def transform_y(self, Y):
+        Y = np.array(Y, dtype=np.result_type(Y.dtype, np.float32))
+        Y -= self.y_mean
+        Y /= self.y_std
+        return np.matmul(Y, self.y_rotations)
+
+    def transform(self, X, Y):
+        return self.transform_x(X), self.transform_y(Y)
+
 class CCAAligner(Aligner):
     def set_params(self, cca):
         self.cca = cca
+        self._proj = None
+        self._normB = None
+        self._index = None
+        self._quant = None
+
+    def get_params(self):
+        if isinstance(self.cca, CCAProjection):
+            return self.cca.get_params()
+        return CCAProjection.from_cca(self.cca).get_params()
+
+    def bind_store(self, store, name_a, name_b):
+        super().bind_store(store, name_a, name_b)
+        # the targets are searched in this pair's projection, not in name_b's own space
+        self._normB = None
+
+    def projection(self):
+        """
+        -> CCAProjection, the transform of the fitted CCA
+        """
+        if isinstance(self.cca, CCAProjection):
+            return self.cca
+        return CCAProjection.from_cca(self.cca)
+
+    def projected(self, side):
+        """
+        The source (0) or target (1) matrix in the shared CCA space. Each side is
+        projected when first needed, so searching quantized targets never projects mtxB.
+        """
+        if getattr(self, '_proj', None) is None:
+            self._proj = [None, None]
+        if self._proj[side] is None:
+            cca = self.projection()
+            mtx = cca.transform_x(self.mtxA) if side == 0 else cca.transform_y(self.mtxB)
+            mtx.setflags(write=False)
+            self._proj[side] = mtx
+        return self._proj[side]
+
+    def projections(self):
+        """
+        -> (MTX, MTX), the source and target matrices in the shared CCA space
+        """
+        return self.projected(0), self.projected(1)
+
+    def source_space(self):
+        return self.projected(0)
+
+    def target_space(self):
+        return self.projected(1)
 
     def translate_mtx(self, mtx):
         return mtx
-    
-    def translate_word(self, word, k=1):
-        tmpA = self.mtxA
-        tmpB = self.mtxB
-        self.mtxA, self.mtxB = self.cca.transform(tmpA, tmpB)
-        res = super().translate_word(word, k=k)
-        self.mtxA = tmpA
-        self.mtxB = tmpB
-        return res
-    
-    def translate_words(self, words, k=1):
-        tmpA = self.mtxA
-        tmpB = self.mtxB
-        self.mtxA, self.mtxB = self.cca.transform(tmpA, tmpB)
-        res, simscores = super().translate_words(words, k=k)
-        self.mtxA = tmpA
-        self.mtxB = tmpB
-        return res, simscores
         
+def index_path(aligner_path):
+    """
+    The file an aligner's index is persisted to, next to the aligner pickle.
+    """
+    return Path(aligner_path).with_suffix('.ivf.npz')
+
+def quantized_path(aligner_path):
+    """
+    The directory an aligner's quantized targets are persisted to, next to the aligner.
+    """
+    return Path(aligner_path).with_suffix('.quant')
+
+def save_compact(aligner, path):
+    """
+    Writes an aligner to the directory path as .npy arrays and a json header.
+    The gensim models are not saved, and the matrices are stored as float32,
+    unless the aligner is bound to an embedding store.
+    meta.json is written last, so a directory without it is incomplete.
+    
+    aligner: the aligner to save
+    path: the directory to write to. It is replaced if it exists.
+    
+    return: None
+    """
+    path = Path(path)
+    tmp = path.with_name(path.name + '.tmp')
+    if tmp.exists():
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    meta = {'class': type(aligner).__name__, 'method': aligner.method}
+    
+    if getattr(aligner, 'store', None) is not None:
+        # the matrices already live in the embedding store
+        meta['store'] = aligner.store
+        meta['names'] = list(aligner.names)
+    else:
+        vocabA = np.empty(len(aligner.w2idA), dtype=object)
+        for w, i in aligner.w2idA.items():
+            vocabA[i] = w
+        vocabB = np.array([aligner.id2wB[i] for i in range(len(aligner.id2wB))])
+        np.save(tmp / 'vocabA.npy', vocabA.astype(str))
+        np.save(tmp / 'vocabB.npy', vocabB.astype(str))
+        np.save(tmp / 'mtxA.npy', np.asarray(aligner.mtxA, dtype=np.float32))
+        np.save(tmp / 'mtxB.npy', np.asarray(aligner.mtxB, dtype=np.float32))
+    np.save(tmp / 'anchors.npy', np.array(aligner.anchors).astype(str))
+    with open(tmp / 'params.npz', 'wb') as fp:
+        np.savez(fp, **aligner.get_params())
+    with open(tmp / 'meta.json', 'w') as fp:
+        json.dump(meta, fp)
+    
+    if path.exists():
+        shutil.rmtree(path)
+    os.replace(tmp, path)
+
+def load_compact(path, mmap_mode='r'):
+    """
+    Reads an aligner written by save_compact. The matrices are memory-mapped.
+    """
+    path = Path(path)
+    with open(path / 'meta.json') as fp:
+        meta = json.load(fp)
+    cls = {'SVDAligner': SVDAligner, 'LSTSQAligner': LSTSQAligner, 'CCAAligner': CCAAligner}[meta['class']]
+    anchors = np.load(path / 'anchors.npy').tolist()
+    
+    if 'store' in meta:
+        aligner = cls(meta['method'], None, None, None, None, None, None, anchors)
+        aligner.bind_store(ES.EmbeddingStore(meta['store']), *meta['names'])
+    else:
+        vocabA = np.load(path / 'vocabA.npy').tolist()
+        vocabB = np.load(path / 'vocabB.npy').tolist()
+        w2idA = {w:i for i,w in enumerate(vocabA)}
+        id2wB = dict(enumerate(vocabB))
+        mtxA = np.load(path / 'mtxA.npy', mmap_mode=mmap_mode)
+        mtxB = np.load(path / 'mtxB.npy', mmap_mode=mmap_mode)
+        aligner = cls(meta['method'], None, None, w2idA, id2wB, mtxA, mtxB, anchors)
+    params = np.load(path / 'params.npz')
+    if cls is CCAAligner:
+        aligner.set_params(CCAProjection(*[params[name] for name in CCAProjection.names]))
+    else:
+        aligner.set_params(params['T'])
+    return aligner
+
+def list_aligners(directory):
+    """
+    The pickled ({a}2{b}.pkl) and compact ({a}2{b}/) aligners in a directory.
+    """
+    res = []
+    for path in sorted(Path(directory).iterdir()):
+        if path.suffix == '.pkl' or (path.is_dir() and (path / 'meta.json').exists()):
+            res.append(path)
+    return res
+
+def written(path):
+    """
+    When an aligner or a file persisted next to it was written. Directories are
+    written last by their json header.
+    """
+    path = Path(path)
+    if path.is_dir():
+        return max((p.stat().st_mtime for p in path.glob('*.json')), default=0)
+    return path.stat().st_mtime
+
+def load_aligner(path):
+    """
+    Loads a pickled or compact aligner, attaching its persisted index and
+    quantized targets if there are any. Those older than the aligner were built
+    for a previous transform, and are ignored.
+    """
+    if Path(path).is_dir():
+        aligner = load_compact(path)
+    else:
+        with open(path, 'rb') as fp:
+            aligner = pickle.load(fp)
+    for sidecar, attach in [(index_path(path), aligner.load_index),
+                            (quantized_path(path), aligner.load_quantized)]:
+        if not sidecar.exists():
+            continue
+        if written(sidecar) < written(path):
+            logging.warning(f"Ignoring {sidecar.name}, which is older than {Path(path).name}")
+            continue
+        attach(sidecar)
+    return aligner
+
+def as_embedding(model):
+    """
+    Wraps a gensim model in an EmbeddingStore.Embedding; embeddings are returned as they are.
+    """
+    if isinstance(model, ES.Embedding):
+        return model
+    return ES.Embedding.from_model(None, model)
+
+def get_anchor_matrices(emb_a, emb_b, anchorlist):
+    """
+    The rows of the anchor words in both embeddings, in anchorlist order.
+    """
+    anchors = np.array(anchorlist)
+    return emb_a.vectors[emb_a.indices(anchors)], emb_b.vectors[emb_b.indices(anchors)]
+
 def get_svd_aligner(model_a, model_b, shared, anchorlist):
-    # get wordmaps
-    w2id = {w:i for i,w in enumerate(shared)}
-    id2w = {i:w for i,w in enumerate(shared)}
-    awords = list(sorted(list(model_a.wv.vocab)))
-    bwords = list(sorted(list(model_b.wv.vocab)))
-    w2idA = {w:i for i,w in enumerate(awords)}
-    id2wA = {i:w for i,w in enumerate(awords)}
-    w2idB = {w:i for i,w in enumerate(bwords)}
-    id2wB = {i:w for i,w in enumerate(bwords)}
-    
-    # build the base matrices
-    a_mtx = np.vstack([model_a.wv[w] for w in awords])
-    b_mtx = np.vstack([model_b.wv[w] for w in bwords])
-    
-    # get the anchors
-    a_anchor = np.vstack([a_mtx[w2idA[w], :] for w in anchorlist])
-    b_anchor = np.vstack([b_mtx[w2idB[w], :] for w in anchorlist])
+    emb_a = as_embedding(model_a)
+    emb_b = as_embedding(model_b)
     
     # get the translation matrix
-    T = align_svd(a_anchor, b_anchor)
+    with PU.stage('align:anchors', items=len(anchorlist), unit='anchors'):
+        a_anchor, b_anchor = get_anchor_matrices(emb_a, emb_b, anchorlist)
+    with PU.stage('align:fit', items=len(anchorlist), unit='anchors', method='svd'):
+        T = align_svd(a_anchor, b_anchor)
     
     # build and return the aligner
-    aligner = SVDAligner('svd', model_a, model_b, w2idA, id2wB, a_mtx, b_mtx, anchorlist)
+    aligner = SVDAligner('svd', model_a, model_b, emb_a.w2id, emb_b.id2w, emb_a.vectors, emb_b.vectors, anchorlist)
     aligner.set_params(T)
     return aligner
 
+def get_refined_svd_aligner(model_a, model_b, shared, anchorlist, n_iter=5, csls_k=10):
+    """
+    An SVD aligner fitted on anchorlist, then refined with refine_svd. Its anchors
+    are the (source word, target word) pairs of the final dictionary.
+    """
+    emb_a = as_embedding(model_a)
+    emb_b = as_embedding(model_b)
+    
+    with PU.stage('align:anchors', items=len(anchorlist), unit='anchors'):
+        a_anchor, b_anchor = get_anchor_matrices(emb_a, emb_b, anchorlist)
+    with PU.stage('align:refine', items=n_iter, unit='rounds', method='svd'):
+        T = align_svd(a_anchor, b_anchor)
+        T, rows_a, rows_b = refine_svd(np.asarray(emb_a.vectors), np.asarray(emb_b.vectors), T,
+                                       n_iter=n_iter, csls_k=csls_k)
+    pairs = list(zip(emb_a.words[rows_a].tolist(), emb_b.words[rows_b].tolist()))
+    
+    aligner = SVDAligner('svd', model_a, model_b, emb_a.w2id, emb_b.id2w, emb_a.vectors, emb_b.vectors, pairs)
+    aligner.set_params(T)
+    return aligner
+
+def get_svd_sweep_aligners(model_a, model_b, shared, anchorlist, ks):
+    """
+    The SVD aligner of every prefix anchorlist[:k] of a frequency-ranked anchor list,
+    fitted with align_svd_sweep.
+    
+    return: a generator of (k, aligner), by increasing k
+    """
+    emb_a = as_embedding(model_a)
+    emb_b = as_embedding(model_b)
+    
+    with PU.stage('align:anchors', items=len(anchorlist), unit='anchors'):
+        a_anchor, b_anchor = get_anchor_matrices(emb_a, emb_b, anchorlist)
+    for k, T in align_svd_sweep(a_anchor, b_anchor, [min(k, len(anchorlist)) for k in ks]):
+        aligner = SVDAligner('svd', model_a, model_b, emb_a.w2id, emb_b.id2w, emb_a.vectors, emb_b.vectors,
+                             anchorlist[:k])
+        aligner.set_params(T)
+        yield k, aligner
+
 def get_lstsq_aligner(model_a, model_b, shared, anchorlist):
-    # get wordmaps
-    w2id = {w:i for i,w in enumerate(shared)}
-    id2w = {i:w for i,w in enumerate(shared)}
-    awords = list(sorted(list(model_a.wv.vocab)))
-    bwords = list(sorted(list(model_b.wv.vocab)))
-    w2idA = {w:i for i,w in enumerate(awords)}
-    id2wA = {i:w for i,w in enumerate(awords)}
-    w2idB = {w:i for i,w in enumerate(bwords)}
-    id2wB = {i:w for i,w in enumerate(bwords)}
-    
-    # build the base matrices
-    a_mtx = np.vstack([model_a.wv[w] for w in awords])
-    b_mtx = np.vstack([model_b.wv[w] for w in bwords])
-    
-    # get the anchors
-    a_anchor = np.vstack([a_mtx[w2idA[w], :] for w in anchorlist])
-    b_anchor = np.vstack([b_mtx[w2idB[w], :] for w in anchorlist])
+    emb_a = as_embedding(model_a)
+    emb_b = as_embedding(model_b)
     
     # get the translation matrix
-    T = align_lstsq(a_anchor, b_anchor)
+    with PU.stage('align:anchors', items=len(anchorlist), unit='anchors'):
+        a_anchor, b_anchor = get_anchor_matrices(emb_a, emb_b, anchorlist)
+    with PU.stage('align:fit', items=len(anchorlist), unit='anchors', method='lstsq'):
+        T = align_lstsq(a_anchor, b_anchor)[0]
     
     # build and return the aligner
-    aligner = LSTSQAligner('svd', model_a, model_b, w2idA, id2wB, a_mtx, b_mtx, anchorlist)
+    aligner = LSTSQAligner('lstsq', model_a, model_b, emb_a.w2id, emb_b.id2w, emb_a.vectors, emb_b.vectors, anchorlist)
     aligner.set_params(T)
     return aligner
 
 def get_cca_aligner(model_a, model_b, shared, anchorlist):
-    # get wordmaps
-    w2id = {w:i for i,w in enumerate(shared)}
-    id2w = {i:w for i,w in enumerate(shared)}
-    awords = list(sorted(list(model_a.wv.vocab)))
-    bwords = list(sorted(list(model_b.wv.vocab)))
-    w2idA = {w:i for i,w in enumerate(awords)}
-    id2wA = {i:w for i,w in enumerate(awords)}
-    w2idB = {w:i for i,w in enumerate(bwords)}
-    id2wB = {i:w for i,w in enumerate(bwords)}
-    
-    # build the base matrices
-    a_mtx = np.vstack([model_a.wv[w] for w in awords])
-    b_mtx = np.vstack([model_b.wv[w] for w in bwords])
-    
-    # get the anchors
-    a_anchor = np.vstack([a_mtx[w2idA[w], :] for w in anchorlist])
-    b_anchor = np.vstack([b_mtx[w2idB[w], :] for w in anchorlist])
+    emb_a = as_embedding(model_a)
+    emb_b = as_embedding(model_b)
     
     # compute CCA
-    cca = align_cca(a_anchor, b_anchor)
+    with PU.stage('align:anchors', items=len(anchorlist), unit='anchors'):
+        a_anchor, b_anchor = get_anchor_matrices(emb_a, emb_b, anchorlist)
+    with PU.stage('align:fit', items=len(anchorlist), unit='anchors', method='cca'):
+        cca = align_cca(a_anchor, b_anchor)
     
     # build and return the aligner
-    aligner = CCAAligner('cca', model_a, model_b, w2idA, id2wB, a_mtx, b_mtx, anchorlist)
+    aligner = CCAAligner('cca', model_a, model_b, emb_a.w2id, emb_b.id2w, emb_a.vectors, emb_b.vectors, anchorlist)
     aligner.set_params(cca)
-    return aligner
\ No newline at end of file
+    return aligner
+
+class JointAlignment():
+    """
+    The orthogonal maps of several communities into one common space, fitted jointly
+    by align_joint. Any pair a -> b translates by T[a] T[b]^T, so N maps stand in for
+    the N(N-1) pairwise aligners.
+    """
+
+    def __init__(self, names, transforms, anchors):
+        """
+        names: the community names
+        transforms: transforms[i] maps community names[i] into the common space
+        anchors: the words the maps were fitted on
+        """
+        self.names = list(names)
+        self.transforms = {name: T for name, T in zip(self.names, transforms)}
+        self.anchors = list(anchors)
+
+    @classmethod
+    def fit(cls, embeddings, anchorlist, n_iter=20):
+        """
+        embeddings: {name: EmbeddingStore.Embedding}, sharing every word of anchorlist
+        """
+        names = list(sorted(embeddings))
+        anchors = np.array(anchorlist)
+        sources = [embeddings[n].vectors[embeddings[n].indices(anchors)] for n in names]
+        return cls(names, align_joint(sources, n_iter=n_iter), anchorlist)
+
+    def get_params(self, name_a, name_b):
+        return {'T': np.matmul(self.transforms[name_a], self.transforms[name_b].transpose())}
+
+    def get_aligner(self, name_a, name_b, emb_a=None, emb_b=None, store=None):
+        """
+        The SVDAligner of the pair, over the given embeddings or those in store.
+        """
+        if store is not None:
+            aligner = SVDAligner('joint', None, None, None, None, None, None, self.anchors)
+            aligner.bind_store(store, name_a, name_b)
+        else:
+            aligner = SVDAligner('joint', None, None, emb_a.w2id, emb_b.id2w, emb_a.vectors, emb_b.vectors, self.anchors)
+        aligner.set_params(**self.get_params(name_a, name_b))
+        return aligner
+
+    def save(self, path):
+        tmp = Path(path).with_name(Path(path).name + '.tmp')
+        with open(tmp, 'wb') as fp:
+            np.savez(fp, names=np.array(self.names).astype(str), anchors=np.array(self.anchors).astype(str),
+                     transforms=np.stack([self.transforms[n] for n in self.names]))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        params = np.load(path)
+        return cls(params['names'].tolist(), list(params['transforms']), params['anchors'].tolist())
+
+def get_joint_aligner(path, name_a, name_b, store):
+    """
+    The aligner of a pair from a joint alignment saved at path, over the embeddings in store.
+    """
+    return JointAlignment.load(path).get_aligner(name_a, name_b, store=store)
@@ -0,0 +1,144 @@
+from pathlib import Path
+import os
+import numpy as np
+from IndexUtils import normalize_rows
+
+# embeddings opened by this process, shared by every store and aligner in it
+_OPEN = {}
+
+class Embedding():
+    """
+    The sorted vocabulary of one community and a float32 row per word.
+    """
+
+    def __init__(self, name, words, vectors):
+        """
+        name: the community name
+        words: the vocabulary, sorted
+        vectors: the matrix of embeddings, one row per word
+        """
+        self.name = name
+        self.words = words
+        self.vectors = vectors
+        self._w2id = None
+        self._id2w = None
+        self._unit = None
+
+    @property
+    def w2id(self):
+        if self._w2id is None:
+            self._w2id = {w:i for i,w in enumerate(self.words.tolist())}
+        return self._w2id
+
+    @property
+    def id2w(self):
+        if self._id2w is None:
+            self._id2w = dict(enumerate(self.words.tolist()))
+        return self._id2w
+
+    @property
+    def unit_vectors(self):
+        """
+        The float32 rows scaled to unit length, which every aligner into this
+        community searches. Opened from the store when it holds them, else
+        normalized once and kept.
+        """
+        if self._unit is None:
+            self._unit = normalize_rows(np.asarray(self.vectors, dtype=np.float32))
+        return self._unit
+
+    def indices(self, words):
+        """
+        The row of each of words, found by binary search in the sorted vocabulary.
+        """
+        idx = np.searchsorted(self.words, words)
+        idx[idx == len(self.words)] = 0
+        missing = self.words[idx] != words
+        if np.any(missing):
+            raise KeyError(str(np.asarray(words)[missing][0]))
+        return idx
+
+    @classmethod
+    def from_model(cls, name, model):
+        """
+        Builds the embedding of a gensim Word2Vec model, gathering its rows in one pass.
+        """
+        vocab = model.wv.vocab
+        words = np.array(sorted(vocab))
+        rows = np.fromiter((vocab[w].index for w in words.tolist()), dtype=np.int64, count=len(words))
+        vectors = np.asarray(model.wv.vectors)[rows].astype(np.float32, copy=False)
+        return cls(name, words, vectors)
+
+class EmbeddingStore():
+    """
+    A directory of community embeddings, {name}.vocab.npy and {name}.npy, and the
+    unit-length rows of each in {name}.unit.npy.
+
+    The matrices are memory-mapped read-only, so processes that open the same
+    community share its pages, and an aligner only needs to hold the community
+    names to rebuild its matrices.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def vocab_path(self, name):
+        return self.root / f"{name}.vocab.npy"
+
+    def matrix_path(self, name):
+        return self.root / f"{name}.npy"
+
+    def unit_path(self, name):
+        return self.root / f"{name}.unit.npy"
+
+    def names(self):
+        return list(sorted(p.name[:-len('.vocab.npy')] for p in self.root.glob("*.vocab.npy")))
+
+    def has(self, name):
+        return self.vocab_path(name).exists() and self.matrix_path(name).exists()
+
+    def has_unit(self, name):
+        """
+        Whether the unit-length rows of a community were written after its matrix.
+        """
+        unit = self.unit_path(name)
+        return unit.exists() and unit.stat().st_mtime >= self.matrix_path(name).stat().st_mtime
+
+    def _write(self, path, array):
+        tmp = path.with_name(path.name + '.tmp')
+        with open(tmp, 'wb') as fp:
+            np.save(fp, array)
+        os.replace(tmp, path)
+
+    def save(self, embedding):
+        """
+        Writes an embedding to the store. The vocabulary, the matrix and its unit-length
+        rows are written in that order, each moved into place once complete.
+        """
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        self._write(self.vocab_path(embedding.name), embedding.words.astype(str))
+        self._write(self.matrix_path(embedding.name), np.asarray(embedding.vectors, dtype=np.float32))
+        _OPEN.pop((str(self.root.resolve()), embedding.name), None)
+        self.save_unit(embedding)
+
+    def save_unit(self, embedding):
+        """
+        Writes the unit-length rows of an embedding already in the store.
+        """
+        self._write(self.unit_path(embedding.name), embedding.unit_vectors)
+        _OPEN.pop((str(self.root.resolve()), embedding.name), None)
+
+    def get(self, name):
+        """
+        Opens a community embedding, memory-mapping its matrix and unit-length rows.
+        """
+        key = (str(self.root.resolve()), name)
+        if key not in _OPEN:
+            words = np.load(self.vocab_path(name))
+            vectors = np.load(self.matrix_path(name), mmap_mode='r')
+            embedding = Embedding(name, words, vectors)
+            if self.has_unit(name):
+                embedding._unit = np.load(self.unit_path(name), mmap_mode='r')
+            _OPEN[key] = embedding
+        return _OPEN[key]
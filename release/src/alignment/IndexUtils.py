@@ -0,0 +1,367 @@
+from pathlib import Path
+import json
+import os
+import shutil
+import numpy as np
+
+# number of inverted lists scanned per query unless the caller asks otherwise
+DEFAULT_PROBE = 8
+
+# candidates per result that a quantized search re-ranks in float32
+DEFAULT_RERANK = 4
+
+# upper bound on the bytes held by one block of query x target scores
+SEARCH_MEMORY = 2**28
+
+def search_row_bytes(n_targets, dtype):
+    """
+    The bytes a blocked top-k search holds per query: its similarities to every target,
+    the copy of them that argpartition partitions, and the int64 indices it returns.
+    """
+    return n_targets * (2 * np.dtype(dtype).itemsize + np.dtype(np.int64).itemsize)
+
+def _tmp_dir(path):
+    """
+    An empty directory next to path, to write to before replacing path with it.
+    """
+    path = Path(path)
+    tmp = path.with_name(path.name + '.tmp')
+    if tmp.exists():
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    return tmp
+
+def normalize_rows(mtx):
+    """
+    Scales each row of mtx to unit length. Zero rows are left as zeros.
+    """
+    norms = np.sqrt(np.einsum('ij,ij->i', mtx, mtx))
+    norms[norms == 0] = 1
+    return mtx / norms[:, np.newaxis]
+
+def _assign(vectors, centroids, block_size=4096):
+    """
+    Index of the most cosine-similar centroid for every row of vectors.
+    """
+    labels = np.empty(vectors.shape[0], dtype=np.int64)
+    for start in range(0, vectors.shape[0], block_size):
+        block = vectors[start:start + block_size]
+        labels[start:start + block_size] = np.argmax(np.matmul(block, centroids.T), axis=1)
+    return labels
+
+def spherical_kmeans(vectors, n_clusters, n_iter=10, sample=None, seed=0):
+    """
+    K-means under cosine similarity.
+
+    vectors: unit-length rows to cluster
+    n_clusters: the number of centroids
+    n_iter: the number of Lloyd iterations
+    sample: if given, fit the centroids on at most this many random rows
+    seed: random seed for the initialization and the sample
+
+    return: unit-length centroids, shape (n_clusters, dims)
+    """
+    rng = np.random.RandomState(seed)
+    if sample is not None and sample < vectors.shape[0]:
+        vectors = vectors[np.sort(rng.choice(vectors.shape[0], sample, replace=False))]
+    centroids = vectors[rng.choice(vectors.shape[0], n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        labels = _assign(vectors, centroids)
+        order = np.argsort(labels, kind='stable')
+        members = np.bincount(labels, minlength=n_clusters)
+        nonempty = members > 0
+        starts = np.concatenate([[0], np.cumsum(members)[:-1]])
+        sums = np.add.reduceat(vectors[order], starts[nonempty], axis=0)
+        centroids[nonempty] = normalize_rows(sums)
+    return centroids
+
+class IVFIndex():
+    """
+    Inverted-file index over the unit-length rows of a target matrix.
+
+    The rows are partitioned by their nearest k-means centroid. A query is only
+    compared against the rows in its n_probe closest partitions, so n_probe trades
+    recall for latency. The index holds row ids, not vectors: searches are scored
+    against the caller's matrix.
+    """
+
+    def __init__(self, centroids, order, offsets):
+        """
+        centroids: unit-length centroids, shape (n_lists, dims)
+        order: row ids grouped by list
+        offsets: list l holds order[offsets[l]:offsets[l + 1]]
+        """
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+
+    @property
+    def n_lists(self):
+        return self.centroids.shape[0]
+
+    @property
+    def n_vectors(self):
+        return self.order.shape[0]
+
+    @classmethod
+    def build(cls, targets, n_lists=None, n_iter=10, seed=0):
+        """
+        Clusters the rows of targets into n_lists inverted lists.
+
+        targets: unit-length target rows
+        n_lists: the number of lists, defaults to 4 * sqrt(len(targets))
+        n_iter: k-means iterations
+        seed: random seed
+
+        return: IVFIndex
+        """
+        if n_lists is None:
+            n_lists = int(4 * np.sqrt(targets.shape[0]))
+        n_lists = max(1, min(n_lists, targets.shape[0]))
+        vectors = np.asarray(targets, dtype=np.float32)
+        centroids = spherical_kmeans(vectors, n_lists, n_iter=n_iter, sample=256 * n_lists, seed=seed)
+        labels = _assign(vectors, centroids)
+        order = np.argsort(labels, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=n_lists))])
+        return cls(centroids, order, offsets)
+
+    def search(self, queries, targets, k=1, n_probe=DEFAULT_PROBE):
+        """
+        Approximate top-k cosine search.
+
+        queries: the query matrix
+        targets: the unit-length target rows the index was built over
+        k: the number of neighbours to keep
+        n_probe: the number of lists scanned per query
+
+        return: (indices, similarities), both of shape (len(queries), k), most similar first.
+            Slots that no probed list could fill have index -1 and similarity -inf.
+        """
+        assert(targets.shape[0] == self.n_vectors)
+        queries = normalize_rows(np.asarray(queries, dtype=targets.dtype))
+        n_probe = max(1, min(n_probe, self.n_lists))
+        n_queries = queries.shape[0]
+
+        # the lists each query scans, closest first
+        coarse = np.matmul(queries, self.centroids.T)
+        probes = np.argpartition(-coarse, n_probe - 1, axis=1)[:, :n_probe]
+
+        # every query gets k candidate slots per probed list
+        cand_ids = np.full((n_queries, n_probe * k), -1, dtype=np.int64)
+        cand_sims = np.full((n_queries, n_probe * k), -np.inf, dtype=targets.dtype)
+        flat = probes.ravel()
+        by_list = np.argsort(flat, kind='stable')
+        bounds = np.searchsorted(flat[by_list], np.arange(self.n_lists + 1))
+        for l in range(self.n_lists):
+            hits = by_list[bounds[l]:bounds[l + 1]]
+            members = self.order[self.offsets[l]:self.offsets[l + 1]]
+            if hits.shape[0] == 0 or members.shape[0] == 0:
+                continue
+            rows, ranks = np.divmod(hits, n_probe)
+            sims = np.matmul(queries[rows], targets[members].T)
+            kk = min(k, members.shape[0])
+            if kk < members.shape[0]:
+                top = np.argpartition(-sims, kk - 1, axis=1)[:, :kk]
+            else:
+                top = np.broadcast_to(np.arange(kk), sims.shape)
+            cols = ranks[:, np.newaxis] * k + np.arange(kk)
+            cand_ids[rows[:, np.newaxis], cols] = members[top]
+            cand_sims[rows[:, np.newaxis], cols] = np.take_along_axis(sims, top, axis=1)
+
+        order = np.argsort(-cand_sims, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(cand_ids, order, axis=1), np.take_along_axis(cand_sims, order, axis=1)
+
+    def save(self, path):
+        with open(path, 'wb') as fp:
+            np.savez(fp, centroids=self.centroids, order=self.order, offsets=self.offsets)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['centroids'], data['order'], data['offsets'])
+
+class QuantizedMatrix():
+    """
+    The unit-length rows of a target matrix in float16, or in int8 with one scale
+    per row, a half or a quarter of the float32 size, and the float32 rows themselves.
+
+    A search scores every row from the codes, keeps rerank * k candidates per query,
+    and re-ranks them exactly against the float32 rows. Once saved and loaded, the
+    float32 rows are memory-mapped, so only the candidates' rows are read and the
+    codes are all that stays in memory. Built without a path, the float32 rows stay
+    in memory too. numpy has no fast float16 or int8 matrix product, so the codes
+    are widened to float32 one block of rows at a time.
+    """
+
+    def __init__(self, codes, scales, rows, rerank=DEFAULT_RERANK):
+        """
+        codes: the quantized rows, float16 or int8
+        scales: for int8, row i is codes[i] * scales[i], otherwise None
+        rows: the unit-length float32 rows, re-ranked against
+        rerank: candidates re-ranked per result
+        """
+        self.codes = codes
+        self.scales = scales
+        self.rows = rows
+        self.rerank = rerank
+
+    @property
+    def n_vectors(self):
+        return self.codes.shape[0]
+
+    @property
+    def nbytes(self):
+        """
+        The bytes a search keeps in memory: the codes and their scales, and the
+        float32 rows unless they are memory-mapped.
+        """
+        nbytes = self.codes.nbytes + (0 if self.scales is None else self.scales.nbytes)
+        if not isinstance(self.rows, np.memmap):
+            nbytes += self.rows.nbytes
+        return nbytes
+
+    @classmethod
+    def build(cls, targets, dtype='int8', rerank=DEFAULT_RERANK, block_size=65536, path=None):
+        """
+        Quantizes the normalized rows of targets, one block at a time.
+
+        targets: the target matrix, normalized here
+        dtype: 'float16' or 'int8'
+        path: if given, the directory to save to, see save. The float32 rows are
+            written there as they are normalized and come back memory-mapped.
+        """
+        if dtype not in ['float16', 'int8']:
+            raise ValueError(f"unknown quantization {dtype}")
+        codes = np.empty(targets.shape, dtype=dtype)
+        scales = np.empty(targets.shape[0], dtype=np.float32) if dtype == 'int8' else None
+        if path is None:
+            rows = np.empty(targets.shape, dtype=np.float32)
+        else:
+            tmp = _tmp_dir(path)
+            rows = np.lib.format.open_memmap(tmp / 'rows.npy', mode='w+', dtype=np.float32, shape=targets.shape)
+        for start in range(0, targets.shape[0], block_size):
+            block = normalize_rows(np.asarray(targets[start:start + block_size], dtype=np.float32))
+            rows[start:start + block_size] = block
+            if dtype == 'float16':
+                codes[start:start + block_size] = block
+                continue
+            scale = np.abs(block).max(axis=1) / 127
+            scale[scale == 0] = 1
+            codes[start:start + block_size] = np.rint(block / scale[:, np.newaxis])
+            scales[start:start + block_size] = scale
+        quant = cls(codes, scales, rows, rerank=rerank)
+        if path is None:
+            return quant
+        rows.flush()
+        quant._commit(tmp, path)
+        return cls.load(path, rerank=rerank)
+
+    def decode(self, start, end):
+        rows = self.codes[start:end].astype(np.float32)
+        if self.scales is not None:
+            rows *= self.scales[start:end, np.newaxis]
+        return rows
+
+    def _query_bytes(self, n_cand):
+        """
+        The bytes a search holds per query besides its scores: the float32 rows of its
+        candidates for re-ranking, and the running candidates merged with every block.
+        """
+        return n_cand * (4 * self.codes.shape[1] + 6 * (4 + 8))
+
+    def search(self, queries, k=1, max_memory=SEARCH_MEMORY, query_block=4096):
+        """
+        Top-k cosine search on the codes, re-ranked in float32.
+
+        queries: the query matrix
+        max_memory: bytes allowed for one block of queries, see search_row_bytes
+
+        return: (indices, similarities), both of shape (len(queries), k), most similar first
+        """
+        queries = normalize_rows(np.asarray(queries, dtype=np.float32))
+        k = max(0, min(k, self.n_vectors))
+        indices = np.empty((queries.shape[0], k), dtype=np.int64)
+        topsims = np.empty((queries.shape[0], k), dtype=np.float32)
+        if k == 0:
+            return indices, topsims
+        n_cand = min(max(k, self.rerank * k), self.n_vectors)
+        # half the budget for what grows with the queries, the rest for the blocks of scores
+        query_block = max(1, min(query_block, int(max_memory // (2 * self._query_bytes(n_cand)))))
+        for start in range(0, queries.shape[0], query_block):
+            block = queries[start:start + query_block]
+            indices[start:start + query_block], topsims[start:start + query_block] = \
+                self._search_block(block, k, n_cand, max_memory)
+        return indices, topsims
+
+    def _search_block(self, queries, k, n_cand, max_memory):
+        n_queries, n_targets = queries.shape[0], self.n_vectors
+        budget = max_memory - n_queries * self._query_bytes(n_cand)
+        # the scores of every query and the decoded rows, per target row
+        block_size = max(1, int(budget // (search_row_bytes(n_queries, np.float32) + 4 * self.codes.shape[1])))
+
+        # the n_cand best scores so far, merged with every block of rows
+        cand_ids = np.empty((n_queries, 0), dtype=np.int64)
+        cand_sims = np.empty((n_queries, 0), dtype=np.float32)
+        for start in range(0, n_targets, block_size):
+            end = min(start + block_size, n_targets)
+            sims = np.matmul(queries, self.decode(start, end).T)
+            if sims.shape[1] > n_cand:
+                top = np.argpartition(sims, sims.shape[1] - n_cand, axis=1)[:, -n_cand:]
+                sims = np.take_along_axis(sims, top, axis=1)
+            else:
+                top = np.broadcast_to(np.arange(sims.shape[1]), sims.shape)
+            sims = np.concatenate([cand_sims, sims], axis=1)
+            ids = np.concatenate([cand_ids, top + start], axis=1)
+            if sims.shape[1] > n_cand:
+                top = np.argpartition(sims, sims.shape[1] - n_cand, axis=1)[:, -n_cand:]
+                sims = np.take_along_axis(sims, top, axis=1)
+                ids = np.take_along_axis(ids, top, axis=1)
+            cand_ids, cand_sims = ids, sims
+
+        # exact similarities of the candidates, reading only their rows
+        rows = np.asarray(self.rows[cand_ids.ravel()], dtype=np.float32)
+        exact = np.einsum('qcd,qd->qc', rows.reshape(n_queries, n_cand, -1), queries)
+        order = np.argsort(-exact, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(cand_ids, order, axis=1), np.take_along_axis(exact, order, axis=1)
+
+    def save(self, path):
+        """
+        Writes the codes, scales and float32 rows to the directory path as .npy files.
+        quant.json is written last, so a directory without it is incomplete.
+        """
+        tmp = _tmp_dir(path)
+        np.save(tmp / 'rows.npy', np.asarray(self.rows, dtype=np.float32))
+        self._commit(tmp, path)
+
+    def _commit(self, tmp, path):
+        np.save(tmp / 'codes.npy', self.codes)
+        if self.scales is not None:
+            np.save(tmp / 'scales.npy', self.scales)
+        with open(tmp / 'quant.json', 'w') as fp:
+            json.dump({'n_vectors': int(self.n_vectors), 'dims': int(self.codes.shape[1]),
+                       'dtype': str(self.codes.dtype)}, fp)
+        path = Path(path)
+        if path.exists():
+            shutil.rmtree(path)
+        os.replace(tmp, path)
+
+    @classmethod
+    def read_meta(cls, path):
+        """
+        The {'n_vectors', 'dims', 'dtype'} of a saved QuantizedMatrix, without loading it.
+        """
+        with open(Path(path) / 'quant.json') as fp:
+            return json.load(fp)
+
+    @classmethod
+    def load(cls, path, rerank=DEFAULT_RERANK, mmap_mode='r'):
+        """
+        Reads a saved QuantizedMatrix: the codes into memory, the float32 rows memory-mapped.
+        """
+        path = Path(path)
+        meta = cls.read_meta(path)
+        codes = np.load(path / 'codes.npy')
+        scales = np.load(path / 'scales.npy') if (path / 'scales.npy').exists() else None
+        rows = np.load(path / 'rows.npy', mmap_mode=mmap_mode)
+        assert(codes.shape[0] == rows.shape[0] == meta['n_vectors'])
+        return cls(codes, scales, rows, rerank=rerank)
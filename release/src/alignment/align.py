@@ -1,43 +1,120 @@
 from pathlib import Path
-import sys
+import argparse
 import logging
 import json
 import AlignUtils as AU
+import EmbeddingStore as ES
 import pickle
 import os
+import sys
+import time
+
+import numpy as np
 
 from gensim.models.word2vec import Word2Vec
 
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'stats'))
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import CountUtils as CU
+import ProfileUtils as PU
+import PoolUtils
+
 logging.basicConfig(level=logging.INFO)
 
-# ./src/alignment/align_svd.py ./data/models/ ./data/aligners/cca/
+# ./src/alignment/align.py ./data/models/ ./data/aligners/cca/ ./data/counts.json cca -1 --workers 8
+# ./src/alignment/align.py ./data/models/ ./data/aligners/joint/ ./data/counts/ joint -1 --store ./data/store/
 
 default_args = {'k':None,
                'method':'svd'}
 
+# embeddings and counts are loaded once in the parent process, before the pool
+# is forked, so every worker shares them copy-on-write instead of reloading them
+EMBEDDINGS = {}
+COUNTS = {}
+
 def get_modelfiles(model_dir):
     res = []
-    for model_file in source_dir.glob("*.model"):
+    for model_file in sorted(model_dir.glob("*.model")):
         res.append(model_file)
     return res
 
+def opts_path(outfile):
+    """
+    The json file next to an aligner that records the options it was built with.
+    """
+    return outfile.with_suffix('.opts.json')
+
+def built_opts(opts, k=None):
+    """
+    The options that decide what an aligner file holds: a change to any of them
+    means it has to be rebuilt.
+    
+    k: in a sweep, the anchor count of the file, -1 for all; otherwise opts['k']
+    """
+    if k is None:
+        k = opts['k']
+    elif k == -1:
+        k = None
+    res = {'method': opts['method'], 'k': k, 'format': opts.get('format'), 'store': opts.get('store')}
+    if opts.get('refine'):
+        res['refine'] = opts['refine']
+        res['csls_k'] = opts.get('csls_k')
+    return res
+
+def write_opts(outfile, built):
+    tmpfile = opts_path(outfile).with_suffix('.tmp')
+    with open(tmpfile, 'w') as fp:
+        json.dump(built, fp, sort_keys=True)
+    os.replace(tmpfile, opts_path(outfile))
+
+def is_up_to_date(outfile, dependencies, built=None):
+    """
+    Whether outfile is newer than all its dependencies and, if built is given,
+    was written with those options (see built_opts).
+    """
+    if built is not None:
+        if not opts_path(outfile).exists():
+            return False
+        with open(opts_path(outfile)) as fp:
+            if json.load(fp) != built:
+                return False
+    if outfile.is_dir():
+        # compact aligners are complete once meta.json exists
+        outfile = outfile / 'meta.json'
+    if not outfile.exists():
+        return False
+    mtime = outfile.stat().st_mtime
+    return all(mtime >= Path(d).stat().st_mtime for d in dependencies)
+
+def load_counts(path, names):
+    """
+    Reads the counts of the named communities, from a json file written by
+    src/stats/counts.py or from a directory of per-community count arrays.
+    
+    return: {name: CountUtils.Counts}
+    """
+    if path.is_dir():
+        return {name: CU.load_counts(path, name) for name in names}
+    with open(path) as fp:
+        counts = json.load(fp)
+    return {name: CU.Counts.from_dict(counts[name]) for name in names}
+
 def build_aligner(a, b, counts, name1, name2, opts=default_args):
     k = opts['k']
+    a = AU.as_embedding(a)
+    b = AU.as_embedding(b)
     
     # get the shared vocab
-    shared_vocab = list(sorted(list(set.intersection(set(a.wv.vocab), set(b.wv.vocab)))))
+    shared_vocab = np.intersect1d(a.words, b.words).tolist()
     
     # get the anchors
-    v_counts = [(w, (counts[name1][w] if w in counts[name1] else 0) + (counts[name2][w] if w in counts[name2] else 0)) for w in shared_vocab]
-    sorted_v = sorted(v_counts, key=lambda x: x[1], reverse=True)
-    sorted_v = [x for x,y in sorted_v]
-    if k is None:
-        anchors = sorted_v
-    else:
-        anchors = sorted_v[:k]
+    anchors = CU.rank_anchors(shared_vocab, counts[name1], counts[name2], k)
         
     # get the aligner
-    if opts['method'] == 'svd':
+    if opts['method'] == 'svd' and opts.get('refine'):
+        aligner = AU.get_refined_svd_aligner(a, b, shared_vocab, anchors,
+                                             n_iter=opts['refine'], csls_k=opts.get('csls_k', 10))
+    elif opts['method'] == 'svd':
         aligner = AU.get_svd_aligner(a, b, shared_vocab, anchors)
     if opts['method'] == 'lstsq':
         aligner = AU.get_lstsq_aligner(a, b, shared_vocab, anchors)
@@ -45,45 +122,252 @@ def build_aligner(a, b, counts, name1, name2, opts=default_args):
         aligner = AU.get_cca_aligner(a, b, shared_vocab, anchors)
     return aligner
 
-def model_iterator(files, counts, target, opts):
-    for i in range(len(files)):
-        model_a = Word2Vec.load(str(files[i]))
-        for j in range(len(files)):
-            if i == j:
-                continue
+def get_outfile(target, name_a, name_b, opts, k=None):
+    """
+    The aligner file of a pair; in a sweep, under target/k{k}/, with kall for -1,
+    so that each k is a directory of aligners like any other.
+    """
+    if k is not None:
+        target = target / f"k{'all' if k == -1 else k}"
+    if opts.get('format') == 'compact':
+        return target / f"{name_a}2{name_b}"
+    return target / f"{name_a}2{name_b}.pkl"
+
+def get_outfiles(target, name_a, name_b, opts):
+    if opts.get('sweep'):
+        outfiles = [get_outfile(target, name_a, name_b, opts, k) for k in opts['sweep']]
+        for f in outfiles:
+            if not os.path.exists(f.parent):
+                os.makedirs(f.parent)
+        return outfiles
+    return [get_outfile(target, name_a, name_b, opts)]
+
+def sweep_pair(job):
+    """
+    Writes the svd aligner of a pair for every anchor count of opts['sweep'],
+    fitting them all from one ranking and one pass over the anchors.
+    """
+    name_a, name_b, outfile, opts = job
+    a = AU.as_embedding(EMBEDDINGS[name_a])
+    b = AU.as_embedding(EMBEDDINGS[name_b])
+    shared_vocab = np.intersect1d(a.words, b.words).tolist()
+    # the anchors of every k are a prefix of the ranking for the largest k
+    k_max = None if -1 in opts['sweep'] else max(opts['sweep'])
+    anchors = CU.rank_anchors(shared_vocab, COUNTS[name_a], COUNTS[name_b], k_max)
+    
+    # -1 and any k past the shared vocabulary take every anchor
+    sizes = {k: len(anchors) if k == -1 else min(k, len(anchors)) for k in opts['sweep']}
+    store = ES.EmbeddingStore(opts['store']) if opts.get('store') is not None else None
+    start = time.perf_counter()
+    timings = []
+    for n, aligner in AU.get_svd_sweep_aligners(a, b, shared_vocab, anchors, sizes.values()):
+        seconds = time.perf_counter() - start
+        if store is not None:
+            aligner.bind_store(store, name_a, name_b)
+        for k in [k for k, size in sizes.items() if size == n]:
+            write_aligner(aligner, get_outfile(outfile.parent.parent, name_a, name_b, opts, k), opts, k=k)
+        timings.append(f"k={n} {seconds:.3f}s")
+        start = time.perf_counter()
+    logging.info(f"{name_a}2{name_b} sweep: {', '.join(timings)}")
+    return outfile
+
+def align_pair(job):
+    name_a, name_b, outfile, opts = job
+    if opts.get('sweep'):
+        return sweep_pair(job)
+    with PU.stage('align:build', pair=f"{name_a}2{name_b}", method=opts['method']):
+        aligner = build_aligner(EMBEDDINGS[name_a], EMBEDDINGS[name_b], COUNTS, name_a, name_b, opts)
+    if opts.get('store') is not None:
+        aligner.bind_store(ES.EmbeddingStore(opts['store']), name_a, name_b)
+    write_aligner(aligner, outfile, opts)
+    return outfile
+
+def write_aligner(aligner, outfile, opts, k=None):
+    """
+    Writes an aligner, then the options it was built with next to it.
+    """
+    if opts.get('format') == 'compact':
+        AU.save_compact(aligner, outfile)
+    else:
+        tmpfile = outfile.with_suffix('.tmp')
+        with open(tmpfile, 'wb') as fp:
+            pickle.dump(aligner, fp)
+        os.replace(tmpfile, outfile)
+    write_opts(outfile, built_opts(opts, k))
+
+def load_embeddings(files, opts):
+    """
+    Loads the embedding of every model into EMBEDDINGS, from the embedding store
+    if opts['store'] is set, writing it there first if it is missing or stale.
+    """
+    store = ES.EmbeddingStore(opts['store']) if opts.get('store') is not None else None
+    for f in files:
+        if f.stem in EMBEDDINGS:
+            continue
+        with PU.stage('align:load', model=f.stem) as s:
+            if store is None:
+                embedding = ES.Embedding.from_model(f.stem, Word2Vec.load(str(f), mmap='r'))
             else:
-                model_b = Word2Vec.load(str(models[j]))
-                
-            name_i = files[i].stem
-            name_j = files[j].stem
-            aligner = build_aligner(model_a, model_b, counts, name_i, name_j, opts)
-            aligner_name = f"{name_i}2{name_j}.pkl"
-            with open(target / aligner_name, 'wb') as fp:
-                pickle.dump(aligner, fp)
+                if not is_up_to_date(store.matrix_path(f.stem), [f]):
+                    store.save(ES.Embedding.from_model(f.stem, Word2Vec.load(str(f), mmap='r')))
+                    logging.info(f"Stored the embedding of {f.stem}")
+                embedding = store.get(f.stem)
+                if not store.has_unit(f.stem):
+                    # stores written before the unit-length rows were kept get them now
+                    store.save_unit(embedding)
+                    embedding = store.get(f.stem)
+            # build the word maps before forking so that the workers share them
+            embedding.w2id, embedding.id2w
+            s.items, s.unit = len(embedding.words), 'words'
+        EMBEDDINGS[f.stem] = embedding
+
+def model_iterator(files, counts, target, opts, dependencies=(), n_workers=1, force=False, pairs=None):
+    """
+    Builds and pickles an aligner for every ordered pair of models.
+    
+    files: the model files
+    counts: the CountUtils.Counts of each community
+    target: the directory to write {a}2{b}.pkl, or the compact {a}2{b}/, to
+    opts: the aligner options
+    dependencies: other files the aligners are built from, e.g. the counts file
+    n_workers: the number of processes building aligners
+    force: rebuild aligners that are already up to date
+    pairs: if given, only build the aligners of these (a, b) name pairs
+    
+    return: None
+    """
+    jobs = []
+    for file_a in files:
+        for file_b in files:
+            if file_a == file_b:
+                continue
+            if pairs is not None and (file_a.stem, file_b.stem) not in pairs:
+                continue
+            outfiles = get_outfiles(target, file_a.stem, file_b.stem, opts)
+            built = [built_opts(opts, k) for k in opts['sweep']] if opts.get('sweep') else [built_opts(opts)]
+            if not force and all(is_up_to_date(f, [file_a, file_b, *dependencies], b)
+                                 for f, b in zip(outfiles, built)):
+                continue
+            jobs.append((file_a.stem, file_b.stem, outfiles[-1], opts))
+    logging.info(f"{len(jobs)} of {len(files) * (len(files) - 1)} aligners to build.")
+    if not jobs:
+        return
+    
+    needed = set(a for a, _, _, _ in jobs) | set(b for _, b, _, _ in jobs)
+    load_embeddings([f for f in files if f.stem in needed], opts)
+    COUNTS.update(counts)
+    
+    with PU.stage('align:pairs', items=len(jobs), unit='pairs', workers=n_workers):
+        for done, outfile in enumerate(PoolUtils.imap_unordered(align_pair, jobs, n_workers), 1):
+            logging.info(f"[{done}/{len(jobs)}] Wrote {outfile.name}")
             
+def joint_align(files, counts, target, opts, dependencies=(), force=False, pairs=None):
+    """
+    Fits one map per model into a common space over the anchors all models share,
+    saves them to target/joint.npz (see AlignUtils.JointAlignment), and writes the
+    aligner of every pair, which holds its composed map. With an embedding store
+    the pair aligners reference its matrices instead of holding their own.
+    
+    return: None
+    """
+    outfile = target / 'joint.npz'
+    if force or not is_up_to_date(outfile, [*files, *dependencies], built_opts(opts)):
+        load_embeddings(files, opts)
+        embeddings = {f.stem: EMBEDDINGS[f.stem] for f in files}
+        dims = set(e.vectors.shape[1] for e in embeddings.values())
+        if len(dims) != 1:
+            raise ValueError(f"a joint alignment needs models of one dimension, got {sorted(dims)}")
+        shared = embeddings[files[0].stem].words
+        for e in embeddings.values():
+            shared = np.intersect1d(shared, e.words)
+        anchors = CU.rank_shared(shared.tolist(), [counts[f.stem] for f in files], opts['k'])
+        with PU.stage('align:joint', items=len(anchors), unit='anchors', models=len(files)):
+            joint = AU.JointAlignment.fit(embeddings, anchors)
+        joint.save(outfile)
+        write_opts(outfile, built_opts(opts))
+        logging.info(f"Wrote {outfile.name}: {len(files)} maps over {len(anchors)} shared anchors")
+    
+    joint = AU.JointAlignment.load(outfile)
+    jobs = []
+    for a in joint.names:
+        for b in joint.names:
+            if a == b or (pairs is not None and (a, b) not in pairs):
+                continue
+            pair_file = get_outfile(target, a, b, opts)
+            if force or not is_up_to_date(pair_file, [outfile], built_opts(opts)):
+                jobs.append((a, b, pair_file))
+    
+    store = ES.EmbeddingStore(opts['store']) if opts.get('store') is not None else None
+    if store is None and jobs:
+        needed = set(a for a, _, _ in jobs) | set(b for _, b, _ in jobs)
+        load_embeddings([f for f in files if f.stem in needed], opts)
+    for a, b, pair_file in jobs:
+        if store is None:
+            aligner = joint.get_aligner(a, b, emb_a=EMBEDDINGS[a], emb_b=EMBEDDINGS[b])
+        else:
+            aligner = joint.get_aligner(a, b, store=store)
+        write_aligner(aligner, pair_file, opts)
+    logging.info(f"Wrote {len(jobs)} pair aligners")
+
 if __name__ == "__main__":
-    assert(len(sys.argv) == 6)
+    parser = argparse.ArgumentParser(description="Builds an aligner for every ordered pair of models.")
+    parser.add_argument('source_dir', type=Path, help="directory of *.model files")
+    parser.add_argument('target_dir', type=Path, help="directory to write the aligners to")
+    parser.add_argument('counts_file', type=Path, help="word counts, the json or directory written by src/stats/counts.py")
+    parser.add_argument('method', choices=['svd', 'cca', 'lstsq', 'joint'],
+                        help="joint fits one map per model into a common space instead of one per pair")
+    parser.add_argument('k', type=int, help="number of anchors, -1 for the whole shared vocabulary; unused with --sweep")
+    parser.add_argument('--workers', type=int, default=1, help="number of processes building aligners")
+    parser.add_argument('--format', choices=['pickle', 'compact'], default='pickle',
+                        help="pickle the aligners, or write them with AlignUtils.save_compact")
+    parser.add_argument('--store', type=Path, default=None,
+                        help="embedding store directory; aligners reference it instead of holding their own matrices")
+    parser.add_argument('--pairs', nargs='+', default=None, metavar='A:B',
+                        help="only build the aligners of these community pairs")
+    parser.add_argument('--force', action='store_true', help="rebuild aligners that are already up to date")
+    parser.add_argument('--sweep', type=int, nargs='+', default=None, metavar='K',
+                        help="svd only: build an aligner for each anchor count, -1 for all, in target_dir/k{K}/")
+    parser.add_argument('--refine', type=int, default=0, metavar='N',
+                        help="svd only: refine the map for up to N rounds on mutual CSLS nearest neighbours")
+    parser.add_argument('--csls-k', type=int, default=10, help="neighbours averaged in the CSLS penalty")
+    args = parser.parse_args()
     
-    source_dir = Path(sys.argv[1])
-    target_dir = Path(sys.argv[2])
+    source_dir = args.source_dir
+    target_dir = args.target_dir
     if not os.path.exists(target_dir):
         os.makedirs(target_dir)
         
-    counts_dir = Path(sys.argv[3])
-    method = sys.argv[4]
-    assert(method in ['svd', 'cca', 'lstsq'])
-    k = int(sys.argv[5])
-        
-    with open(counts_dir) as fp:
-        counts = json.load(fp)
-    
     opts = {}
-    opts['method'] = method
+    opts['method'] = args.method
+    opts['format'] = args.format
+    opts['store'] = str(args.store.resolve()) if args.store is not None else None
+    k = args.k
     if k == -1:
         k = None
     opts['k'] = k
+    if args.refine < 0:
+        parser.error(f"--refine needs a number of rounds >= 0, got {args.refine}")
+    if args.csls_k < 1:
+        parser.error(f"--csls-k needs at least one neighbour, got {args.csls_k}")
+    opts['refine'] = args.refine
+    if args.sweep is not None and any(k < 1 and k != -1 for k in args.sweep):
+        parser.error(f"--sweep needs anchor counts >= 1, or -1 for all, got {args.sweep}")
+    opts['sweep'] = args.sweep
+    if args.sweep is not None and (args.method != 'svd' or args.refine):
+        parser.error("--sweep needs the svd method without --refine")
+    opts['csls_k'] = args.csls_k
 
     models = get_modelfiles(source_dir)
-    model_iterator(models, counts, target_dir, opts)
-
-    
\ No newline at end of file
+    pairs = None
+    if args.pairs is not None:
+        pairs = set(tuple(p.split(':')) for p in args.pairs)
+        names = set(name for pair in pairs for name in pair)
+        # a joint alignment is always fitted over every model
+        if args.method != 'joint':
+            models = [f for f in models if f.stem in names]
+    counts = load_counts(args.counts_file, [f.stem for f in models])
+    if args.method == 'joint':
+        joint_align(models, counts, target_dir, opts, dependencies=[args.counts_file], force=args.force, pairs=pairs)
+    else:
+        model_iterator(models, counts, target_dir, opts, dependencies=[args.counts_file],
+                       n_workers=args.workers, force=args.force, pairs=pairs)
@@ -0,0 +1,190 @@
+from pathlib import Path
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import sklearn
+import AlignUtils as AU
+import EmbeddingStore as ES
+
+logging.basicConfig(level=logging.INFO)
+
+# ./src/alignment/benchmark.py ./data/bench/head.json --vocab 10000 100000 --dims 100 300 --anchors 1000 -1
+# ./src/alignment/benchmark.py ./data/bench/new.json --baseline ./data/bench/head.json
+#   times fitting, aligner construction and translation on synthetic embeddings;
+#   with --baseline, reports the ratio to a previous run and exits 1 on a regression
+
+FACTORIES = {'svd': AU.get_svd_aligner,
+             'lstsq': AU.get_lstsq_aligner,
+             'cca': AU.get_cca_aligner}
+
+FITS = {'svd': AU.align_svd,
+        'lstsq': AU.align_lstsq,
+        'cca': AU.align_cca}
+
+def synthetic_embeddings(n_words, dims, noise=0.1, seed=0):
+    """
+    Two embeddings of the same vocabulary, the second a noisy rotation of the first,
+    so that every aligner has a true mapping to recover.
+
+    return: (emb_a, emb_b)
+    """
+    rng = np.random.RandomState(seed)
+    words = np.array([f"w{i:07d}" for i in range(n_words)])
+    vectors = rng.randn(n_words, dims).astype(np.float32)
+    rotation = np.linalg.qr(rng.randn(dims, dims))[0].astype(np.float32)
+    target = vectors.dot(rotation) + noise * rng.randn(n_words, dims).astype(np.float32)
+    return ES.Embedding('a', words, vectors), ES.Embedding('b', words, target)
+
+def measure(fn, repeat=1):
+    """
+    Runs fn repeat times, tracing the memory numpy and python allocate.
+
+    return: ({'seconds': best time, 'peak_mb': peak traced memory}, fn's last result)
+    """
+    times = []
+    peak = 0
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        res = fn()
+        times.append(time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return {'seconds': min(times), 'peak_mb': peak / 2**20}, res
+
+def bench_config(method, n_words, dims, k, opts):
+    """
+    Times one method on one synthetic vocabulary.
+
+    k: the number of anchors, -1 for the whole vocabulary
+
+    return: {stage: {'seconds', 'peak_mb'}} and the top-1 accuracy of the bulk translation
+    """
+    emb_a, emb_b = synthetic_embeddings(n_words, dims, seed=opts['seed'])
+    n_anchors = n_words if k == -1 else min(k, n_words)
+    anchors = emb_a.words[:n_anchors].tolist()
+    a_anchor, b_anchor = AU.get_anchor_matrices(emb_a, emb_b, anchors)
+    # the lookups are built outside the timings, as align.py prebuilds them
+    emb_a.w2id, emb_b.id2w
+
+    res = {}
+    res['fit'], _ = measure(lambda: FITS[method](a_anchor, b_anchor), opts['repeat'])
+    res['build'], aligner = measure(lambda: FACTORIES[method](emb_a, emb_b, None, anchors), opts['repeat'])
+
+    rng = np.random.RandomState(opts['seed'])
+    queries = emb_a.words[rng.choice(n_words, min(opts['queries'], n_words), replace=False)].tolist()
+    # the first search pays for normalizing the target, as a freshly loaded aligner would
+    res['translate_word_cold'], _ = measure(lambda: aligner.translate_word(queries[0]))
+    res['translate_word'], _ = measure(lambda: aligner.translate_word(queries[0]), opts['repeat'])
+    res['translate_words'], (guesses, _) = measure(lambda: aligner.translate_words(queries, k=opts['k']),
+                                                    opts['repeat'])
+    translated = aligner.translate_mtx(aligner.encode_input(queries))
+    res['decode_output'], _ = measure(lambda: aligner.decode_output(translated, k=opts['k']), opts['repeat'])
+    res['translate_words']['words_per_sec'] = len(queries) / max(res['translate_words']['seconds'], 1e-9)
+    accuracy = float(np.mean([g[0] == q for g, q in zip(guesses, queries)]))
+
+    # quantized as quantize.py does, to files whose float32 rows are memory-mapped;
+    # bytes_ratio leaves out mtxB, which only compact or store-bound aligners do not hold
+    with tempfile.TemporaryDirectory() as tmp:
+        for dtype in opts['quantize']:
+            path = Path(tmp) / f"{dtype}.quant"
+            res[f'quantize_{dtype}'], quant = measure(lambda: aligner.quantize(dtype, path=path))
+            stage = f'translate_words_{dtype}'
+            res[stage], (approx, _) = measure(lambda: aligner.translate_words(queries, k=opts['k'], quantized=True),
+                                              opts['repeat'])
+            res[stage]['words_per_sec'] = len(queries) / max(res[stage]['seconds'], 1e-9)
+            res[stage]['recall'] = float(np.mean([len(set(g) & set(a)) / len(g) for g, a in zip(guesses, approx)]))
+            res[stage]['bytes_ratio'] = 4 * n_words * dims / quant.nbytes
+        # the memory-mapped rows must be released before the files are removed
+        aligner._quant = quant = None
+    return res, accuracy
+
+def get_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=Path(__file__).resolve().parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def config_key(method, n_words, dims, k):
+    return f"{method}/v{n_words}/d{dims}/k{k}"
+
+def compare(results, baseline, tolerance, min_seconds=0.01):
+    """
+    The ratio of every timing to the same timing in baseline.
+
+    return: [(config, stage, ratio)] of the timings slower than 1 + tolerance,
+        ignoring slowdowns under min_seconds, which are mostly timer noise
+    """
+    regressions = []
+    for key, stages in results['configs'].items():
+        if key not in baseline['configs']:
+            continue
+        for stage, m in stages['stages'].items():
+            old = baseline['configs'][key]['stages'].get(stage)
+            if old is None:
+                continue
+            ratio = m['seconds'] / max(old['seconds'], 1e-9)
+            logging.info(f"{key:30s} {stage:20s} {old['seconds']:10.4f}s -> {m['seconds']:10.4f}s  x{ratio:.2f}")
+            if ratio > 1 + tolerance and m['seconds'] - old['seconds'] > min_seconds:
+                regressions.append((key, stage, ratio))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the aligners on synthetic embeddings.")
+    parser.add_argument('outfile', type=Path, help="the json file to write the results to")
+    parser.add_argument('--methods', nargs='+', default=['svd', 'lstsq', 'cca'], choices=list(FACTORIES))
+    parser.add_argument('--vocab', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--dims', type=int, nargs='+', default=[100, 300])
+    parser.add_argument('--anchors', type=int, nargs='+', default=[1000, -1], help="anchor counts, -1 for all")
+    parser.add_argument('--queries', type=int, default=10000, help="words in the bulk translation")
+    parser.add_argument('-k', type=int, default=1, help="translations per word")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per timing, the best is kept")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--quantize', nargs='*', default=[], choices=['float16', 'int8'],
+                        help="also translate with quantized targets, reporting recall against the exact search")
+    parser.add_argument('--baseline', type=Path, default=None, help="a previous result file to compare to")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="slowdown tolerated before a regression")
+    parser.add_argument('--min-seconds', type=float, default=0.01, help="smallest slowdown reported as a regression")
+    args = parser.parse_args()
+    opts = {'queries': args.queries, 'k': args.k, 'repeat': args.repeat, 'seed': args.seed,
+            'quantize': args.quantize}
+
+    results = {'revision': get_revision(), 'started': time.time(), 'opts': opts,
+               'platform': platform.platform(), 'cpus': os.cpu_count(),
+               'numpy': np.__version__, 'sklearn': sklearn.__version__, 'configs': {}}
+    for n_words in args.vocab:
+        for dims in args.dims:
+            for k in args.anchors:
+                for method in args.methods:
+                    key = config_key(method, n_words, dims, k)
+                    stages, accuracy = bench_config(method, n_words, dims, k, opts)
+                    results['configs'][key] = {'method': method, 'vocab': n_words, 'dims': dims, 'anchors': k,
+                                               'accuracy': accuracy, 'stages': stages}
+                    logging.info(f"{key}: " + ', '.join(f"{s} {m['seconds']:.4f}s" for s, m in stages.items()))
+    # the largest resident set of the whole run, in MB
+    results['max_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+    if not os.path.exists(args.outfile.parent):
+        os.makedirs(args.outfile.parent)
+    with open(args.outfile, 'w') as fp:
+        json.dump(results, fp, indent=1)
+    logging.info(f"Wrote {len(results['configs'])} configurations to {args.outfile}")
+
+    if args.baseline is not None:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline, args.tolerance, args.min_seconds)
+        for key, stage, ratio in regressions:
+            logging.warning(f"Regression: {key} {stage} is x{ratio:.2f} slower than {args.baseline.name}")
+        if regressions:
+            raise SystemExit(1)
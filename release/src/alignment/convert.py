@@ -0,0 +1,27 @@
+from pathlib import Path
+import sys
+import logging
+import os
+import shutil
+import AlignUtils as AU
+
+logging.basicConfig(level=logging.INFO)
+
+# converts pickled aligners to the compact format read by AlignUtils.load_aligner
+# ./src/alignment/convert.py ./data/aligners/cca/ ./data/aligners/cca-compact/
+
+if __name__ == "__main__":
+    assert(len(sys.argv) == 3)
+
+    source_dir = Path(sys.argv[1])
+    target_dir = Path(sys.argv[2])
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+
+    for aligner_file in sorted(source_dir.glob("*.pkl")):
+        aligner = AU.load_aligner(aligner_file)
+        target = target_dir / aligner_file.stem
+        AU.save_compact(aligner, target)
+        if AU.index_path(aligner_file).exists():
+            shutil.copyfile(AU.index_path(aligner_file), AU.index_path(target))
+        logging.info(f"Converted {aligner_file.name}")
@@ -0,0 +1,27 @@
+from pathlib import Path
+import re
+import sys
+import logging
+import AlignUtils as AU
+
+logging.basicConfig(level=logging.INFO)
+
+# ./src/alignment/index.py ./data/aligners/svd/ [n_lists]
+#   indexes the pickled and compact aligners of the directory, and of its k{K}/
+#   directories if it holds an anchor sweep (see align.py --sweep)
+
+def aligner_dirs(aligner_dir):
+    sweep = [d for d in aligner_dir.glob('k*') if d.is_dir() and re.fullmatch(r'k(\d+|all)', d.name)]
+    return [aligner_dir] + sorted(sweep)
+
+if __name__ == "__main__":
+    assert(len(sys.argv) in [2, 3])
+
+    aligner_dir = Path(sys.argv[1])
+    n_lists = int(sys.argv[2]) if len(sys.argv) == 3 else None
+
+    for aligner_file in [f for d in aligner_dirs(aligner_dir) for f in AU.list_aligners(d)]:
+        aligner = AU.load_aligner(aligner_file)
+        index = aligner.build_index(n_lists=n_lists)
+        aligner.save_index(AU.index_path(aligner_file))
+        logging.info(f"Indexed {aligner_file.parent.name}/{aligner_file.stem}: {index.n_vectors} words in {index.n_lists} lists")
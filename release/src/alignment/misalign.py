@@ -0,0 +1,91 @@
+from pathlib import Path
+import argparse
+import csv
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+import AlignUtils as AU
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import PoolUtils
+
+logging.basicConfig(level=logging.INFO)
+
+# ./src/alignment/misalign.py ./data/aligners/cca/ ./alignments/cca/ --workers 8
+
+def split_name(stem, stems):
+    """
+    Splits an aligner name {a}2{b} into (a, b). Community names may contain a 2
+    themselves, so prefer the split whose reverse aligner {b}2{a} also exists.
+    """
+    splits = [(stem[:i], stem[i + 1:]) for i, c in enumerate(stem) if c == '2' and 0 < i < len(stem) - 1]
+    for a, b in splits:
+        if f"{b}2{a}" in stems:
+            return a, b
+    return splits[0]
+
+def get_misalignments(aligner, max_memory=AU.DECODE_MEMORY):
+    """
+    Translates every word the two vocabularies share with one top-1 search.
+    
+    aligner: the aligner to evaluate
+    max_memory: bytes allowed for one block of the search
+    
+    return: (similarities, sources, images) of the words whose nearest target
+        word is a different word, by decreasing similarity
+    """
+    vocabB = np.array([aligner.id2wB[i] for i in range(len(aligner.id2wB))])
+    sources = np.array(sorted(set(aligner.w2idA).intersection(vocabB.tolist())))
+    rows = np.array([aligner.w2idA[w] for w in sources.tolist()], dtype=np.int64)
+    
+    translated = aligner.translate_mtx(np.asarray(aligner.source_space()[rows]))
+    ids, sims = aligner.search(translated, k=1, max_memory=max_memory)
+    images = vocabB[ids[:, 0]]
+    sims = sims[:, 0]
+    
+    misaligned = np.flatnonzero(images != sources)
+    order = misaligned[np.argsort(-sims[misaligned], kind='stable')]
+    return sims[order], sources[order], images[order]
+
+def write_report(job):
+    aligner_file, outfile, max_memory = job
+    start = time.time()
+    aligner = AU.load_aligner(aligner_file)
+    sims, sources, images = get_misalignments(aligner, max_memory=max_memory)
+    
+    tmpfile = outfile.with_suffix('.tmp')
+    with open(tmpfile, 'w', newline='') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(['similarity', 'source', 'image'])
+        writer.writerows(zip((f"{s:f}" for s in sims.tolist()), sources.tolist(), images.tolist()))
+    os.replace(tmpfile, outfile)
+    return outfile, len(sims), time.time() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Writes the misaligned shared words of every aligner to {a}-{b}.csv.")
+    parser.add_argument('aligner_dir', type=Path, help="directory of pickled or compact aligners")
+    parser.add_argument('target_dir', type=Path, help="directory to write the tables to")
+    parser.add_argument('--workers', type=int, default=1, help="number of aligners processed at once")
+    parser.add_argument('--max-memory', type=int, default=AU.DECODE_MEMORY,
+                        help="bytes allowed for one block of a worker's search")
+    args = parser.parse_args()
+    
+    if not os.path.exists(args.target_dir):
+        os.makedirs(args.target_dir)
+    
+    aligner_files = AU.list_aligners(args.aligner_dir)
+    stems = set(f.stem for f in aligner_files)
+    jobs = []
+    for f in aligner_files:
+        a, b = split_name(f.stem, stems)
+        jobs.append((f, args.target_dir / f"{a}-{b}.csv", args.max_memory))
+    
+    start = time.time()
+    n_rows = 0
+    for outfile, n, seconds in PoolUtils.imap_unordered(write_report, jobs, args.workers):
+        n_rows += n
+        logging.info(f"Wrote {n} rows to {outfile.name} in {seconds:.2f}s")
+    logging.info(f"Wrote {n_rows} rows for {len(jobs)} pairs in {time.time() - start:.2f}s")
@@ -0,0 +1,84 @@
+from pathlib import Path
+import argparse
+import json
+import logging
+import time
+
+import numpy as np
+import AlignUtils as AU
+import IndexUtils as IU
+
+logging.basicConfig(level=logging.INFO)
+
+# ./src/alignment/quantize.py ./data/aligners/svd/ int8 --rerank 4 -k 10
+#   writes {aligner}.quant/ next to every aligner, which load_aligner attaches for
+#   searches with quantized=True, and reports recall@k against the exact search.
+#   The float32 targets only leave memory for compact or store-bound aligners,
+#   which memory-map them; pickled aligners still load their whole mtxB.
+
+def recall_at_k(exact, approx):
+    """
+    The mean fraction of each row of exact ids that approx also found.
+    """
+    k = exact.shape[1]
+    return float(np.mean([len(np.intersect1d(e, a)) / k for e, a in zip(exact, approx)]))
+
+def evaluate(aligner, k, sample, seed=0):
+    """
+    Compares the quantized search of an aligner with its exact search on a sample of source words.
+
+    return: {'recall', 'top1', 'exact_seconds', 'quantized_seconds', 'queries'}
+    """
+    rng = np.random.RandomState(seed)
+    rows = np.sort(rng.choice(len(aligner.w2idA), min(sample, len(aligner.w2idA)), replace=False))
+    queries = aligner.translate_mtx(np.asarray(aligner.source_space()[rows]))
+
+    start = time.perf_counter()
+    exact, _ = aligner.search(queries, k=k)
+    exact_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    approx, _ = aligner.search(queries, k=k, quantized=True)
+    quantized_seconds = time.perf_counter() - start
+    return {'recall': recall_at_k(exact, approx),
+            'top1': float(np.mean(exact[:, 0] == approx[:, 0])),
+            'exact_seconds': exact_seconds,
+            'quantized_seconds': quantized_seconds,
+            'queries': len(rows)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Quantizes the target matrix of every aligner in a directory.")
+    parser.add_argument('aligner_dir', type=Path, help="directory of pickled or compact aligners")
+    parser.add_argument('dtype', choices=['float16', 'int8'])
+    parser.add_argument('--rerank', type=int, default=IU.DEFAULT_RERANK, help="candidates re-ranked per result")
+    parser.add_argument('-k', type=int, default=10, help="the k of the reported recall@k")
+    parser.add_argument('--sample', type=int, default=2000, help="source words searched to measure recall")
+    parser.add_argument('--report', type=Path, default=None, help="json report, default {aligner_dir}/quant.{dtype}.json")
+    args = parser.parse_args()
+
+    report = {'dtype': args.dtype, 'rerank': args.rerank, 'k': args.k, 'aligners': {}}
+    for aligner_file in AU.list_aligners(args.aligner_dir):
+        aligner = AU.load_aligner(aligner_file)
+        start = time.perf_counter()
+        quant = aligner.quantize(args.dtype, rerank=args.rerank, path=AU.quantized_path(aligner_file))
+        seconds = time.perf_counter() - start
+
+        res = evaluate(aligner, args.k, args.sample)
+        res['quantize_seconds'] = seconds
+        res['bytes'] = quant.nbytes
+        res['float32_bytes'] = quant.rows.nbytes
+        res['holds_float32'] = not isinstance(aligner.mtxB, np.memmap)
+        if res['holds_float32']:
+            logging.warning(f"{aligner_file.name} holds its float32 targets in memory, "
+                            f"convert it with convert.py to keep only the quantized targets in memory")
+        report['aligners'][aligner_file.name] = res
+        logging.info(f"{aligner_file.name}: recall@{args.k} {res['recall']:.4f}, top-1 {res['top1']:.4f}, "
+                     f"{res['float32_bytes'] / res['bytes']:.1f}x smaller, search "
+                     f"{res['exact_seconds']:.3f}s exact vs {res['quantized_seconds']:.3f}s quantized")
+
+    results = list(report['aligners'].values())
+    if results:
+        report['mean_recall'] = float(np.mean([r['recall'] for r in results]))
+        logging.info(f"Mean recall@{args.k} over {len(results)} aligners: {report['mean_recall']:.4f}")
+    report_file = args.report or args.aligner_dir / f"quant.{args.dtype}.json"
+    with open(report_file, 'w') as fp:
+        json.dump(report, fp, indent=1)
@@ -0,0 +1,350 @@
+from pathlib import Path
+from concurrent.futures import Future
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import argparse
+import json
+import logging
+import queue
+import threading
+import time
+
+import numpy as np
+import AlignUtils as AU
+import IndexUtils as IU
+from misalign import split_name
+
+logging.basicConfig(level=logging.INFO)
+
+# ./src/alignment/serve.py ./data/aligners/svd/ --port 8765
+#
+# Holds every aligner of a directory in memory and answers, as json over localhost http:
+#   POST /translate     {"aligner": "a2b", "words": [...], "k": 1}  -> {"words": [[...]], "sims": [[...]]}
+#   POST /most_similar  {"aligner": "a2b", "words": [...], "k": 10} -> the same, searched in the source space
+#   GET  /aligners      the names of the aligners
+#   GET  /stats         request, batch and latency counters per aligner
+# Requests for the same aligner and operation that arrive within --window seconds of
+# each other are answered by one matrix search, by one thread per operation. The
+# aligners of a community share one copy of its source and of its target matrix.
+# See AlignClient.py for a client.
+
+# the latencies kept per aligner for the percentiles in /stats
+N_LATENCIES = 10000
+
+class Sources():
+    """
+    The unit-length source matrices that most_similar searches, one per community:
+    the aligners {a}2{b} of a community a share its embedding, and so its matrix.
+    CCA aligners search their own projection of it, so they get one each.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.matrices = {}
+
+    def get(self, key, aligner):
+        """
+        return: (unit-length source matrix, {row: word})
+        """
+        with self.lock:
+            if key not in self.matrices:
+                source = AU.normalize_rows(np.asarray(aligner.source_space(), dtype=np.float32))
+                self.matrices[key] = (source, {i: w for w, i in aligner.w2idA.items()})
+            return self.matrices[key]
+
+class Targets():
+    """
+    The target matrices that translate searches, one per community: the pickled
+    aligners {a}2{b} into a community b each hold an equal copy of its embedding,
+    so all but the first are pointed at the first's, and its rows are normalized
+    once. Store-bound aligners already share the store's matrices, and CCA
+    aligners search their own projection, so both are left as they are.
+    """
+
+    def __init__(self):
+        self.owners = {}
+
+    def share(self, key, aligner, normalize=True):
+        """
+        Points aligner at the target matrix of the first aligner shared under key,
+        if the two are equal.
+
+        normalize: also share the unit-length rows that exact and approximate searches use
+        """
+        owner = self.owners.setdefault(key, aligner)
+        if owner is aligner:
+            return
+        if owner.id2wB != aligner.id2wB or not np.array_equal(owner.mtxB, aligner.mtxB):
+            logging.warning(f"The targets of two aligners into {key} differ, they are not shared")
+            return
+        aligner.id2wB = owner.id2wB
+        aligner.mtxB = owner.mtxB
+        if normalize:
+            aligner._normB = owner.target_matrix()
+
+class Batcher():
+    """
+    Collects the queries of one operation for every aligner, and answers all those
+    that arrive within a window with one search per aligner over its unique words.
+    """
+
+    def __init__(self, op, aligners, sources, window, max_batch, max_memory=AU.DECODE_MEMORY, approximate=False,
+                 n_probe=IU.DEFAULT_PROBE, quantized=False):
+        """
+        op: 'translate' or 'most_similar'
+        aligners: {name: (aligner, key of its source matrix in sources)}
+        sources: the Sources shared by the batchers
+        window: the seconds to wait for more queries after the first of a batch
+        max_batch: the most words searched at once
+        max_memory: bytes allowed for one block of a search
+        """
+        self.op = op
+        self.aligners = aligners
+        self.sources = sources
+        self.window = window
+        self.max_batch = max_batch
+        self.max_memory = max_memory
+        self.approximate = approximate
+        self.n_probe = n_probe
+        self.quantized = quantized
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.latencies = {}
+        threading.Thread(target=self.run, name=op, daemon=True).start()
+
+    def submit(self, name, words, k):
+        """
+        Queues a query. The future resolves to (words, sims), None for unknown words.
+        """
+        if name not in self.aligners:
+            raise KeyError(name)
+        future = Future()
+        self.queue.put((name, list(words), k, future, time.perf_counter()))
+        return future
+
+    def collect(self):
+        """
+        Blocks for a first query, then takes the queries that arrive within the window.
+        """
+        batch = [self.queue.get()]
+        n_words = len(batch[0][1])
+        deadline = time.perf_counter() + self.window
+        while n_words < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+            n_words += len(batch[-1][1])
+        return batch
+
+    def search(self, name, words, k):
+        """
+        The k results of every word, which must all be known to the aligner.
+
+        return: ([[STRING]], SIMS)
+        """
+        aligner, key = self.aligners[name]
+        if self.op == 'translate':
+            return aligner.translate_words(words, k=k, max_memory=self.max_memory, approximate=self.approximate,
+                                           n_probe=self.n_probe, quantized=self.quantized)
+        # neighbours in the source space, leaving out the word itself
+        source, id2wA = self.sources.get(key, aligner)
+        queries = aligner.encode_input(words).astype(np.float32)
+        ids, sims = AU.topk_cosine(queries, source, k=k + 1, max_memory=self.max_memory)
+        own = np.array([aligner.w2idA[w] for w in words])[:, None]
+        keep = np.argsort(ids == own, axis=1, kind='stable')[:, :-1]
+        ids = np.take_along_axis(ids, keep, axis=1)
+        sims = np.take_along_axis(sims, keep, axis=1)
+        return [[id2wA[i] for i in row] for row in ids], sims
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            by_name = {}
+            for query in batch:
+                by_name.setdefault(query[0], []).append(query[1:])
+            for name, queries in by_name.items():
+                self.answer(name, queries)
+
+    def answer(self, name, queries):
+        """
+        Resolves the queries for one aligner with one search.
+        """
+        start = time.perf_counter()
+        try:
+            known = self.aligners[name][0].w2idA
+            unique = list(dict.fromkeys(w for words, _, _, _ in queries for w in words if w in known))
+            k = max(q_k for _, q_k, _, _ in queries)
+            results = {}
+            if unique:
+                res, sims = self.search(name, unique, k)
+                results = {w: (r, s) for w, r, s in zip(unique, res, np.asarray(sims).tolist())}
+            for words, q_k, future, _ in queries:
+                found = [results.get(w) for w in words]
+                future.set_result(([None if f is None else f[0][:q_k] for f in found],
+                                   [None if f is None else f[1][:q_k] for f in found]))
+        except Exception as e:
+            logging.exception(f"{name} {self.op} failed")
+            for _, _, future, _ in queries:
+                if not future.done():
+                    future.set_exception(e)
+            with self.lock:
+                self.get_counters(name)['errors'] += 1
+            return
+        end = time.perf_counter()
+        with self.lock:
+            stats = self.get_counters(name)
+            stats['requests'] += len(queries)
+            stats['words'] += sum(len(words) for words, _, _, _ in queries)
+            stats['unique_words'] += len(unique)
+            stats['batches'] += 1
+            stats['search_seconds'] += end - start
+            self.latencies[name].extend(end - submitted for _, _, _, submitted in queries)
+
+    def get_counters(self, name):
+        if name not in self.stats:
+            self.stats[name] = {'requests': 0, 'words': 0, 'unique_words': 0, 'batches': 0, 'errors': 0,
+                                'search_seconds': 0.}
+            self.latencies[name] = deque(maxlen=N_LATENCIES)
+        return self.stats[name]
+
+    def get_stats(self, name, uptime):
+        with self.lock:
+            stats = dict(self.get_counters(name))
+            latencies = np.array(self.latencies[name])
+        stats['words_per_batch'] = stats['words'] / stats['batches'] if stats['batches'] else None
+        stats['words_per_sec'] = stats['words'] / uptime
+        if len(latencies):
+            stats['latency_ms'] = {'mean': float(latencies.mean()) * 1000,
+                                   'p50': float(np.percentile(latencies, 50)) * 1000,
+                                   'p95': float(np.percentile(latencies, 95)) * 1000,
+                                   'max': float(latencies.max()) * 1000}
+        return stats
+
+class Service():
+    """
+    The aligners of a directory, with a batcher per operation.
+    """
+
+    def __init__(self, aligner_dir, window=0.005, max_batch=4096, max_memory=AU.DECODE_MEMORY, approximate=False,
+                 n_probe=IU.DEFAULT_PROBE, quantized=None):
+        """
+        quantized: None, or 'float16' or 'int8' to translate with quantized targets,
+            taken from quantize.py's files when there are any
+        """
+        self.started = time.time()
+        paths = AU.list_aligners(aligner_dir)
+        stems = set(path.stem for path in paths)
+        aligners = {}
+        targets = Targets()
+        for path in paths:
+            start = time.time()
+            aligner = AU.load_aligner(path)
+            if isinstance(aligner, AU.CCAAligner):
+                key = path.stem
+            elif getattr(aligner, 'store', None) is not None:
+                key = aligner.names[0]
+            else:
+                key, target = split_name(path.stem, stems)
+                targets.share(target, aligner, normalize=quantized is None)
+            if approximate and getattr(aligner, '_index', None) is None:
+                aligner.build_index()
+            if quantized is not None and getattr(aligner, '_quant', None) is None:
+                # without quantize.py's files the float32 rows are held in memory, and
+                # with them only compact or store-bound aligners leave mtxB on disk
+                logging.warning(f"{path.stem} has no quantized targets on disk, quantizing in memory")
+                aligner.quantize(quantized)
+            aligners[path.stem] = (aligner, key)
+            logging.info(f"Loaded {path.stem} in {time.time() - start:.2f}s")
+        sources = Sources()
+        self.batchers = {op: Batcher(op, aligners, sources, window, max_batch, max_memory=max_memory,
+                                     approximate=approximate, n_probe=n_probe, quantized=quantized is not None)
+                         for op in ['translate', 'most_similar']}
+        self.names = list(sorted(aligners))
+
+    def aligners(self):
+        return self.names
+
+    def query(self, op, name, words, k):
+        return self.batchers[op].submit(name, words, k).result()
+
+    def get_stats(self):
+        uptime = time.time() - self.started
+        res = {'uptime': uptime, 'aligners': {}}
+        for name in self.names:
+            res['aligners'][name] = {op: batcher.get_stats(name, uptime) for op, batcher in self.batchers.items()}
+        return res
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # clients send many queries at once, more than the default listen backlog of 5
+    request_queue_size = 256
+
+class Handler(BaseHTTPRequestHandler):
+    service = None
+
+    def reply(self, code, body):
+        data = json.dumps(body).encode('utf8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/aligners':
+            self.reply(200, self.service.aligners())
+        elif self.path == '/stats':
+            self.reply(200, self.service.get_stats())
+        else:
+            self.reply(404, {'error': f"unknown path {self.path}"})
+
+    def do_POST(self):
+        op = self.path.strip('/')
+        if op not in ['translate', 'most_similar']:
+            self.reply(404, {'error': f"unknown path {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            words = request['words']
+            if not isinstance(words, list) or not all(isinstance(w, str) for w in words):
+                raise ValueError("words must be a list of strings")
+            words, sims = self.service.query(op, request['aligner'], words, int(request.get('k', 1)))
+        except KeyError as e:
+            self.reply(404, {'error': f"unknown aligner or missing field {e}"})
+            return
+        except (ValueError, TypeError) as e:
+            self.reply(400, {'error': str(e)})
+            return
+        self.reply(200, {'words': words, 'sims': sims})
+
+    def log_message(self, format, *args):
+        pass
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves translations from a directory of aligners.")
+    parser.add_argument('aligner_dir', type=Path, help="directory of pickled or compact aligners")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--window', type=float, default=0.005, help="seconds a batch waits for more queries")
+    parser.add_argument('--max-batch', type=int, default=4096, help="most words searched at once")
+    parser.add_argument('--max-memory', type=int, default=AU.DECODE_MEMORY, help="bytes allowed for one block of a search")
+    parser.add_argument('--approximate', action='store_true', help="translate with the IVF index, see index.py")
+    parser.add_argument('--n-probe', type=int, default=IU.DEFAULT_PROBE)
+    parser.add_argument('--quantized', choices=['float16', 'int8'], default=None,
+                        help="translate with quantized targets, see quantize.py")
+    args = parser.parse_args()
+
+    Handler.service = Service(args.aligner_dir, window=args.window, max_batch=args.max_batch,
+                              max_memory=args.max_memory, approximate=args.approximate, n_probe=args.n_probe,
+                              quantized=args.quantized)
+    server = Server((args.host, args.port), Handler)
+    logging.info(f"Serving {len(Handler.service.aligners())} aligners on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
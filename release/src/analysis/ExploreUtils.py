@@ -1,7 +1,22 @@
+from pathlib import Path
+import json
+import os
+import numpy as np
 from nltk.corpus import stopwords, wordnet
 from tqdm import tqdm
 
-def get_antonyms(vocab):
+def get_antonyms(vocab, lexicon=None):
+    """
+    The (word, antonym) pairs of the words in vocab.
+
+    vocab: the words to look up
+    lexicon: an antonym lexicon from get_antonym_lexicon; without one, every word
+        is looked up in WordNet
+
+    return: {(word, antonym)}
+    """
+    if lexicon is not None:
+        return lookup_antonyms(vocab, lexicon)
     antonyms = []
     for w in tqdm(vocab):
         for synset in wordnet.synsets(w):
@@ -9,4 +24,96 @@ def get_antonyms(vocab):
                 if lemma.antonyms():
                     antonyms.append((w, lemma.antonyms()[0].name()))
     antonyms = set(antonyms)
-    return antonyms
\ No newline at end of file
+    return antonyms
+
+def word_antonyms(form):
+    """
+    The antonyms get_antonyms finds for one lowercase word.
+    """
+    antonyms = set()
+    for synset in wordnet.synsets(form):
+        for lemma in synset.lemmas():
+            if lemma.antonyms():
+                antonyms.add(lemma.antonyms()[0].name())
+    return antonyms
+
+# the WordNet files of the irregular forms that morphy reduces, by part of speech
+EXCEPTION_FILES = {'n': 'noun.exc', 'v': 'verb.exc', 'a': 'adj.exc', 'r': 'adv.exc', 's': 'adj.exc'}
+
+def exception_forms(pos):
+    """
+    The irregular forms WordNet lists for a part of speech and their bases, read
+    from its exception file as morphy reads them, e.g. {'worse': ['bad', 'ill']}.
+    """
+    res = {}
+    with wordnet.open(EXCEPTION_FILES[pos]) as fp:
+        for line in fp:
+            terms = line.split()
+            if terms:
+                res[terms[0]] = terms[1:]
+    return res
+
+def build_antonym_lexicon():
+    """
+    Extracts from WordNet the antonyms of every word form that has any, so that
+    get_antonyms(vocab, lexicon) finds the same pairs as get_antonyms(vocab).
+
+    wordnet.synsets reduces a word to its lemmas with morphy: the word itself, its
+    exception-list bases, or one suffix substitution. The candidate forms are built
+    from the lemmas of the synsets that have antonyms by inverting those three steps,
+    then each candidate is looked up once as get_antonyms would.
+
+    return: {form: [antonym]}
+    """
+    bases = set()
+    for synset in wordnet.all_synsets():
+        if any(lemma.antonyms() for lemma in synset.lemmas()):
+            bases.update(lemma.name().lower() for lemma in synset.lemmas())
+
+    candidates = set(bases)
+    for pos, substitutions in wordnet.MORPHOLOGICAL_SUBSTITUTIONS.items():
+        for base in bases:
+            for old, new in substitutions:
+                if base.endswith(new):
+                    candidates.add(base[:len(base) - len(new)] + old)
+        # irregular forms, e.g. worse -> bad
+        for form, forms in exception_forms(pos).items():
+            if bases.intersection(forms):
+                candidates.add(form)
+
+    lexicon = {}
+    for form in tqdm(sorted(candidates)):
+        antonyms = word_antonyms(form)
+        if antonyms:
+            lexicon[form] = list(sorted(antonyms))
+    return lexicon
+
+def save_antonym_lexicon(lexicon, path):
+    tmp = Path(path).with_name(Path(path).name + '.tmp')
+    with open(tmp, 'w') as fp:
+        json.dump(lexicon, fp)
+    os.replace(tmp, path)
+
+def get_antonym_lexicon(path):
+    """
+    The antonym lexicon cached at path, built from WordNet on first use.
+    """
+    if not Path(path).exists():
+        save_antonym_lexicon(build_antonym_lexicon(), path)
+    with open(path) as fp:
+        return json.load(fp)
+
+def lookup_antonyms(vocab, lexicon):
+    """
+    Intersects vocab with the lexicon's forms. WordNet lookups ignore case, so
+    the words are matched lowercased but returned as they are.
+
+    return: {(word, antonym)}
+    """
+    words = np.array(list(vocab), dtype=str)
+    forms = np.array(sorted(lexicon), dtype=str)
+    if len(words) == 0 or len(forms) == 0:
+        return set()
+    lowered = np.char.lower(words)
+    found = np.isin(lowered, forms)
+    return set((w, a) for w, form in zip(words[found].tolist(), lowered[found].tolist()) for a in lexicon[form])
@@ -0,0 +1,85 @@
+from pathlib import Path
+import argparse
+import csv
+import logging
+import os
+import sys
+import time
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'alignment'))
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import AlignUtils as AU
+import ExploreUtils as EU
+from misalign import split_name
+import PoolUtils
+
+logging.basicConfig(level=logging.INFO)
+
+# ./src/analysis/antonyms.py ./data/aligners/cca/ ./data/antonyms/cca.csv --lexicon ./data/antonyms.json --workers 8
+#   writes every (source, antonym) pair whose antonym is among the k translations of the source
+
+# the lexicon is loaded before the pool is forked and shared by every worker
+LEXICON = None
+
+def get_antonym_translations(aligner, lexicon, k=1):
+    """
+    Translates each source word with an antonym once, and keeps the pairs whose
+    antonym is one of its k translations.
+
+    return: [(similarity, rank, source, antonym)], by decreasing similarity
+    """
+    antonyms = EU.get_antonyms(aligner.w2idA, lexicon)
+    if not antonyms:
+        return []
+    sources = list(sorted(set(s for s, _ in antonyms)))
+    guesses, simscores = aligner.translate_words(sources, k=k)
+    translations = {s: (gs, scr) for s, gs, scr in zip(sources, guesses, simscores)}
+
+    res = []
+    for s, t in antonyms:
+        gs, scr = translations[s]
+        if t in gs:
+            rank = gs.index(t)
+            res.append((float(scr[rank]), rank + 1, s, t))
+    return list(sorted(res, reverse=True))
+
+def scan(job):
+    aligner_file, a, b, k = job
+    start = time.time()
+    aligner = AU.load_aligner(aligner_file)
+    rows = get_antonym_translations(aligner, LEXICON, k=k)
+    return a, b, rows, time.time() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Finds the words every aligner translates to one of their antonyms.")
+    parser.add_argument('aligner_dir', type=Path, help="directory of pickled or compact aligners")
+    parser.add_argument('outfile', type=Path, help="the csv table to write")
+    parser.add_argument('--lexicon', type=Path, default=Path('data/antonyms.json'),
+                        help="antonym lexicon, extracted from WordNet if missing")
+    parser.add_argument('-k', type=int, default=1, help="number of translations to check for the antonym")
+    parser.add_argument('--workers', type=int, default=1, help="number of aligners processed at once")
+    args = parser.parse_args()
+
+    start = time.time()
+    LEXICON = EU.get_antonym_lexicon(args.lexicon)
+    logging.info(f"Loaded {len(LEXICON)} antonym forms in {time.time() - start:.1f}s")
+
+    aligner_files = AU.list_aligners(args.aligner_dir)
+    stems = set(f.stem for f in aligner_files)
+    jobs = [(f, *split_name(f.stem, stems), args.k) for f in aligner_files]
+
+    table = []
+    for a, b, rows, seconds in PoolUtils.imap_unordered(scan, jobs, args.workers):
+        table.extend((a, b, *row) for row in rows)
+        logging.info(f"{a} -> {b}: {len(rows)} antonym translations in {seconds:.2f}s")
+
+    if not os.path.exists(args.outfile.parent):
+        os.makedirs(args.outfile.parent)
+    table.sort(key=lambda row: (row[0], row[1], -row[2]))
+    tmpfile = args.outfile.with_suffix('.tmp')
+    with open(tmpfile, 'w', newline='') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(['source_community', 'target_community', 'similarity', 'rank', 'source', 'antonym'])
+        writer.writerows((a, b, f"{sim:f}", rank, s, t) for a, b, sim, rank, s, t in table)
+    os.replace(tmpfile, args.outfile)
+    logging.info(f"Wrote {len(table)} rows for {len(jobs)} pairs in {time.time() - start:.2f}s")
@@ -0,0 +1,163 @@
+from pathlib import Path
+from array import array
+import json
+import logging
+import os
+import numpy as np
+
+# A corpus manifest sits next to its corpus file:
+#   {corpus}.manifest.json  {"size", "mtime", "n_lines", "n_tokens"}
+#   {corpus}.offsets.npy    the byte offset of every line, where get_chunks cuts the corpus
+# It is valid while the corpus keeps the recorded size and mtime.
+
+def manifest_path(f):
+    f = Path(f)
+    return f.with_name(f.name + '.manifest.json')
+
+def offsets_path(f):
+    f = Path(f)
+    return f.with_name(f.name + '.offsets.npy')
+
+class ManifestWriter():
+    """
+    Records the manifest of a corpus file line by line, as the file is written or read.
+    The line offsets go to disk in blocks, so memory does not grow with the corpus.
+    """
+
+    def __init__(self, f, buffer_size=2**20):
+        """
+        f: the corpus file
+        buffer_size: the number of offsets held before they are written out
+        """
+        self.f = Path(f)
+        self.tmp = offsets_path(f).with_suffix('.tmp')
+        self.fp = open(self.tmp, 'wb')
+        self.buffer = array('q')
+        self.buffer_size = buffer_size
+        self.position = 0
+        self.n_lines = 0
+        self.n_tokens = 0
+
+    def add(self, n_bytes, n_tokens):
+        """
+        Records a line of n_bytes bytes, newline included, holding n_tokens tokens.
+        """
+        self.buffer.append(self.position)
+        self.position += n_bytes
+        self.n_lines += 1
+        self.n_tokens += n_tokens
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def add_lines(self, lengths, n_tokens):
+        """
+        Records consecutive lines of the given byte lengths, holding n_tokens tokens in all.
+        """
+        for n_bytes in lengths:
+            self.buffer.append(self.position)
+            self.position += n_bytes
+        self.n_lines += len(lengths)
+        self.n_tokens += n_tokens
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.buffer.tofile(self.fp)
+        self.buffer = array('q')
+
+    def close(self):
+        """
+        Writes {f}.offsets.npy, then {f}.manifest.json. The corpus file must be complete.
+
+        return: the manifest
+        """
+        self.flush()
+        self.fp.close()
+        if self.n_lines:
+            offsets = np.memmap(self.tmp, dtype=np.int64, mode='r', shape=(self.n_lines,))
+        else:
+            offsets = np.zeros(0, dtype=np.int64)
+        np.save(offsets_path(self.f), offsets)
+        del offsets
+        os.remove(self.tmp)
+        stat = self.f.stat()
+        assert(stat.st_size == self.position)
+        manifest = {'size': stat.st_size, 'mtime': stat.st_mtime, 'n_lines': self.n_lines, 'n_tokens': self.n_tokens}
+        with open(manifest_path(self.f), 'w') as fp:
+            json.dump(manifest, fp)
+        return manifest
+
+def build_manifest(f):
+    """
+    Builds the manifest of a corpus file in one pass.
+    """
+    writer = ManifestWriter(f)
+    with open(f, 'rb') as fp:
+        for line in fp:
+            writer.add(len(line), len(line.decode('utf-8').split()))
+    manifest = writer.close()
+    logging.info(f"Built the manifest of {Path(f).name}: {manifest['n_lines']} lines, {manifest['n_tokens']} tokens")
+    return manifest
+
+def read_manifest(f):
+    """
+    The cached manifest of a corpus file, None if there is none or the file changed since.
+    """
+    stat = Path(f).stat()
+    if manifest_path(f).exists() and offsets_path(f).exists():
+        with open(manifest_path(f)) as fp:
+            manifest = json.load(fp)
+        if manifest['size'] == stat.st_size and manifest['mtime'] == stat.st_mtime:
+            return manifest
+    return None
+
+def get_manifest(f):
+    """
+    The manifest of a corpus file, built and cached on first use or when the file changed.
+
+    return: {"size", "mtime", "n_lines", "n_tokens"}
+    """
+    manifest = read_manifest(f)
+    if manifest is None:
+        manifest = build_manifest(f)
+    return manifest
+
+def load_offsets(f):
+    """
+    The byte offset of every line of a corpus file, memory-mapped.
+    """
+    get_manifest(f)
+    return np.load(offsets_path(f), mmap_mode='r')
+
+def get_chunks(f, chunk_size=64 * 2**20):
+    """
+    Splits a file into byte ranges of about chunk_size that end on line boundaries.
+    The boundaries are looked up in the line offsets of the file's manifest if it
+    has a valid one, and found by reading the line at each cut otherwise.
+
+    f: the file to split
+    chunk_size: the target size of a range, in bytes
+
+    return: [(f, start, end)]
+    """
+    size = f.stat().st_size
+    chunks = []
+    if read_manifest(f) is not None:
+        offsets = load_offsets(f)
+        start = 0
+        while start < size:
+            # the first line starting after the cut, as readline would find it
+            i = np.searchsorted(offsets, start + chunk_size, side='right')
+            end = int(offsets[i]) if i < len(offsets) else size
+            chunks.append((f, start, end))
+            start = end
+        return chunks
+    with open(f, 'rb') as fp:
+        start = 0
+        while start < size:
+            fp.seek(min(start + chunk_size, size))
+            fp.readline()
+            end = fp.tell()
+            chunks.append((f, start, end))
+            start = end
+    return chunks
@@ -4,4 +4,4 @@ DIMS=100
 WINDOW=5
 SAMPLE='.00001'
 
-python3 $(dirname $0)/train_model.py $1 $2 $DIMS $WINDOW $SAMPLE "multi"
\ No newline at end of file
+python3 $(dirname $0)/train_model.py $1 $2 $DIMS $WINDOW $SAMPLE "multi" "${@:3}"
\ No newline at end of file
@@ -0,0 +1,116 @@
+from pathlib import Path
+from multiprocessing import cpu_count
+import argparse
+import logging
+import subprocess
+import sys
+import time
+import CorpusUtils as CU
+from train_model import ITERTOKENS, get_n_iterations
+
+logging.basicConfig(level=logging.INFO)
+
+# ./src/modeling/schedule.py ./corpus/ ./data/models/ --cores 64 --corpus-file
+
+TRAIN = Path(__file__).resolve().parent / 'train_model.py'
+
+def get_jobs(corpus_dir, model_dir):
+    """
+    One training job per community corpus, with its estimated cost in word updates.
+    Corpora whose model finished after the corpus last changed are left out.
+
+    return: [{'name', 'source', 'target', 'cost'}], most expensive first
+    """
+    jobs = []
+    for source in sorted(corpus_dir.glob("*.txt")):
+        target = model_dir / f"{source.stem}.model"
+        # train_model.py writes the stats file after saving the model
+        done = Path(f"{target}.train.json")
+        if done.exists() and done.stat().st_mtime >= source.stat().st_mtime:
+            logging.info(f"Skipping {source.stem}: already trained")
+            continue
+        n_tokens = CU.get_manifest(source)['n_tokens']
+        cost = n_tokens * get_n_iterations(n_tokens, ITERTOKENS)
+        jobs.append({'name': source.stem, 'source': source, 'target': target, 'cost': cost})
+    return list(sorted(jobs, key=lambda j: j['cost'], reverse=True))
+
+def assign_workers(jobs, cores, max_workers):
+    """
+    Gives each job a share of the cores in proportion to its cost, so that jobs
+    started together finish at about the same time.
+    """
+    total = sum(j['cost'] for j in jobs)
+    for j in jobs:
+        j['workers'] = max(1, min(max_workers, cores, round(cores * j['cost'] / total)))
+
+def run_jobs(jobs, cores, args):
+    """
+    Runs the jobs largest first, starting any pending job whose workers fit in the
+    free cores. A job that needs more cores than are free waits, unless nothing runs.
+
+    return: the names of the jobs that failed
+    """
+    pending = list(jobs)
+    running = []
+    failed = []
+    try:
+        schedule(pending, running, failed, cores, args)
+    except KeyboardInterrupt:
+        # unfinished models have no .train.json, so they are retrained on the next run
+        for _, proc, _, _ in running:
+            proc.terminate()
+        raise
+    return failed
+
+def schedule(pending, running, failed, cores, args):
+    while pending or running:
+        free = cores - sum(j['workers'] for j, _, _, _ in running)
+        for j in list(pending):
+            if j['workers'] <= free or not running:
+                cmd = [sys.executable, str(TRAIN), str(j['source']), str(j['target']),
+                       str(args.dims), str(args.window), str(args.sample), '--workers', str(j['workers'])]
+                if args.corpus_file:
+                    cmd.append('--corpus-file')
+                log = open(f"{j['target']}.log", 'w')
+                running.append((j, subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT), log, time.time()))
+                pending.remove(j)
+                free -= j['workers']
+                logging.info(f"Started {j['name']} with {j['workers']} workers ({len(pending)} pending)")
+        time.sleep(1)
+        for entry in list(running):
+            j, proc, log, start = entry
+            if proc.poll() is None:
+                continue
+            running.remove(entry)
+            log.close()
+            if proc.returncode != 0:
+                failed.append(j['name'])
+                logging.error(f"{j['name']} failed with code {proc.returncode}, see {j['target']}.log")
+            else:
+                logging.info(f"Finished {j['name']} in {time.time() - start:.0f}s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Trains one model per community corpus under a global core budget.")
+    parser.add_argument('corpus_dir', type=Path)
+    parser.add_argument('model_dir', type=Path)
+    parser.add_argument('--cores', type=int, default=cpu_count(), help="cores shared by all running jobs")
+    parser.add_argument('--max-workers', type=int, default=None,
+                        help="most workers for one job; defaults to 12, or --cores with --corpus-file")
+    parser.add_argument('--dims', type=int, default=100)
+    parser.add_argument('--window', type=int, default=5)
+    parser.add_argument('--sample', type=float, default=0.00001)
+    parser.add_argument('--corpus-file', action='store_true', help="see train_model.py --corpus-file")
+    args = parser.parse_args()
+
+    args.model_dir.mkdir(parents=True, exist_ok=True)
+    max_workers = args.max_workers
+    if max_workers is None:
+        max_workers = args.cores if args.corpus_file else 12
+
+    jobs = get_jobs(args.corpus_dir, args.model_dir)
+    if jobs:
+        assign_workers(jobs, args.cores, max_workers)
+        failed = run_jobs(jobs, args.cores, args)
+        if failed:
+            logging.error(f"Failed: {', '.join(failed)}")
+            sys.exit(1)
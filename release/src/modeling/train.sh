@@ -4,7 +4,7 @@ DIMS=100
 WINDOW=5
 SAMPLE='.00001'
 
-for src in $1/*; do
+for src in $1/*.txt; do
     target="$2/$(basename $src .txt).model"
-    python3 $(dirname $0)/train_model.py $src $target $DIMS $WINDOW $SAMPLE
+    python3 $(dirname $0)/train_model.py $src $target $DIMS $WINDOW $SAMPLE "${@:3}"
 done
\ No newline at end of file
@@ -1,20 +1,31 @@
 from pathlib import Path
 from multiprocessing import cpu_count
+import argparse
+import json
+import os
+import shutil
 import sys
+import time
 import logging
 from gensim.models.word2vec import Word2Vec
+from gensim.models.callbacks import CallbackAny2Vec
 import queue
+import CorpusUtils as CU
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import ProfileUtils as PU
 
 logging.basicConfig(level=logging.INFO)
 
+# the number of tokens each model is trained on, within 10 to 20 iterations
+ITERTOKENS = 6000000000
+
 def get_n_tokens(source_files):
-    counter = 0
-    for f in source_files:
-        with open(f, 'r') as fp:
-            for line in fp:
-                tokens = line.split()
-                counter += len(tokens)
-    return counter
+    # read from the cached corpus manifests, built on first use
+    with PU.stage('train:n_tokens', unit='tokens') as s:
+        n_tokens = sum(CU.get_manifest(f)['n_tokens'] for f in source_files)
+        s.items = n_tokens
+    return n_tokens
 
 def iterfile(f_in):
     with open(f_in) as fp:
@@ -60,61 +71,156 @@ class FileIter():
         else:
             return line.split()
             
-def train(f_in, f_out, opts):
-    n_tokens = get_n_tokens([f_in])
-    n_iterations = max(10,min(20,int(opts['itertokens'] / n_tokens)))
+def corpus_inputs(f_ins):
+    """
+    Identifies the corpora a concatenated corpus is built from, by path, size and mtime.
+    """
+    return [[str(f), f.stat().st_size, f.stat().st_mtime] for f in f_ins]
+
+def get_multi_corpus(f_ins, f_out):
+    """
+    Concatenates community corpora into a single LineSentence file for corpus_file
+    training. The corpora it was built from are recorded in {f_out}.inputs.json,
+    and the file is reused while they are the same, unchanged files.
+    
+    f_ins: the community corpora
+    f_out: the concatenated corpus
+    
+    return: f_out
+    """
+    inputs = corpus_inputs(f_ins)
+    inputs_file = f_out.with_name(f_out.name + '.inputs.json')
+    if f_out.exists() and inputs_file.exists():
+        with open(inputs_file) as fp:
+            if json.load(fp) == inputs:
+                return f_out
+        # a build cut short must not leave the record of a previous one
+        os.remove(inputs_file)
+    tmp = f_out.with_name(f_out.name + '.tmp')
+    with open(tmp, 'wb') as out:
+        for f in f_ins:
+            with open(f, 'rb') as fp:
+                shutil.copyfileobj(fp, out, 16 * 2**20)
+            # keep the last line of one corpus apart from the first of the next
+            if f.stat().st_size > 0:
+                with open(f, 'rb') as fp:
+                    fp.seek(-1, os.SEEK_END)
+                    if fp.read(1) != b'\n':
+                        out.write(b'\n')
+    os.replace(tmp, f_out)
+    with open(inputs_file, 'w') as fp:
+        json.dump(inputs, fp)
+    return f_out
+
+class EpochRecorder(CallbackAny2Vec):
+    """
+    Records every training epoch as a ProfileUtils stage.
+    """
+    def __init__(self, n_tokens):
+        self.n_tokens = n_tokens
+        self.epoch = 0
+        self.stage = None
+
+    def on_epoch_begin(self, model):
+        self.stage = PU.stage('train:epoch', items=self.n_tokens, unit='words', epoch=self.epoch)
+        self.stage.__enter__()
+
+    def on_epoch_end(self, model):
+        self.stage.__exit__(None, None, None)
+        self.stage = None
+        self.epoch += 1
+
+def get_n_iterations(n_tokens, itertokens):
+    return max(10,min(20,int(itertokens / n_tokens)))
+
+def fit(f_out, n_tokens, opts, sentences=None, corpus_file=None):
+    n_iterations = get_n_iterations(n_tokens, opts['itertokens'])
     
-    model = Word2Vec()
-    model = Word2Vec(sentences=FileIter(f_in),
-                    size=opts['dims'],
-                    window=opts['window'],
-                    workers=opts['n_cpu'],
-                    sg=1,
-                    hs=0,
-                    negative=5,
-                    min_count=opts['min_count'],
-                    max_final_vocab=opts['vocab'],
-                    sample=opts['sample'],
-                    iter=n_iterations)
+    start = time.time()
+    callbacks = [EpochRecorder(n_tokens)] if PU.enabled() else []
+    with PU.stage('train:fit', items=n_tokens * n_iterations, unit='words', workers=opts['n_cpu']):
+        model = Word2Vec(sentences=sentences,
+                        corpus_file=None if corpus_file is None else str(corpus_file),
+                        size=opts['dims'],
+                        window=opts['window'],
+                        workers=opts['n_cpu'],
+                        sg=1,
+                        hs=0,
+                        negative=5,
+                        min_count=opts['min_count'],
+                        max_final_vocab=opts['vocab'],
+                        sample=opts['sample'],
+                        iter=n_iterations,
+                        callbacks=callbacks)
+    seconds = time.time() - start
     
+    # the callbacks would be pickled with the model, and unpickling them needs this script
+    model.callbacks = ()
     model.save(str(f_out))
+    stats = {'mode': 'iterator' if corpus_file is None else 'corpus_file',
+             'workers': opts['n_cpu'],
+             'n_tokens': n_tokens,
+             'iterations': n_iterations,
+             'seconds': seconds,
+             'words_per_sec': n_tokens * n_iterations / seconds}
+    with open(f"{f_out}.train.json", 'w') as fp:
+        json.dump(stats, fp)
+    logging.info(f"Trained on {n_tokens} tokens x {n_iterations} iterations in {seconds:.1f}s: "
+                 f"{stats['words_per_sec']:.0f} words/sec with {opts['n_cpu']} workers")
+    return model
+            
+def train(f_in, f_out, opts):
+    n_tokens = get_n_tokens([f_in])
+    if opts['corpus_file']:
+        fit(f_out, n_tokens, opts, corpus_file=f_in)
+    else:
+        fit(f_out, n_tokens, opts, sentences=FileIter(f_in))
     logging.info(f"Completed embedding from: {f_in.stem}")
     
 def train_multi(dir_in, f_out, opts):
-    f_ins = list(dir_in.glob("*.txt"))
+    f_ins = list(sorted(dir_in.glob("*.txt")))
     n_tokens = get_n_tokens(f_ins)
-    n_iterations = max(10,min(20,int(opts['itertokens'] / n_tokens)))
-    
-    model = Word2Vec()
-    model = Word2Vec(sentences=MultiFileIter(f_ins),
-                    size=opts['dims'],
-                    window=opts['window'],
-                    workers=opts['n_cpu'],
-                    sg=1,
-                    hs=0,
-                    negative=5,
-                    min_count=opts['min_count'],
-                    max_final_vocab=opts['vocab'],
-                    sample=opts['sample'],
-                    iter=n_iterations)
-    
-    model.save(str(f_out))
+    if opts['corpus_file']:
+        corpus = get_multi_corpus(f_ins, dir_in.parent / f"{dir_in.name}.multi.txt")
+        fit(f_out, n_tokens, opts, corpus_file=corpus)
+    else:
+        fit(f_out, n_tokens, opts, sentences=MultiFileIter(f_ins))
     logging.info(f"Completed embedding from: {dir_in.stem}")
     
 if __name__ == "__main__":    
-    source_file = Path(sys.argv[1])
-    target_file = Path(sys.argv[2])
+    parser = argparse.ArgumentParser(description="Trains a word2vec model on a community corpus.")
+    parser.add_argument('source', type=Path, help="the corpus file, or a directory of corpora in multi mode")
+    parser.add_argument('target', type=Path, help="the model file to write")
+    parser.add_argument('dims', type=int)
+    parser.add_argument('window', type=int)
+    parser.add_argument('sample', type=float)
+    parser.add_argument('mode', nargs='?', choices=['multi'], help="train one model on every corpus in source")
+    parser.add_argument('--corpus-file', action='store_true',
+                        help="let gensim's worker threads read the LineSentence corpus directly")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="training threads; defaults to all cores with --corpus-file, else at most 12")
+    args = parser.parse_args()
+    
+    source_file = args.source
+    target_file = args.target
     opts = {}
     
-    opts['dims'] = int(sys.argv[3])
-    opts['window'] = int(sys.argv[4])
-    opts['n_cpu'] = min(cpu_count(), 12)
+    opts['dims'] = args.dims
+    opts['window'] = args.window
+    opts['corpus_file'] = args.corpus_file
+    if args.workers is not None:
+        opts['n_cpu'] = args.workers
+    elif args.corpus_file:
+        opts['n_cpu'] = cpu_count()
+    else:
+        # python iterator training stops scaling long before this
+        opts['n_cpu'] = min(cpu_count(), 12)
     opts['vocab'] = 15000
-    opts['sample'] = float(sys.argv[5])
-    opts['itertokens'] = 6000000000
+    opts['sample'] = args.sample
+    opts['itertokens'] = ITERTOKENS
     opts['min_count']= 100
     
-    if len(sys.argv) > 6 and sys.argv[6] == 'multi':
+    if args.mode == 'multi':
         train_multi(source_file, target_file, opts)
     else:
-        train(source_file, target_file, opts)
\ No newline at end of file
+        train(source_file, target_file, opts)
@@ -0,0 +1,190 @@
+from pathlib import Path
+import sys
+import json
+import time
+import hashlib
+import logging
+import subprocess
+import os
+
+logging.basicConfig(level=logging.INFO)
+
+# ./src/pipeline.py pipeline.json
+#
+# Runs preprocessing -> counts -> training -> alignment, skipping every stage whose
+# inputs and parameters hash to the same key as in the last run. Example config:
+# {"raw": "corpora/raw", "work": "work", "workers": 8,
+#  "phraseseq": [[5, 100]],
+#  "train": {"dims": 100, "window": 5, "sample": 0.00001},
+#  "align": {"method": "svd", "k": -1}}
+# PROFILE_LOG and PROFILE_DIR (see ProfileUtils.py) are inherited by every stage.
+
+SRC = Path(__file__).resolve().parent
+PREPROCESSING = SRC.parent / 'example' / 'preprocessing.py'
+COUNTS = SRC / 'stats' / 'counts.py'
+TRAIN = SRC / 'modeling' / 'train_model.py'
+ALIGN = SRC / 'alignment' / 'align.py'
+
+class Manifest():
+    """
+    The keys, outputs and timings of the stages run in a work directory, and a
+    cache of file hashes keyed by size and mtime.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.data = {'stages': {}, 'hashes': {}}
+        if self.path.exists():
+            with open(self.path) as fp:
+                self.data = json.load(fp)
+        self.timings = []
+
+    def save(self):
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp, 'w') as fp:
+            json.dump(self.data, fp, indent=1)
+        os.replace(tmp, self.path)
+
+    def file_hash(self, path):
+        """
+        The sha256 of a file's content, rehashed only when its size or mtime changed.
+        """
+        path = Path(path)
+        stat = path.stat()
+        cached = self.data['hashes'].get(str(path))
+        if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime]:
+            return cached[2]
+        h = hashlib.sha256()
+        with open(path, 'rb') as fp:
+            for block in iter(lambda: fp.read(2**20), b''):
+                h.update(block)
+        self.data['hashes'][str(path)] = [stat.st_size, stat.st_mtime, h.hexdigest()]
+        return h.hexdigest()
+
+    def key(self, inputs, params):
+        """
+        Hashes the content of the input files together with the stage parameters.
+        """
+        h = hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf8'))
+        for path in sorted(str(p) for p in inputs):
+            h.update(path.encode('utf8'))
+            h.update(self.file_hash(path).encode('utf8'))
+        return h.hexdigest()
+
+    def is_fresh(self, stage, key):
+        record = self.data['stages'].get(stage)
+        if record is None or record['key'] != key:
+            return False
+        return all(Path(p).exists() for p in record['outputs'])
+
+    def record(self, stage, key, outputs, seconds):
+        self.data['stages'][stage] = {'key': key, 'outputs': [str(p) for p in outputs],
+                                      'seconds': seconds, 'finished': time.time()}
+        self.timings.append((stage, seconds))
+        self.save()
+
+def run(cmd, **kwargs):
+    logging.info(' '.join(str(c) for c in cmd))
+    subprocess.run([str(c) for c in cmd], check=True, **kwargs)
+
+def model_files(model):
+    """
+    A saved gensim model and the arrays gensim stored next to it.
+    """
+    return list(sorted(model.parent.glob(model.name + '*')))
+
+def run_stage(manifest, stage, inputs, params, outputs, action):
+    """
+    Runs action unless the stage's key and outputs are unchanged since the last run.
+
+    return: True if the stage ran
+    """
+    key = manifest.key(inputs, params)
+    if manifest.is_fresh(stage, key):
+        logging.info(f"{stage}: up to date")
+        return False
+    start = time.time()
+    action()
+    manifest.record(stage, key, outputs, time.time() - start)
+    logging.info(f"{stage}: done in {time.time() - start:.1f}s")
+    return True
+
+def align_pairs(manifest, names, models, counts, target, align, workers):
+    """
+    Rebuilds the aligner of every pair whose key changed, in one run of align.py.
+    """
+    # an aligner is rebuilt only if either model, either count file or the method changed
+    stale = []
+    keys = {}
+    for a in names:
+        for b in names:
+            if a == b:
+                continue
+            inputs = model_files(models / f"{a}.model") + model_files(models / f"{b}.model")
+            inputs += [counts / f"{n}.{part}.npy" for n in [a, b] for part in ['words', 'counts']]
+            keys[(a, b)] = manifest.key(inputs, align)
+            if not manifest.is_fresh(f"align:{a}:{b}", keys[(a, b)]):
+                stale.append((a, b))
+    if stale:
+        start = time.time()
+        run([sys.executable, ALIGN, models, target, counts, align['method'], align['k'],
+             '--workers', workers, '--force', '--pairs', *[f"{a}:{b}" for a, b in stale]])
+        seconds = (time.time() - start) / len(stale)
+        for a, b in stale:
+            manifest.record(f"align:{a}:{b}", keys[(a, b)], [target / f"{a}2{b}.pkl"], seconds)
+    logging.info(f"align: {len(stale)} of {len(keys)} pairs rebuilt")
+
+def main(config):
+    raw = Path(config['raw']).resolve()
+    work = Path(config['work']).resolve()
+    workers = config.get('workers', os.cpu_count())
+    prep, counts, models, aligners = work / 'prep', work / 'counts', work / 'models', work / 'aligners'
+    for d in [prep, counts, models, aligners, work / 'data']:
+        if not os.path.exists(d):
+            os.makedirs(d)
+    manifest = Manifest(work / 'pipeline.json')
+
+    # the phraser is learned from every corpus, so preprocessing is one stage
+    sources = list(sorted(raw.glob('*.txt')))
+    names = [s.stem for s in sources]
+    phraseseq = config.get('phraseseq', [[5, 100]])
+    run_stage(manifest, 'preprocess', sources, {'phraseseq': phraseseq},
+              [prep / s.name for s in sources],
+              lambda: run([sys.executable, PREPROCESSING, raw, prep, workers, 10000, json.dumps(phraseseq)], cwd=work))
+
+    # counts and models are per community, keyed on the content of its phrased corpus
+    for name in names:
+        corpus = prep / f"{name}.txt"
+        run_stage(manifest, f"counts:{name}", [corpus], {},
+                  [counts / f"{name}.words.npy", counts / f"{name}.counts.npy"],
+                  lambda: run([sys.executable, COUNTS, corpus, counts, workers]))
+
+    train = config.get('train', {'dims': 100, 'window': 5, 'sample': 0.00001})
+    for name in names:
+        corpus = prep / f"{name}.txt"
+        model = models / f"{name}.model"
+        run_stage(manifest, f"train:{name}", [corpus], train, [model],
+                  lambda: run([sys.executable, TRAIN, corpus, model, train['dims'], train['window'], train['sample']]))
+
+    align = config.get('align', {'method': 'svd', 'k': -1})
+    if align['method'] == 'joint':
+        # the joint maps are fitted over every model at once, so they are one stage
+        inputs = [f for n in names for f in model_files(models / f"{n}.model")]
+        inputs += [counts / f"{n}.{part}.npy" for n in names for part in ['words', 'counts']]
+        target = aligners / 'joint'
+        outputs = [target / 'joint.npz'] + [target / f"{a}2{b}.pkl" for a in names for b in names if a != b]
+        run_stage(manifest, 'align:joint', inputs, align, outputs,
+                  lambda: run([sys.executable, ALIGN, models, target, counts, 'joint', align['k'], '--force']))
+    else:
+        align_pairs(manifest, names, models, counts, aligners / align['method'], align, workers)
+
+    manifest.save()
+    for stage, seconds in manifest.timings:
+        logging.info(f"{stage:40s} {seconds:10.1f}s")
+    logging.info(f"{len(manifest.timings)} stages run, {sum(s for _, s in manifest.timings):.1f}s in total")
+
+if __name__ == "__main__":
+    assert(len(sys.argv) == 2)
+    with open(sys.argv[1]) as fp:
+        config = json.load(fp)
+    main(config)
@@ -0,0 +1,96 @@
+from pathlib import Path
+import os
+import numpy as np
+
+class Counts():
+    """
+    The token counts of one community: a sorted vocabulary and a parallel count array.
+    """
+
+    def __init__(self, words, counts):
+        """
+        words: the vocabulary, sorted
+        counts: counts[i] is the number of occurrences of words[i]
+        """
+        self.words = words
+        self.counts = counts
+
+    @classmethod
+    def from_dict(cls, counts):
+        words = np.array(sorted(counts))
+        return cls(words, np.array([counts[w] for w in words.tolist()], dtype=np.int64))
+
+    def lookup(self, words):
+        """
+        The count of each of words, 0 for words outside the vocabulary.
+        """
+        words = np.asarray(words)
+        if len(self.words) == 0:
+            return np.zeros(len(words), dtype=np.int64)
+        idx = np.searchsorted(self.words, words)
+        idx[idx == len(self.words)] = 0
+        found = self.words[idx] == words
+        return np.where(found, self.counts[idx], 0)
+
+def save_counts(directory, name, counts):
+    """
+    Writes the counts of community name to {name}.words.npy and {name}.counts.npy.
+    """
+    directory = Path(directory)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    for path, array in [(directory / f"{name}.words.npy", counts.words.astype(str)),
+                        (directory / f"{name}.counts.npy", np.asarray(counts.counts, dtype=np.int64))]:
+        tmp = path.with_name(path.name + '.tmp')
+        with open(tmp, 'wb') as fp:
+            np.save(fp, array)
+        os.replace(tmp, path)
+
+def load_counts(directory, name, mmap_mode='r'):
+    """
+    Opens the counts of community name, memory-mapping both arrays.
+    """
+    directory = Path(directory)
+    words = np.load(directory / f"{name}.words.npy", mmap_mode=mmap_mode)
+    counts = np.load(directory / f"{name}.counts.npy", mmap_mode=mmap_mode)
+    return Counts(words, counts)
+
+def rank_anchors(shared, counts_a, counts_b, k=None):
+    """
+    Ranks the shared vocabulary by its combined count in two communities.
+
+    shared: the shared vocabulary, sorted
+    counts_a: the Counts of the first community
+    counts_b: the Counts of the second community
+    k: keep only the k most frequent words, None to keep all
+
+    return: the words by decreasing combined count; ties keep their order in shared
+    """
+    return rank_shared(shared, [counts_a, counts_b], k)
+
+def rank_shared(shared, counts, k=None):
+    """
+    Ranks the shared vocabulary by its combined count in any number of communities.
+
+    shared: the shared vocabulary, sorted
+    counts: the Counts of each community
+    k: keep only the k most frequent words, None to keep all
+
+    return: the words by decreasing combined count; ties keep their order in shared
+    """
+    shared = np.asarray(shared)
+    totals = np.zeros(len(shared), dtype=np.int64)
+    for c in counts:
+        totals += c.lookup(shared)
+    if k is None or k >= len(shared):
+        order = np.argsort(-totals, kind='stable')
+    elif k <= 0:
+        order = np.array([], dtype=np.int64)
+    else:
+        # partial selection of the k largest, taking tied words at the cut in shared order
+        kth = np.partition(totals, len(totals) - k)[len(totals) - k]
+        above = np.flatnonzero(totals > kth)
+        ties = np.flatnonzero(totals == kth)[:k - len(above)]
+        selected = np.sort(np.concatenate([above, ties]))
+        order = selected[np.argsort(-totals[selected], kind='stable')]
+    return shared[order].tolist()
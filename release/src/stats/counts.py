@@ -1,25 +1,70 @@
 from pathlib import Path
 from collections import Counter
+from multiprocessing import Pool, cpu_count
 import sys
+import time
+import logging
 from tqdm import tqdm
 import json
+import CountUtils as CU
 
-corpus = Path(sys.argv[1])
-outfile = Path(sys.argv[2])
-
-counts = {}
-fs = list(corpus.glob("*.txt"))
-print(fs)
-for f in fs:
-    name = f.stem
-    counts[name] = {}
-    
-    with open(f) as fp:
-        for line in tqdm(fp):
-            hist = Counter(line.split())
-            for k in hist:
-                if k not in counts[name]:
-                    counts[name][k] = 0
-                counts[name][k] += hist[k]
-                
-json.dump(counts, open(outfile, 'w'))
\ No newline at end of file
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'modeling'))
+from CorpusUtils import get_chunks
+
+logging.basicConfig(level=logging.INFO)
+
+# ./src/stats/counts.py ./corpus/ ./data/counts.json [n_workers]
+# ./src/stats/counts.py ./corpus/ ./data/counts/ [n_workers]
+# ./src/stats/counts.py ./corpus/politics.txt ./data/counts/ [n_workers]
+#   writes {name}.words.npy and {name}.counts.npy per community instead of one json
+
+# bytes of text counted by one worker at a time
+CHUNK_SIZE = 64 * 2**20
+
+def count_chunk(chunk):
+    f, start, end = chunk
+    with open(f, 'rb') as fp:
+        fp.seek(start)
+        text = fp.read(end - start).decode('utf-8')
+    return f.stem, end - start, Counter(text.split())
+
+def count_files(fs, n_workers=cpu_count(), chunk_size=CHUNK_SIZE):
+    """
+    Counts the whitespace-separated tokens of each file, in parallel over chunks.
+
+    fs: the files to count
+    n_workers: the number of counting processes
+    chunk_size: the size of the byte range counted by one task
+
+    return: {file stem: {token: count}}
+    """
+    chunks = [c for f in fs for c in get_chunks(f, chunk_size)]
+    total = sum(end - start for _, start, end in chunks)
+    counts = {f.stem: Counter() for f in fs}
+
+    start = time.time()
+    with Pool(n_workers) as pool, tqdm(total=total, unit='B', unit_scale=True) as progress:
+        for name, n_bytes, hist in pool.imap_unordered(count_chunk, chunks):
+            counts[name].update(hist)
+            progress.update(n_bytes)
+    elapsed = max(time.time() - start, 1e-9)
+    n_tokens = sum(sum(c.values()) for c in counts.values())
+    logging.info(f"Counted {n_tokens} tokens in {total / 2**20:.1f} MB over {len(chunks)} chunks "
+                 f"in {elapsed:.1f}s: {total / 2**20 / elapsed:.1f} MB/s, {n_tokens / elapsed:.0f} tokens/s")
+    return {name: dict(c) for name, c in counts.items()}
+
+if __name__ == "__main__":
+    assert(len(sys.argv) in [3, 4])
+    corpus = Path(sys.argv[1])
+    outfile = Path(sys.argv[2])
+    n_workers = int(sys.argv[3]) if len(sys.argv) == 4 else cpu_count()
+
+    # a single corpus file counts just that community
+    fs = [corpus] if corpus.is_file() else list(sorted(corpus.glob("*.txt")))
+    print(fs)
+    counts = count_files(fs, n_workers=n_workers)
+    if outfile.suffix == '.json':
+        json.dump(counts, open(outfile, 'w'))
+    else:
+        for name in counts:
+            CU.save_counts(outfile, name, CU.Counts.from_dict(counts[name]))
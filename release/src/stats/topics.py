@@ -1,43 +1,231 @@
 from pathlib import Path
+import argparse
 import sys
 import json
+import os
+import tempfile
+import time
 
 import numpy as np
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from threadpoolctl import threadpool_limits
 from gensim.models.word2vec import Word2Vec
 
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'alignment'))
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+import AlignUtils as AU
+import EmbeddingStore as ES
+import PoolUtils
+
 import logging
 
 logging.basicConfig(level=logging.INFO)
 
+# ./src/stats/topics.py ./data/models/politics.model ./data/topics/politics.json
+# ./src/stats/topics.py politics ./data/topics/politics.json --store ./data/store/ --minibatch -k 50 100 200 --workers 3
+# ./src/stats/topics.py politics ./data/topics/joint.json --store ./data/store/ --minibatch \
+#     --joint ./data/aligners/svd/ --communities politics news sports
+#   clusters the three communities together in the space of politics; words are written as {community}:{word}
+
+# rows read by one mini-batch update, and by one labelling pass
+BATCH_SIZE = 4096
+BLOCK_SIZE = 2**16
+
+# the matrix and words clustered by the sweep, set before the pool is forked
+VECTORS = None
+WORDS = None
+
 def build_matrix(modelfile):
     model = Word2Vec.load(str(modelfile))
     vocab = list(sorted(list(model.wv.vocab)))
     mtx = np.vstack([model.wv[w] for w in vocab])
     return mtx, vocab
-    
-def get_clusters(mtx, wordlist):
-    clustering = KMeans(n_clusters=100).fit(mtx)
+
+def group_words(labels, wordlist):
     res = {}
-    for c, w in zip(clustering.labels_, wordlist):
+    for c, w in zip(labels, wordlist):
         c = str(c)
         if c not in res:
             res[c] = []
         res[c].append(w)
+    return res
+
+def get_clusters(mtx, wordlist, k=100):
+    clustering = KMeans(n_clusters=k).fit(mtx)
+    res = group_words(clustering.labels_, wordlist)
     logging.info(f"{len(res)} clusters.")
     logging.info(f"{sum(map(len, res.values()))} words.")
     return res
 
+def label_blocks(clustering, mtx, block_size=BLOCK_SIZE):
+    """
+    Assigns every row to its nearest centre, reading the matrix one block at a time.
+
+    return: (labels, inertia)
+    """
+    labels = np.empty(mtx.shape[0], dtype=np.int32)
+    inertia = 0.
+    centers = clustering.cluster_centers_
+    for start in range(0, mtx.shape[0], block_size):
+        block = np.asarray(mtx[start:start + block_size], dtype=centers.dtype)
+        labels[start:start + block_size] = clustering.predict(block)
+        inertia += float(((block - centers[labels[start:start + block_size]]) ** 2).sum())
+    return labels, inertia
+
+def minibatch_kmeans(mtx, k, batch_size=BATCH_SIZE, n_epochs=3, seed=0):
+    """
+    Clusters the rows of a (memory-mapped) matrix with mini-batch k-means, streaming
+    contiguous batches in a new random order every epoch.
+
+    mtx: the matrix to cluster, only read one batch at a time
+    k: the number of clusters
+    batch_size: the rows per update; raised to 3k so the first batch can seed k centres
+    n_epochs: the number of passes over the matrix
+
+    return: (labels, inertia)
+    """
+    batch_size = max(batch_size, 3 * k)
+    clustering = MiniBatchKMeans(n_clusters=k, batch_size=batch_size, random_state=seed, n_init=3)
+    rng = np.random.RandomState(seed)
+    starts = np.arange(0, mtx.shape[0], batch_size)
+    for epoch in range(n_epochs):
+        for start in rng.permutation(starts):
+            clustering.partial_fit(np.asarray(mtx[start:start + batch_size], dtype=np.float32))
+    return label_blocks(clustering, mtx)
+
+def cluster_k(job):
+    """
+    Clusters VECTORS into k clusters, fully or with mini-batches.
+
+    return: (k, labels, inertia, seconds)
+    """
+    k, opts = job
+    start = time.time()
+    # workers share the cores, so each one clusters on a single thread
+    with threadpool_limits(limits=1 if opts['workers'] > 1 else None):
+        if opts['minibatch']:
+            labels, inertia = minibatch_kmeans(VECTORS, k, batch_size=opts['batch_size'],
+                                               n_epochs=opts['epochs'], seed=opts['seed'])
+        else:
+            clustering = KMeans(n_clusters=k, random_state=opts['seed']).fit(VECTORS)
+            labels, inertia = clustering.labels_, float(clustering.inertia_)
+    return k, labels, inertia, time.time() - start
+
+def find_aligner(aligner_dir, name_a, name_b):
+    for path in AU.list_aligners(aligner_dir):
+        if path.stem == f"{name_a}2{name_b}":
+            return path
+    raise FileNotFoundError(f"no aligner {name_a}2{name_b} in {aligner_dir}")
+
+def project_joint(aligner_dir, pivot, communities, outfile, block_size=BLOCK_SIZE):
+    """
+    Maps every community into the space of pivot through its aligner {c}2{pivot},
+    writing the rows of all communities into one memory-mapped matrix.
+
+    return: (matrix, words), the words labelled {community}:{word}
+    """
+    aligners = {}
+    for c in communities:
+        if c != pivot:
+            aligners[c] = AU.load_aligner(find_aligner(aligner_dir, c, pivot))
+            if isinstance(aligners[c], AU.CCAAligner):
+                raise ValueError("CCA aligners map each pair into its own space; use svd or lstsq aligners")
+    if not aligners:
+        raise ValueError("a joint clustering needs at least one community besides the pivot")
+
+    # the pivot's own rows are the target space of any of its aligners
+    spaces = []
+    for c in communities:
+        if c == pivot:
+            aligner = next(iter(aligners.values()))
+            vocab = [aligner.id2wB[i] for i in range(len(aligner.id2wB))]
+            spaces.append((c, vocab, aligner.target_space(), None))
+        else:
+            aligner = aligners[c]
+            vocab = sorted(aligner.w2idA, key=aligner.w2idA.get)
+            spaces.append((c, vocab, aligner.source_space(), aligner))
+
+    n_rows = sum(len(vocab) for _, vocab, _, _ in spaces)
+    dims = spaces[0][2].shape[1]
+    mtx = np.lib.format.open_memmap(outfile, mode='w+', dtype=np.float32, shape=(n_rows, dims))
+    words = []
+    offset = 0
+    for c, vocab, space, aligner in spaces:
+        for start in range(0, len(vocab), block_size):
+            block = np.asarray(space[start:start + block_size])
+            if aligner is not None:
+                block = aligner.translate_mtx(block)
+            mtx[offset + start:offset + start + len(block)] = block
+        words.extend(f"{c}:{w}" for w in vocab)
+        offset += len(vocab)
+        logging.info(f"Projected {len(vocab)} words of {c} into {pivot}")
+    mtx.flush()
+    return np.load(outfile, mmap_mode='r'), words
+
+def sweep(ks, opts):
+    """
+    Clusters VECTORS once per k, opts['workers'] values of k at a time.
+
+    return: {k: (labels, inertia, seconds)}
+    """
+    jobs = [(k, opts) for k in ks]
+    res = {}
+    for k, labels, inertia, seconds in PoolUtils.imap_unordered(cluster_k, jobs, opts['workers']):
+        res[k] = (labels, inertia, seconds)
+        logging.info(f"k={k}: inertia {inertia:.1f} in {seconds:.1f}s")
+    return res
+
+def get_outfile(outfile, k, ks):
+    """
+    The cluster file of k: outfile itself for a single k, {outfile}.k{k}.json in a sweep.
+    """
+    if len(ks) == 1:
+        return outfile
+    return outfile.with_name(f"{outfile.stem}.k{k}{outfile.suffix}")
+
 if __name__ == "__main__":
-    embedding_file = Path(sys.argv[1])
-    outfile = Path(sys.argv[2])
-    
-    mtx, wordlist = build_matrix(embedding_file)
-    logging.info("Built matrix")
-    
-    clusters = get_clusters(mtx, wordlist)
-    logging.info("Computed clusters")
-    
-    json.dump(clusters, open(outfile, 'w'))
+    parser = argparse.ArgumentParser(description="Clusters the vocabulary of one or several communities with k-means.")
+    parser.add_argument('source', help="a gensim model file, or a community name with --store")
+    parser.add_argument('outfile', type=Path)
+    parser.add_argument('-k', type=int, nargs='+', default=[100], help="the numbers of clusters to sweep")
+    parser.add_argument('--minibatch', action='store_true',
+                        help="stream mini-batches over the vectors instead of full-batch k-means")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--epochs', type=int, default=3, help="passes over the vectors with --minibatch")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1, help="number of k values clustered at once")
+    parser.add_argument('--store', type=Path, default=None, help="embedding store to memory-map the vectors from")
+    parser.add_argument('--joint', type=Path, default=None, metavar='ALIGNER_DIR',
+                        help="cluster --communities together in the space of source, through svd or lstsq aligners")
+    parser.add_argument('--communities', nargs='+', default=[], help="the communities clustered with --joint")
+    args = parser.parse_args()
+    opts = {'minibatch': args.minibatch, 'batch_size': args.batch_size, 'epochs': args.epochs,
+            'seed': args.seed, 'workers': args.workers}
+
+    if not os.path.exists(args.outfile.parent):
+        os.makedirs(args.outfile.parent)
+
+    with tempfile.TemporaryDirectory(dir=args.outfile.parent) as tmpdir:
+        start = time.time()
+        if args.joint is not None:
+            communities = list(dict.fromkeys([args.source] + args.communities))
+            VECTORS, WORDS = project_joint(args.joint, args.source, communities, Path(tmpdir) / 'joint.npy')
+        elif args.store is not None:
+            embedding = ES.EmbeddingStore(args.store).get(args.source)
+            VECTORS, WORDS = embedding.vectors, embedding.words.tolist()
+        else:
+            VECTORS, WORDS = build_matrix(args.source)
+        logging.info(f"Built matrix of {VECTORS.shape[0]} words in {time.time() - start:.1f}s")
+
+        results = sweep(args.k, opts)
+        logging.info("Computed clusters")
+
+    stats = {}
+    for k in args.k:
+        labels, inertia, seconds = results[k]
+        clusters = group_words(labels, WORDS)
+        json.dump(clusters, open(get_outfile(args.outfile, k, args.k), 'w'))
+        stats[str(k)] = {'inertia': inertia, 'seconds': seconds, 'n_clusters': len(clusters)}
+        logging.info(f"k={k}: {len(clusters)} clusters, {sum(map(len, clusters.values()))} words.")
+    json.dump(stats, open(args.outfile.with_name(f"{args.outfile.stem}.stats.json"), 'w'), indent=1)
     logging.info("Saved.")
-    
\ No newline at end of file
@@ -0,0 +1,126 @@
+from pathlib import Path
+import os
+import pickle
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'src' / 'alignment'))
+import AlignUtils as AU
+import EmbeddingStore as ES
+
+# python -m pytest -q ./tests
+#   saving and loading aligners: pickles, the compact format and embedding stores
+
+FACTORIES = {'svd': AU.get_svd_aligner,
+             'lstsq': AU.get_lstsq_aligner,
+             'cca': AU.get_cca_aligner}
+
+def embeddings(names, n_words=120, dims=6, seed=0):
+    rng = np.random.RandomState(seed)
+    words = np.array([f"w{i:03d}" for i in range(n_words)])
+    return {name: ES.Embedding(name, words, rng.randn(n_words, dims).astype(np.float32)) for name in names}
+
+def assert_same_translations(aligner, loaded, words):
+    expected, expected_sims = aligner.translate_words(words, k=3)
+    res, sims = loaded.translate_words(words, k=3)
+    assert(res == expected)
+    assert(np.allclose(sims, expected_sims, atol=1e-5))
+
+@pytest.mark.parametrize('method', list(FACTORIES))
+def test_compact_round_trip(method, tmp_path):
+    embs = embeddings(['a', 'b'])
+    words = embs['a'].words.tolist()
+    aligner = FACTORIES[method](embs['a'], embs['b'], None, words[:60])
+    AU.save_compact(aligner, tmp_path / 'a2b')
+    assert(AU.list_aligners(tmp_path) == [tmp_path / 'a2b'])
+
+    loaded = AU.load_aligner(tmp_path / 'a2b')
+    assert(type(loaded) is type(aligner))
+    assert(loaded.anchors == words[:60])
+    assert(isinstance(loaded.mtxA, np.memmap) and isinstance(loaded.mtxB, np.memmap))
+    assert(loaded.w2idA == aligner.w2idA and loaded.id2wB == aligner.id2wB)
+    assert_same_translations(aligner, loaded, words[::5])
+
+def test_compact_replaces_previous_save(tmp_path):
+    embs = embeddings(['a', 'b'])
+    words = embs['a'].words.tolist()
+    AU.save_compact(AU.get_svd_aligner(embs['a'], embs['b'], None, words[:10]), tmp_path / 'a2b')
+    aligner = AU.get_svd_aligner(embs['a'], embs['b'], None, words[:80])
+    AU.save_compact(aligner, tmp_path / 'a2b')
+    loaded = AU.load_aligner(tmp_path / 'a2b')
+    assert(np.allclose(loaded.T, aligner.T))
+    assert(not (tmp_path / 'a2b.tmp').exists())
+
+def store_aligners(store, names, method='svd'):
+    aligners = {}
+    for a in names:
+        for b in names:
+            if a != b:
+                emb_a, emb_b = store.get(a), store.get(b)
+                aligner = FACTORIES[method](emb_a, emb_b, None, emb_a.words[:60].tolist())
+                aligner.bind_store(store, a, b)
+                aligners[f"{a}2{b}"] = aligner
+    return aligners
+
+def test_store_aligners_share_targets(tmp_path):
+    store = ES.EmbeddingStore(tmp_path / 'store')
+    for emb in embeddings(['a', 'b', 'c']).values():
+        store.save(emb)
+    aligners = store_aligners(store, ['a', 'b', 'c'])
+    for aligner in aligners.values():
+        aligner.translate_words(['w001', 'w002'], k=2)
+    assert(aligners['a2b'].target_matrix() is aligners['c2b'].target_matrix())
+    assert(aligners['a2c'].target_matrix() is aligners['b2c'].target_matrix())
+    assert(isinstance(aligners['a2b'].target_matrix(), np.memmap))
+    assert(np.allclose(aligners['a2b'].target_matrix(), AU.normalize_rows(store.get('b').vectors)))
+
+    # a map fitted in float64 searches the float32 targets without copying them
+    joint = AU.SVDAligner('joint', None, None, None, None, None, None, [])
+    joint.bind_store(store, 'a', 'b')
+    joint.set_params(np.eye(6))
+    joint.translate_words(['w001'], k=2)
+    assert(joint.target_matrix() is aligners['c2b'].target_matrix())
+
+def test_store_aligners_rebind_when_unpickled(tmp_path):
+    store = ES.EmbeddingStore(tmp_path / 'store')
+    for emb in embeddings(['a', 'b']).values():
+        store.save(emb)
+    aligner = store_aligners(store, ['a', 'b'])['a2b']
+    state = aligner.__getstate__()
+    assert(all(key not in state for key in ['mtxA', 'mtxB', 'w2idA', 'id2wB', '_normB']))
+
+    loaded = pickle.loads(pickle.dumps(aligner))
+    assert(loaded.mtxB is store.get('b').vectors)
+    assert(loaded.target_matrix() is aligner.target_matrix())
+    assert_same_translations(aligner, loaded, ['w000', 'w050', 'w119'])
+
+    AU.save_compact(aligner, tmp_path / 'a2b')
+    assert(not (tmp_path / 'a2b' / 'mtxB.npy').exists())
+    compact = AU.load_aligner(tmp_path / 'a2b')
+    assert(compact.target_matrix() is aligner.target_matrix())
+    assert_same_translations(aligner, compact, ['w000', 'w050', 'w119'])
+
+def test_store_without_unit_rows(tmp_path):
+    store = ES.EmbeddingStore(tmp_path / 'store')
+    for emb in embeddings(['a', 'b', 'c']).values():
+        store.save(emb)
+    os.remove(store.unit_path('b'))
+    ES._OPEN.clear()
+    aligners = store_aligners(store, ['a', 'b', 'c'])
+    # normalized once in memory, and still shared
+    assert(aligners['a2b'].target_matrix() is aligners['c2b'].target_matrix())
+    assert(not isinstance(aligners['a2b'].target_matrix(), np.memmap))
+
+def test_store_cca_aligners_search_their_projection(tmp_path):
+    store = ES.EmbeddingStore(tmp_path / 'store')
+    embs = embeddings(['a', 'b'])
+    for emb in embs.values():
+        store.save(emb)
+    words = embs['a'].words.tolist()
+    unbound = AU.get_cca_aligner(embs['a'], embs['b'], None, words[:60])
+    aligner = store_aligners(store, ['a', 'b'], method='cca')['a2b']
+    loaded = pickle.loads(pickle.dumps(aligner))
+    assert(loaded.target_matrix() is not store.get('b').unit_vectors)
+    assert_same_translations(unbound, loaded, words[::5])
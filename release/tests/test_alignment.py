@@ -0,0 +1,121 @@
+from pathlib import Path
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'src' / 'alignment'))
+import AlignUtils as AU
+import EmbeddingStore as ES
+
+# python -m pytest -q ./tests
+#   the alignment fits, on maps with a known answer
+
+def random_rotation(rng, dims):
+    return np.linalg.qr(rng.randn(dims, dims))[0]
+
+def test_align_svd_recovers_rotation():
+    rng = np.random.RandomState(7)
+    for dims in [2, 5, 30]:
+        source = rng.randn(100, dims)
+        R = random_rotation(rng, dims)
+        assert(np.allclose(AU.align_svd(source, source.dot(R)), R))
+
+def test_align_joint_recovers_rotations():
+    rng = np.random.RandomState(9)
+    common = rng.randn(80, 6)
+    rotations = [random_rotation(rng, 6) for _ in range(4)]
+    sources = [common.dot(R.T) for R in rotations]
+    transforms = AU.align_joint(sources)
+    mapped = [source.dot(T) for source, T in zip(sources, transforms)]
+    for T in transforms:
+        assert(np.allclose(T.T.dot(T), np.eye(6)))
+    for m in mapped[1:]:
+        assert(np.allclose(m, mapped[0]))
+    # every pair map is the relative rotation between the two communities
+    for i, j in [(0, 1), (2, 3), (3, 0)]:
+        assert(np.allclose(transforms[i].dot(transforms[j].T), rotations[i].dot(rotations[j].T)))
+    with pytest.raises(ValueError):
+        AU.align_joint(sources, n_iter=0)
+
+def test_joint_alignment_aligners(tmp_path):
+    rng = np.random.RandomState(12)
+    words = np.array([f"w{i:03d}" for i in range(100)])
+    common = rng.randn(100, 5)
+    rotations = {name: random_rotation(rng, 5) for name in ['a', 'b', 'c']}
+    embs = {name: ES.Embedding(name, words, common.dot(R.T).astype(np.float32)) for name, R in rotations.items()}
+    joint = AU.JointAlignment.fit(embs, words[:40].tolist())
+    joint.save(tmp_path / 'joint.npz')
+    loaded = AU.JointAlignment.load(tmp_path / 'joint.npz')
+    assert(loaded.names == ['a', 'b', 'c'] and loaded.anchors == words[:40].tolist())
+
+    store = ES.EmbeddingStore(tmp_path / 'store')
+    for emb in embs.values():
+        store.save(emb)
+    for a, b in [('a', 'b'), ('c', 'a')]:
+        aligner = loaded.get_aligner(a, b, emb_a=embs[a], emb_b=embs[b])
+        # the pair map is the relative rotation, so every word translates to itself
+        assert(np.allclose(aligner.T, rotations[a].dot(rotations[b].T), atol=1e-5))
+        assert([g[0] for g in aligner.translate_words(words.tolist())[0]] == words.tolist())
+        stored = AU.get_joint_aligner(tmp_path / 'joint.npz', a, b, store)
+        assert(stored.translate_words(words.tolist())[0] == aligner.translate_words(words.tolist())[0])
+
+def dense_csls(source, target, csls_k):
+    sims = np.matmul(source, target.T)
+    r_source = -np.sort(-sims, axis=1)[:, :csls_k].mean(axis=1)
+    r_target = -np.sort(-sims.T, axis=1)[:, :csls_k].mean(axis=1)
+    csls = 2 * sims - r_source[:, np.newaxis] - r_target[np.newaxis, :]
+    forward = csls.argmax(axis=1)
+    backward = csls.argmax(axis=0)
+    rows = np.flatnonzero(backward[forward] == np.arange(len(source)))
+    return rows, forward[rows], csls[rows, forward[rows]]
+
+@pytest.mark.parametrize('csls_k', [1, 3, 10])
+def test_csls_neighbours_matches_dense(csls_k):
+    rng = np.random.RandomState(5)
+    source = AU.normalize_rows(rng.randn(50, 6))
+    target = AU.normalize_rows(rng.randn(45, 6))
+    rows, cols, scores = AU.csls_neighbours(source, target, csls_k=csls_k, max_memory=2**11)
+    ref_rows, ref_cols, ref_scores = dense_csls(source, target, csls_k)
+    assert(np.array_equal(rows, ref_rows))
+    assert(np.array_equal(cols, ref_cols))
+    assert(np.allclose(scores, ref_scores))
+
+def test_csls_neighbours_needs_a_neighbour():
+    source = AU.normalize_rows(np.eye(3))
+    with pytest.raises(ValueError):
+        AU.csls_neighbours(source, source, csls_k=0)
+
+def test_refine_svd_recovers_rotation():
+    rng = np.random.RandomState(8)
+    source = rng.randn(300, 10)
+    R = random_rotation(rng, 10)
+    target = source.dot(R) + 0.01 * rng.randn(300, 10)
+    # a rough start from a few anchors, with the rest of the dictionary learned
+    T = AU.align_svd(source[:15], target[:15] + 0.3 * rng.randn(15, 10))
+    T, rows_a, rows_b = AU.refine_svd(source, target, T, n_iter=10, csls_k=5)
+    assert(np.array_equal(rows_a, np.arange(300)))
+    assert(np.array_equal(rows_b, np.arange(300)))
+    assert(np.allclose(T, R, atol=1e-2))
+
+@pytest.mark.parametrize('n_iter', [0, -2])
+def test_refine_svd_needs_a_round(n_iter):
+    source = np.eye(4)
+    with pytest.raises(ValueError):
+        AU.refine_svd(source, source, np.eye(4), n_iter=n_iter)
+
+def test_svd_sweep_matches_individual_fits():
+    rng = np.random.RandomState(6)
+    source = rng.randn(200, 10)
+    target = rng.randn(200, 10)
+    ks = [150, 20, 20, 200, 11]
+    fitted = list(AU.align_svd_sweep(source, target, ks))
+    assert([k for k, _ in fitted] == sorted(set(ks)))
+    for k, T in fitted:
+        assert(np.allclose(T, AU.align_svd(source[:k], target[:k])))
+
+@pytest.mark.parametrize('ks', [[0], [-5, 10], [-1]])
+def test_svd_sweep_needs_positive_prefixes(ks):
+    source = np.eye(4)
+    with pytest.raises(ValueError):
+        list(AU.align_svd_sweep(source, source, ks))
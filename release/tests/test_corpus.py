@@ -0,0 +1,74 @@
+from pathlib import Path
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'src' / 'modeling'))
+import CorpusUtils as CU
+
+# python -m pytest -q ./tests
+#   corpus manifests, their line offsets and the chunks cut at them
+
+LINES = ['a b c\n', '\n', 'élan vital\n', 'x\n', 'one two three four five\n', '\n', 'ü\n', 'last line no newline']
+
+def write_corpus(path, lines=LINES, repeat=50):
+    with open(path, 'w', encoding='utf-8') as fp:
+        fp.write(''.join(lines * repeat))
+    return path
+
+def expected_offsets(path):
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    return [0] + [i + 1 for i, c in enumerate(data) if c == ord('\n') and i + 1 < len(data)]
+
+@pytest.mark.parametrize('buffer_size', [1, 7, 2**20])
+def test_manifest_writer_offsets(tmp_path, buffer_size):
+    f = write_corpus(tmp_path / 'c.txt')
+    writer = CU.ManifestWriter(f, buffer_size=buffer_size)
+    with open(f, 'rb') as fp:
+        lines = list(fp)
+    # whole lines one at a time, then the rest as batches
+    for line in lines[:10]:
+        writer.add(len(line), len(line.split()))
+    for start in range(10, len(lines), 13):
+        batch = lines[start:start + 13]
+        writer.add_lines([len(line) for line in batch], sum(len(line.split()) for line in batch))
+    manifest = writer.close()
+
+    assert(np.load(CU.offsets_path(f)).tolist() == expected_offsets(f))
+    assert(manifest['n_lines'] == len(lines))
+    assert(manifest['n_tokens'] == sum(len(line.split()) for line in lines))
+    assert(manifest == CU.get_manifest(f))
+    assert(not CU.offsets_path(f).with_suffix('.tmp').exists())
+
+def test_manifest_is_rebuilt_when_the_corpus_changes(tmp_path):
+    f = write_corpus(tmp_path / 'c.txt')
+    assert(CU.read_manifest(f) is None)
+    manifest = CU.get_manifest(f)
+    assert(CU.read_manifest(f) == manifest)
+    write_corpus(f, repeat=3)
+    os.utime(f, (0, 1))
+    assert(CU.read_manifest(f) is None)
+    assert(CU.get_manifest(f)['n_lines'] == len(expected_offsets(f)))
+    assert(CU.load_offsets(f).tolist() == expected_offsets(f))
+
+def test_empty_corpus(tmp_path):
+    f = tmp_path / 'c.txt'
+    f.write_text('')
+    assert(CU.build_manifest(f)['n_lines'] == 0)
+    assert(CU.get_chunks(f) == [])
+
+@pytest.mark.parametrize('chunk_size', [1, 5, 37, 64, 10**6])
+def test_chunks_from_offsets_match_scanned_chunks(tmp_path, chunk_size):
+    f = write_corpus(tmp_path / 'c.txt')
+    scanned = CU.get_chunks(f, chunk_size)
+    CU.build_manifest(f)
+    assert(CU.get_chunks(f, chunk_size) == scanned)
+
+    # the chunks tile the file, and every one starts on a line
+    starts = set(expected_offsets(f))
+    assert(scanned[0][1] == 0 and scanned[-1][2] == f.stat().st_size)
+    assert(all(a[2] == b[1] for a, b in zip(scanned, scanned[1:])))
+    assert(all(start in starts for _, start, _ in scanned))
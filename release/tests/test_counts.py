@@ -0,0 +1,40 @@
+from pathlib import Path
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'src' / 'stats'))
+import CountUtils as CU
+
+# python -m pytest -q ./tests
+#   the binary counts store and the anchor ranking built on it
+
+def test_counts_round_trip(tmp_path):
+    counts = CU.Counts.from_dict({'b': 3, 'a': 1, 'c': 7})
+    CU.save_counts(tmp_path, 'x', counts)
+    loaded = CU.load_counts(tmp_path, 'x')
+    assert(loaded.words.tolist() == ['a', 'b', 'c'])
+    assert(loaded.lookup(['c', 'zz', 'a', '']).tolist() == [7, 0, 1, 0])
+    assert(CU.Counts.from_dict({}).lookup(['a']).tolist() == [0])
+
+@pytest.mark.parametrize('k', [None, 0, 1, 7, 20, 60, 1000])
+def test_rank_anchors_matches_stable_sort(k):
+    rng = np.random.RandomState(4)
+    vocab = [f"w{i:03d}" for i in range(60)]
+    # few distinct totals, so most of the ranking is decided by ties
+    counts_a = {w: int(c) for w, c in zip(vocab, rng.randint(0, 4, 60)) if rng.rand() < 0.8}
+    counts_b = {w: int(c) for w, c in zip(vocab, rng.randint(0, 4, 60)) if rng.rand() < 0.8}
+    shared = sorted(vocab[5:])
+
+    v_counts = [(w, counts_a.get(w, 0) + counts_b.get(w, 0)) for w in shared]
+    expected = [w for w, _ in sorted(v_counts, key=lambda x: x[1], reverse=True)]
+    if k is not None:
+        expected = expected[:k]
+    ranked = CU.rank_anchors(shared, CU.Counts.from_dict(counts_a), CU.Counts.from_dict(counts_b), k)
+    assert(ranked == expected)
+
+def test_rank_shared_sums_every_community():
+    counts = [CU.Counts.from_dict({'a': 1, 'b': 2}), CU.Counts.from_dict({'a': 5}), CU.Counts.from_dict({'c': 4})]
+    assert(CU.rank_shared(['a', 'b', 'c'], counts) == ['a', 'c', 'b'])
+    assert(CU.rank_shared(['a', 'b', 'c'], counts, 2) == ['a', 'c'])
@@ -0,0 +1,124 @@
+from pathlib import Path
+import io
+import sys
+
+import pytest
+from nltk.corpus import wordnet
+from nltk.corpus.reader.wordnet import WordNetCorpusReader
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'src' / 'analysis'))
+import ExploreUtils as EU
+
+# python -m pytest -q ./tests
+#   the cached antonym lexicon against direct WordNet lookups
+
+class Lemma():
+    def __init__(self, name):
+        self._name = name
+        self._antonyms = []
+
+    def name(self):
+        return self._name
+
+    def antonyms(self):
+        return self._antonyms
+
+class Synset():
+    def __init__(self, names):
+        self._lemmas = [Lemma(n) for n in names]
+
+    def lemmas(self):
+        return self._lemmas
+
+class FakeWordNet():
+    """
+    A small WordNet that reduces words to lemmas as morphy does: the word itself,
+    its exception-list bases, or one suffix substitution.
+    """
+    MORPHOLOGICAL_SUBSTITUTIONS = WordNetCorpusReader.MORPHOLOGICAL_SUBSTITUTIONS
+    EXCEPTIONS = {'noun.exc': 'mice mouse\n',
+                  'verb.exc': 'went go\n',
+                  'adj.exc': 'better good well\nworse bad ill\n\n',
+                  'adv.exc': 'better well\n'}
+
+    def __init__(self, pairs, plain):
+        """
+        pairs: (lemmas, antonym lemmas) of synsets whose first lemmas are antonyms
+        plain: lemmas of synsets without antonyms
+        """
+        self.synset_list = []
+        for names, antonym_names in pairs:
+            a, b = Synset(names), Synset(antonym_names)
+            a.lemmas()[0]._antonyms.append(b.lemmas()[0])
+            b.lemmas()[0]._antonyms.append(a.lemmas()[0])
+            self.synset_list += [a, b]
+        self.synset_list += [Synset(names) for names in plain]
+        self.index = {}
+        for synset in self.synset_list:
+            for lemma in synset.lemmas():
+                self.index.setdefault(lemma.name().lower(), []).append(synset)
+
+    def open(self, name):
+        return io.StringIO(self.EXCEPTIONS[name])
+
+    def all_synsets(self):
+        return iter(self.synset_list)
+
+    def synsets(self, word):
+        word = word.lower()
+        forms = [word]
+        for pos, substitutions in self.MORPHOLOGICAL_SUBSTITUTIONS.items():
+            forms += EU.exception_forms(pos).get(word, [])
+            forms += [word[:len(word) - len(old)] + new for old, new in substitutions if word.endswith(old)]
+        res = []
+        for form in forms:
+            for synset in self.index.get(form, []):
+                if synset not in res:
+                    res.append(synset)
+        return res
+
+WORDS = ['good', 'Good', 'GOOD', 'better', 'worse', 'bad', 'ill', 'sick', 'well', 'evil', 'cold', 'colder',
+         'coldest', 'hot', 'hotter', 'increase', 'increased', 'increases', 'increasing', 'decreasing', 'north',
+         'North', 'south', 'mouse', 'mice', 'table', 'tables', 'dark', 'darker', 'lights', 'light', 'went', 'go',
+         'stop', 'stopped', 'xyz', '', 'boxes', 'classes', 'class']
+
+@pytest.fixture
+def fake_wordnet(monkeypatch):
+    fake = FakeWordNet(pairs=[(['good', 'goodness'], ['bad', 'badness']),
+                              (['good'], ['evil']),
+                              (['well'], ['ill', 'sick']),
+                              (['hot'], ['cold']),
+                              (['increase'], ['decrease']),
+                              (['North'], ['South']),
+                              (['dark'], ['light']),
+                              (['go'], ['stop']),
+                              (['class'], ['mass'])],
+                       plain=[['mouse'], ['table', 'tabular_array'], ['box'], ['bad', 'big']])
+    monkeypatch.setattr(EU, 'wordnet', fake)
+    return fake
+
+def test_lexicon_matches_direct_lookups(fake_wordnet, tmp_path):
+    expected = EU.get_antonyms(WORDS)
+    assert(('better', 'bad') in expected and ('worse', 'good') in expected and ('North', 'South') in expected)
+    lexicon = EU.get_antonym_lexicon(tmp_path / 'antonyms.json')
+    assert(EU.get_antonyms(WORDS, lexicon) == expected)
+    # the lexicon is read back from its cache
+    assert(EU.get_antonym_lexicon(tmp_path / 'antonyms.json') == lexicon)
+    assert(EU.get_antonyms([], lexicon) == set())
+
+def test_exception_forms(fake_wordnet):
+    assert(EU.exception_forms('a') == {'better': ['good', 'well'], 'worse': ['bad', 'ill']})
+    assert(EU.exception_forms('s') == EU.exception_forms('a'))
+
+def wordnet_available():
+    try:
+        wordnet.ensure_loaded()
+    except LookupError:
+        return False
+    return True
+
+@pytest.mark.skipif(not wordnet_available(), reason="the WordNet data is not installed")
+def test_lexicon_matches_wordnet(tmp_path):
+    vocab = WORDS + [lemma.lower() for lemma in wordnet.words()][::500]
+    lexicon = EU.get_antonym_lexicon(tmp_path / 'antonyms.json')
+    assert(EU.get_antonyms(vocab, lexicon) == EU.get_antonyms(vocab))
@@ -0,0 +1,36 @@
+from pathlib import Path
+import multiprocessing
+import sys
+
+import pytest
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'src'))
+import PoolUtils
+
+# python -m pytest -q ./tests
+#   the shared worker pool of align.py, misalign.py, antonyms.py and topics.py
+
+def square(x):
+    return x * x
+
+def fail_on_three(x):
+    if x == 3:
+        raise RuntimeError("three")
+    return x
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_imap_unordered_runs_every_job(workers):
+    assert(sorted(PoolUtils.imap_unordered(square, range(20), workers)) == [x * x for x in range(20)])
+    assert(multiprocessing.active_children() == [])
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_imap_unordered_stops_the_pool_on_errors(workers):
+    with pytest.raises(RuntimeError):
+        list(PoolUtils.imap_unordered(fail_on_three, range(20), workers))
+    assert(multiprocessing.active_children() == [])
+
+def test_imap_unordered_stops_the_pool_when_abandoned():
+    results = PoolUtils.imap_unordered(square, range(20), 3)
+    next(results)
+    results.close()
+    assert(multiprocessing.active_children() == [])
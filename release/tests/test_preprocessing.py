@@ -0,0 +1,77 @@
+from pathlib import Path
+import json
+import pickle
+import random
+import sys
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'example'))
+import preprocessing
+
+# python -m pytest -q ./tests
+#   the parallel preprocessing modes against the serial one
+
+VOCAB = ['new', 'york', 'city', 'is', 'big', 'san', 'francisco', 'the', 'a', 'of', 'ice', 'cream']
+PHRASESEQ = [(2, 0.1), (2, 0.1)]
+
+def write_corpora(directory, names=('a', 'b'), n_lines=300, seed=0):
+    """
+    Tokenized corpora in which 'new york' and 'ice cream' are frequent enough to be phrased.
+    """
+    rng = random.Random(seed)
+    directory.mkdir()
+    for name in names:
+        with open(directory / f"{name}.txt", 'w') as fp:
+            for _ in range(n_lines):
+                sent = []
+                for _ in range(rng.randint(0, 8)):
+                    r = rng.random()
+                    sent += ['new', 'york'] if r < 0.2 else ['ice', 'cream'] if r < 0.3 else [rng.choice(VOCAB)]
+                fp.write(' '.join(sent) + '\n')
+    return list(sorted(directory.glob('*.txt')))
+
+def run(sources, target_dir, **kwargs):
+    target_dir.mkdir()
+    targets = [target_dir / s.name for s in sources]
+    preprocessing.main(sources, targets, PHRASESEQ, **kwargs)
+    with open('data/counts.pkl', 'rb') as fp:
+        return targets, pickle.load(fp)
+
+def test_parallel_phrasing_matches_serial(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'data').mkdir()
+    sources = write_corpora(tmp_path / 'raw')
+    serial, serial_counts = run(sources, tmp_path / 'serial', n_workers=1)
+    # batches much smaller than the corpora, so the workers return them out of order
+    parallel, parallel_counts = run(sources, tmp_path / 'parallel', n_workers=3, batch_size=7,
+                                    cache_dir=tmp_path / 'cache')
+
+    assert(serial_counts == parallel_counts)
+    assert(any('_' in w for w in serial_counts))
+    for s, p in zip(serial, parallel):
+        assert(s.read_text() == p.read_text())
+        manifests = [json.loads(Path(f"{f}.manifest.json").read_text()) for f in [s, p]]
+        for m in manifests:
+            m.pop('mtime')
+        assert(manifests[0] == manifests[1])
+        assert(np.array_equal(np.load(f"{s}.offsets.npy"), np.load(f"{p}.offsets.npy")))
+
+def test_parallel_phrase_detection_matches_serial(tmp_path):
+    sources = write_corpora(tmp_path / 'raw')
+    serial = preprocessing.get_multiphraser(sources, PHRASESEQ)
+    parallel = preprocessing.get_multiphraser_parallel(sources, PHRASESEQ, 3, tmp_path / 'cache')
+    assert(len(serial.phrasers) == len(parallel.phrasers) == len(PHRASESEQ))
+    for s, p in zip(serial.phrasers, parallel.phrasers):
+        assert(s.phrasegrams == p.phrasegrams)
+    assert(len(serial.phrasers[0].phrasegrams) > 0)
+
+    # the phrased text of the first round is cached, and rewritten once its key changes
+    cached = tmp_path / 'cache' / 'round1' / 'a.txt'
+    expected = ''.join(' '.join(serial.phrasers[0][s]) + '\n' for s in preprocessing.get_sentences([sources[0]]))
+    assert(cached.read_text() == expected)
+    mtime = cached.stat().st_mtime_ns
+    preprocessing.get_multiphraser_parallel(sources, PHRASESEQ, 3, tmp_path / 'cache')
+    assert(cached.stat().st_mtime_ns == mtime)
+    preprocessing.get_multiphraser_parallel(sources, [(3, 0.1), (2, 0.1)], 3, tmp_path / 'cache')
+    assert(cached.stat().st_mtime_ns != mtime)
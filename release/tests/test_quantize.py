@@ -0,0 +1,78 @@
+from pathlib import Path
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'src' / 'alignment'))
+import AlignUtils as AU
+import EmbeddingStore as ES
+import IndexUtils as IU
+import quantize
+
+# python -m pytest -q ./tests
+#   quantized searches against the exact search, in memory and from their files
+
+def embeddings(n_words=1500, dims=16, seed=0):
+    rng = np.random.RandomState(seed)
+    words = np.array([f"w{i:05d}" for i in range(n_words)])
+    vectors = rng.randn(n_words, dims).astype(np.float32)
+    target = vectors.dot(np.linalg.qr(rng.randn(dims, dims))[0]).astype(np.float32)
+    target += 0.05 * rng.randn(n_words, dims).astype(np.float32)
+    return ES.Embedding('a', words, vectors), ES.Embedding('b', words, target)
+
+@pytest.mark.parametrize('dtype', ['float16', 'int8'])
+def test_quantized_search_recall(dtype):
+    rng = np.random.RandomState(1)
+    targets = rng.randn(3000, 20).astype(np.float32)
+    queries = targets[rng.choice(3000, 200, replace=False)] + 0.5 * rng.randn(200, 20).astype(np.float32)
+    exact, exact_sims = AU.topk_cosine(queries, AU.normalize_rows(targets), k=10)
+    quant = IU.QuantizedMatrix.build(targets, dtype=dtype, block_size=700)
+    indices, sims = quant.search(queries, k=10, max_memory=2**16)
+    assert(quantize.recall_at_k(exact, indices) >= 0.99)
+    assert(np.mean(exact[:, 0] == indices[:, 0]) >= 0.99)
+    # the returned similarities are the exact ones of the re-ranked rows
+    rows = AU.normalize_rows(targets)[indices]
+    assert(np.allclose(sims, np.einsum('qkd,qd->qk', rows, AU.normalize_rows(queries)), atol=1e-5))
+
+def test_quantized_nbytes(tmp_path):
+    targets = np.random.RandomState(2).randn(500, 32).astype(np.float32)
+    codes_bytes = 500 * 32 + 4 * 500
+    in_memory = IU.QuantizedMatrix.build(targets, dtype='int8')
+    assert(in_memory.nbytes == codes_bytes + targets.nbytes)
+    on_disk = IU.QuantizedMatrix.build(targets, dtype='int8', path=tmp_path / 'int8.quant')
+    assert(isinstance(on_disk.rows, np.memmap))
+    assert(on_disk.nbytes == codes_bytes)
+    half = IU.QuantizedMatrix.build(targets, dtype='float16', path=tmp_path / 'float16.quant')
+    assert(half.nbytes == targets.nbytes // 2)
+    with pytest.raises(ValueError):
+        IU.QuantizedMatrix.build(targets, dtype='int4')
+
+def test_quantized_targets_load_with_the_aligner(tmp_path):
+    emb_a, emb_b = embeddings()
+    aligner = AU.get_svd_aligner(emb_a, emb_b, None, emb_a.words[:300].tolist())
+    aligner.src = aligner.tgt = None
+    path = tmp_path / 'a2b'
+    AU.save_compact(aligner, path)
+    quant = aligner.quantize('int8', path=AU.quantized_path(path))
+    words = emb_a.words[::37].tolist()
+    expected, expected_sims = aligner.translate_words(words, k=5, quantized=True)
+
+    loaded = AU.load_aligner(path)
+    assert(isinstance(loaded.mtxB, np.memmap))
+    assert(isinstance(loaded._quant.rows, np.memmap))
+    assert(loaded._quant.nbytes == quant.nbytes)
+    res, sims = loaded.translate_words(words, k=5, quantized=True)
+    assert(res == expected)
+    assert(np.allclose(sims, expected_sims))
+    res = quantize.evaluate(loaded, k=5, sample=200)
+    assert(res['recall'] >= 0.95 and res['queries'] == 200)
+
+def test_quantized_search_needs_quantized_targets():
+    emb_a, emb_b = embeddings(n_words=200)
+    aligner = AU.get_svd_aligner(emb_a, emb_b, None, emb_a.words[:100].tolist())
+    with pytest.raises(ValueError):
+        aligner.translate_words(['w00001'], quantized=True)
+    aligner.quantize('float16')
+    with pytest.raises(ValueError):
+        aligner.translate_words(['w00001'], approximate=True, quantized=True)
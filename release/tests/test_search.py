@@ -0,0 +1,98 @@
+from pathlib import Path
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'src' / 'alignment'))
+import AlignUtils as AU
+import IndexUtils as IU
+import EmbeddingStore as ES
+
+# python -m pytest -q ./tests
+#   the exact and approximate searches against a dense reference
+
+def dense_topk(queries, targets, k):
+    """
+    The reference search: every similarity, fully sorted.
+    """
+    sims = np.matmul(AU.normalize_rows(queries), targets.T)
+    order = np.argsort(-sims, axis=1, kind='stable')[:, :k]
+    return order, np.take_along_axis(sims, order, axis=1)
+
+@pytest.mark.parametrize('k', [1, 5, 40])
+@pytest.mark.parametrize('max_memory', [1, 2**12, 2**30])
+def test_topk_cosine_matches_dense(k, max_memory):
+    rng = np.random.RandomState(0)
+    queries = rng.randn(37, 8)
+    targets = AU.normalize_rows(rng.randn(40, 8))
+    indices, sims = AU.topk_cosine(queries, targets, k=k, max_memory=max_memory)
+    ref_indices, ref_sims = dense_topk(queries, targets, k)
+    assert(np.array_equal(indices, ref_indices))
+    assert(np.allclose(sims, ref_sims))
+
+def test_topk_cosine_ties():
+    rng = np.random.RandomState(1)
+    base = AU.normalize_rows(rng.randn(6, 5))
+    # every target appears three times, so each rank is a three-way tie
+    targets = np.repeat(base, 3, axis=0)
+    queries = rng.randn(10, 5)
+    indices, sims = AU.topk_cosine(queries, targets, k=7, max_memory=2**10)
+    _, ref_sims = dense_topk(queries, targets, 7)
+    assert(np.allclose(sims, ref_sims))
+    dense = np.matmul(AU.normalize_rows(queries), targets.T)
+    assert(np.allclose(np.take_along_axis(dense, indices, axis=1), sims))
+    assert(all(len(set(row)) == 7 for row in indices.tolist()))
+    # the first six results are both copies of the two best base rows, whatever the tie order
+    best = np.argsort(-dense[:, ::3], axis=1)[:, :2]
+    for row, groups in zip(indices[:, :6] // 3, best):
+        assert(sorted(row.tolist()) == sorted(groups.tolist() * 3))
+
+def test_topk_cosine_k_out_of_range():
+    rng = np.random.RandomState(2)
+    queries = rng.randn(4, 3)
+    targets = AU.normalize_rows(rng.randn(5, 3))
+    indices, sims = AU.topk_cosine(queries, targets, k=50)
+    ref_indices, ref_sims = dense_topk(queries, targets, 5)
+    assert(indices.shape == (4, 5))
+    assert(np.array_equal(indices, ref_indices))
+    assert(np.allclose(sims, ref_sims))
+    indices, sims = AU.topk_cosine(queries, targets, k=0)
+    assert(indices.shape == (4, 0) and sims.shape == (4, 0))
+
+def test_topk_cosine_bias():
+    rng = np.random.RandomState(3)
+    queries = rng.randn(9, 6)
+    targets = AU.normalize_rows(rng.randn(30, 6))
+    bias = rng.rand(30)
+    indices, sims = AU.topk_cosine(queries, targets, k=4, max_memory=2**9, bias=bias)
+    dense = np.matmul(AU.normalize_rows(queries), targets.T) - bias
+    order = np.argsort(-dense, axis=1)[:, :4]
+    assert(np.array_equal(indices, order))
+    assert(np.allclose(sims, np.take_along_axis(dense, order, axis=1)))
+def test_translate_words_max_memory():
+    rng = np.random.RandomState(11)
+    words = np.array([f"w{i:03d}" for i in range(200)])
+    emb_a = ES.Embedding('a', words, rng.randn(200, 8).astype(np.float32))
+    emb_b = ES.Embedding('b', words, rng.randn(200, 8).astype(np.float32))
+    aligner = AU.get_svd_aligner(emb_a, emb_b, None, words[:50].tolist())
+    queries = words[::7].tolist()
+    expected, expected_sims = aligner.translate_words(queries, k=5)
+    # a budget below one row searches one query at a time
+    for max_memory in [1, 2**14]:
+        res, sims = aligner.translate_words(queries, k=5, max_memory=max_memory)
+        assert(res == expected)
+        assert(np.allclose(sims, expected_sims))
+    assert(aligner.translate_word(queries[3], k=5, max_memory=1)[0] == expected[3])
+
+@pytest.mark.parametrize('n_lists', [1, 7, 25])
+def test_ivf_probing_every_list_is_exact(n_lists):
+    rng = np.random.RandomState(10)
+    targets = IU.normalize_rows(rng.randn(400, 8)).astype(np.float32)
+    queries = rng.randn(60, 8).astype(np.float32)
+    index = IU.IVFIndex.build(targets, n_lists=n_lists, seed=0)
+    indices, sims = index.search(queries, targets, k=10, n_probe=index.n_lists)
+    ref_indices, ref_sims = AU.topk_cosine(queries, targets, k=10)
+    recall = np.mean([len(np.intersect1d(a, b)) / 10 for a, b in zip(indices, ref_indices)])
+    assert(recall == 1.0)
+    assert(np.allclose(sims, ref_sims, atol=1e-6))
@@ -0,0 +1,88 @@
+from pathlib import Path
+import pickle
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'src' / 'alignment'))
+import AlignUtils as AU
+import EmbeddingStore as ES
+import serve
+
+# python -m pytest -q ./tests
+#   the translation service against local translations
+
+NAMES = ['a', 'b', 'c']
+
+def embeddings(n_words=150, dims=6, seed=0):
+    rng = np.random.RandomState(seed)
+    words = np.array([f"w{i:03d}" for i in range(n_words)])
+    return {name: ES.Embedding(name, words, rng.randn(n_words, dims).astype(np.float32)) for name in NAMES}
+
+def pairs():
+    return [(a, b) for a in NAMES for b in NAMES if a != b]
+
+def build(directory, factory, store=None):
+    embs = embeddings()
+    directory.mkdir()
+    local = {}
+    for a, b in pairs():
+        aligner = factory(embs[a], embs[b], None, embs[a].words[:80].tolist())
+        aligner.src = aligner.tgt = None
+        if store is not None:
+            aligner.bind_store(store, a, b)
+            AU.save_compact(aligner, directory / f"{a}2{b}")
+        else:
+            with open(directory / f"{a}2{b}.pkl", 'wb') as fp:
+                pickle.dump(aligner, fp)
+        local[f"{a}2{b}"] = aligner
+    return local
+
+def check_translations(service, local):
+    words = ['w000', 'w017', 'unknown', 'w149', 'w017']
+    for name, aligner in local.items():
+        res, sims = service.query('translate', name, words, 3)
+        expected, expected_sims = aligner.translate_words([w for w in words if w != 'unknown'], k=3)
+        assert(res[2] is None and sims[2] is None)
+        assert([r for r in res if r is not None] == expected)
+        assert(np.allclose([s for s in sims if s is not None], expected_sims, atol=1e-5))
+
+def test_pickled_aligners_share_their_targets(tmp_path):
+    local = build(tmp_path / 'svd', AU.get_svd_aligner)
+    service = serve.Service(tmp_path / 'svd', window=0.001)
+    aligners = {name: aligner for name, (aligner, _) in service.batchers['translate'].aligners.items()}
+    for x, y in [('a2b', 'c2b'), ('a2c', 'b2c'), ('b2a', 'c2a')]:
+        assert(aligners[x].mtxB is aligners[y].mtxB)
+        assert(aligners[x].id2wB is aligners[y].id2wB)
+        assert(aligners[x].target_matrix() is aligners[y].target_matrix())
+    check_translations(service, local)
+
+def test_store_aligners_share_the_store_targets(tmp_path):
+    store = ES.EmbeddingStore(tmp_path / 'store')
+    for emb in embeddings().values():
+        store.save(emb)
+    local = build(tmp_path / 'svd', AU.get_svd_aligner, store=store)
+    service = serve.Service(tmp_path / 'svd', window=0.001)
+    aligners = {name: aligner for name, (aligner, _) in service.batchers['translate'].aligners.items()}
+    assert(aligners['a2b'].target_matrix() is aligners['c2b'].target_matrix() is store.get('b').unit_vectors)
+    check_translations(service, local)
+
+def test_cca_aligners_keep_their_own_targets(tmp_path):
+    local = build(tmp_path / 'cca', AU.get_cca_aligner)
+    service = serve.Service(tmp_path / 'cca', window=0.001)
+    aligners = {name: aligner for name, (aligner, _) in service.batchers['translate'].aligners.items()}
+    assert(aligners['a2b'].target_matrix() is not aligners['c2b'].target_matrix())
+    check_translations(service, local)
+
+def test_most_similar_leaves_out_the_word(tmp_path):
+    local = build(tmp_path / 'svd', AU.get_svd_aligner)
+    service = serve.Service(tmp_path / 'svd', window=0.001)
+    res, sims = service.query('most_similar', 'a2b', ['w005', 'w006'], 4)
+    source = AU.normalize_rows(local['a2b'].mtxA)
+    for word, row in zip(['w005', 'w006'], res):
+        dense = source.dot(source[local['a2b'].w2idA[word]])
+        expected = [f"w{i:03d}" for i in np.argsort(-dense)[1:5]]
+        assert(row == expected)
+    with pytest.raises(KeyError):
+        service.query('translate', 'a2a', ['w000'], 1)
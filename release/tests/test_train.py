@@ -0,0 +1,39 @@
+from pathlib import Path
+import os
+import sys
+
+sys.path.append(str(Path(__file__).resolve().parent.parent / 'src' / 'modeling'))
+import train_model
+
+# python -m pytest -q ./tests
+#   the concatenated corpus of multi-community corpus_file training
+
+def write(path, text, mtime=None):
+    path.write_text(text)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return path
+
+def test_multi_corpus_follows_its_inputs(tmp_path):
+    corpora = tmp_path / 'prep'
+    corpora.mkdir()
+    a = write(corpora / 'a.txt', 'a b\nc')
+    b = write(corpora / 'b.txt', 'd e\n')
+    out = tmp_path / 'prep.multi.txt'
+    assert(train_model.get_multi_corpus([a, b], out).read_text() == 'a b\nc\nd e\n')
+
+    # reused while the inputs are unchanged
+    mtime = out.stat().st_mtime_ns
+    train_model.get_multi_corpus([a, b], out)
+    assert(out.stat().st_mtime_ns == mtime)
+
+    # a community removed, although the file is newer than what is left
+    assert(train_model.get_multi_corpus([b], out).read_text() == 'd e\n')
+
+    # a community added with an old mtime, as cp -p would
+    c = write(corpora / 'c.txt', 'f\n', mtime=1)
+    assert(train_model.get_multi_corpus([b, c], out).read_text() == 'd e\nf\n')
+
+    # a corpus rewritten in place, with its old mtime
+    write(c, 'g h\n', mtime=1)
+    assert(train_model.get_multi_corpus([b, c], out).read_text() == 'd e\ng h\n')